@@ -20,19 +20,30 @@ import homeassistant.helpers.config_validation as cv
 from homeassistant.helpers.restore_state import RestoreStateData
 from homeassistant.loader import bind_hass
 
-from .const import CONF_ALLOW_ALL_IMPORTS, DOMAIN, FOLDER, LOGGER_PATH, SERVICE_JUPYTER_KERNEL_START
+from .const import (
+    CONF_ALLOW_ALL_IMPORTS,
+    CONF_STARTUP_CONCURRENCY,
+    DOMAIN,
+    FOLDER,
+    LOGGER_PATH,
+    SERVICE_JUPYTER_KERNEL_START,
+)
 from .eval import AstEval
 from .event import Event
 from .function import Function
 from .global_ctx import GlobalContext, GlobalContextMgr
 from .jupyter_kernel import Kernel
 from .state import State
-from .trigger import TrigTime
+from .trigger import TrigStartup, TrigTime
 
 _LOGGER = logging.getLogger(LOGGER_PATH)
 
 PYSCRIPT_SCHEMA = vol.Schema(
-    {vol.Optional(CONF_ALLOW_ALL_IMPORTS, default=False): cv.boolean}, extra=vol.ALLOW_EXTRA,
+    {
+        vol.Optional(CONF_ALLOW_ALL_IMPORTS, default=False): cv.boolean,
+        vol.Optional(CONF_STARTUP_CONCURRENCY): vol.All(vol.Coerce(int), vol.Range(min=1)),
+    },
+    extra=vol.ALLOW_EXTRA,
 )
 
 CONFIG_SCHEMA = vol.Schema({DOMAIN: PYSCRIPT_SCHEMA}, extra=vol.ALLOW_EXTRA)
@@ -65,6 +76,7 @@ async def async_setup_entry(hass, config_entry):
     Function.init(hass)
     Event.init(hass)
     TrigTime.init(hass)
+    TrigStartup.init(config_entry.data.get(CONF_STARTUP_CONCURRENCY))
     State.init(hass)
     State.register_functions()
     GlobalContextMgr.init()
@@ -100,6 +112,7 @@ async def async_setup_entry(hass, config_entry):
             await hass.config_entries.flow.async_init(DOMAIN, context={"source": SOURCE_IMPORT}, data=config)
 
         State.set_pyscript_config(config_entry.data)
+        TrigStartup.set_concurrency(config_entry.data.get(CONF_STARTUP_CONCURRENCY))
 
         ctx_delete = {}
         for global_ctx_name, global_ctx in GlobalContextMgr.items():
@@ -154,13 +167,15 @@ async def async_setup_entry(hass, config_entry):
 
     async def state_changed(event):
         var_name = event.data["entity_id"]
-        # attr = event.data["new_state"].attributes
         if "new_state" not in event.data or event.data["new_state"] is None:
             # state variable has been deleted
             new_val = None
+            new_attrs = {}
         else:
             new_val = event.data["new_state"].state
+            new_attrs = event.data["new_state"].attributes
         old_val = event.data["old_state"].state if event.data["old_state"] else None
+        old_attrs = event.data["old_state"].attributes if event.data["old_state"] else {}
         new_vars = {var_name: new_val, f"{var_name}.old": old_val}
         func_args = {
             "trigger_type": "state",
@@ -168,7 +183,7 @@ async def async_setup_entry(hass, config_entry):
             "value": new_val,
             "old_value": old_val,
         }
-        await State.update(new_vars, func_args)
+        await State.update(new_vars, func_args, old_attrs=old_attrs, new_attrs=new_attrs)
 
     async def start_triggers(event):
         _LOGGER.debug("adding state changed listener and starting triggers")
@@ -251,3 +266,4 @@ async def load_scripts(hass, data):
             rel_import_path=rel_import_path,
         )
         await GlobalContextMgr.load_file(source_file, global_ctx)
+    GlobalContextMgr.parse_cache_prune()
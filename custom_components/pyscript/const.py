@@ -6,10 +6,24 @@ FOLDER = "pyscript"
 
 CONF_ALLOW_ALL_IMPORTS = "allow_all_imports"
 
+CONF_STARTUP_CONCURRENCY = "startup_concurrency"
+
 SERVICE_JUPYTER_KERNEL_START = "jupyter_kernel_start"
 
 LOGGER_PATH = "custom_components.pyscript"
 
+#
+# Default number of seconds a pyscript task runs before loops and function calls
+# yield to let the event loop run other tasks; None disables time slicing
+#
+DEFAULT_TIME_SLICE = 0.05
+
+#
+# Default number of trigger functions whose startup runs (eg, @time_trigger("startup"))
+# can be running at the same time; the others wait their turn
+#
+DEFAULT_STARTUP_CONCURRENCY = 8
+
 ALLOWED_IMPORTS = {
     "black",
     "cmath",
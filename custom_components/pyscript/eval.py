@@ -3,13 +3,18 @@
 import ast
 import asyncio
 import builtins
-from collections import OrderedDict
+from collections import ChainMap, OrderedDict
+import functools
 import importlib
 import inspect
 import io
 import keyword
 import logging
+import math
+import operator
 import sys
+import time
+import types
 
 import yaml
 
@@ -193,6 +198,294 @@ class EvalLocalVar:
         return f"EvalLocalVar @{hex(id(self))} = {self.value if self.defined else 'undefined'}"
 
 
+class EvalYield:
+    """Awaitable used by yield to suspend a generator's body and pass a value to its consumer."""
+
+    def __init__(self, value):
+        """Initialize with the value being yielded."""
+        self.value = value
+
+    def __await__(self):
+        """Suspend until the generator is resumed, and return the value sent to it."""
+        return (yield self)
+
+
+class EvalStopIteration(Exception):
+    """Carries a StopIteration raised for a script, eg, by next() on an exhausted generator.
+
+    A StopIteration can't propagate out of a coroutine, which turns it into a RuntimeError
+    (PEP 479), so it's wrapped while it passes up through the interpreter's coroutines.
+    try...except matches and binds the StopIteration it carries.
+    """
+
+    def __init__(self, stop):
+        """Initialize with the StopIteration being carried."""
+        super().__init__(*stop.args)
+        self.stop = stop
+
+
+class EvalGenerator:
+    """Asynchronous iterator that lazily runs the body of a generator function or expression.
+
+    The body is a coroutine, running in its own AstEval context, which awaits an
+    EvalYield for each value it produces.  Each __anext__() steps the coroutine until
+    it awaits the next EvalYield, passing anything else it awaits (eg, futures) up to
+    the event loop in between.  The coroutine is only created by the first __anext__(),
+    so a generator that is never iterated doesn't leave one that was never awaited.
+    """
+
+    def __init__(self, ast_ctx, gen_ctx, body):
+        """Initialize generator that runs the coroutine returned by body() in gen_ctx.
+
+        Exceptions are reported in ast_ctx.
+        """
+        self.ast_ctx = ast_ctx
+        self.gen_ctx = gen_ctx
+        self.body = body
+        self.coro = None
+        self.running = False
+        self.done = False
+        self.return_value = None
+
+    def __aiter__(self):
+        """Return the iterator."""
+        return self
+
+    def __anext__(self):
+        """Return an awaitable for the next value."""
+        return self.resume(None)
+
+    def asend(self, value):
+        """Return an awaitable for the next value, with value as the result of the current yield."""
+        return self.resume(value)
+
+    async def send(self, value):
+        """Resume the generator, making the current yield evaluate to value."""
+        try:
+            return await self.resume(value)
+        except StopAsyncIteration as stop:
+            raise EvalStopIteration(StopIteration(*stop.args)) from None
+
+    async def aclose(self):
+        """Stop running the body."""
+        if not self.done:
+            self.done = True
+            if self.coro is not None:
+                self.coro.close()
+
+    async def values(self, limit=None):
+        """Return a list of the remaining values, stopping after limit of them if given."""
+        if limit is None:
+            return [value async for value in self]
+        vals = []
+        while len(vals) < limit:
+            try:
+                vals.append(await self.__anext__())
+            except StopAsyncIteration:
+                break
+        return vals
+
+    def __iter__(self):
+        """Return the iterator, so regular Python functions can iterate too."""
+        return self
+
+    def __next__(self):
+        """Return the next value by stepping the body synchronously.
+
+        That only works while the body doesn't await anything other than a bare
+        yield to the event loop (as asyncio.sleep(0) does), since a regular function
+        can't wait for a future.
+        """
+        steps = self.resume(None)
+        try:
+            yielded = steps.send(None)
+            while yielded is None:
+                yielded = steps.send(None)
+        except StopIteration as stop:
+            return stop.value
+        except StopAsyncIteration:
+            raise StopIteration from None
+        steps.close()
+        msg = "generator can't be iterated by a regular function while it awaits; use list() on it first"
+        raise RuntimeError(msg)
+
+    def raise_exception(self):
+        """Report and raise any exception that stopped the body."""
+        err = self.gen_ctx.exception_obj
+        if err is None:
+            return
+        if not self.ast_ctx.exception_obj:
+            self.ast_ctx.exception_obj = err
+            self.ast_ctx.exception = self.gen_ctx.exception
+            self.ast_ctx.exception_long = self.gen_ctx.exception_long
+        raise err
+
+    @types.coroutine
+    def resume(self, value):
+        """Run the body until it yields its next value, which is returned."""
+        if self.done:
+            raise StopAsyncIteration
+        if self.running:
+            raise RuntimeError("generator already executing")
+        self.running = True
+        if self.coro is None:
+            self.coro = self.body()
+        exc = None
+        try:
+            while True:
+                try:
+                    yielded = self.coro.throw(exc) if exc else self.coro.send(value)
+                except StopIteration as stop:
+                    self.done = True
+                    self.return_value = stop.value
+                    self.raise_exception()
+                    if stop.value is None:
+                        raise StopAsyncIteration from None
+                    raise StopAsyncIteration(stop.value) from None
+                except Exception:
+                    self.done = True
+                    self.raise_exception()
+                    raise
+                except BaseException:
+                    self.done = True
+                    raise
+                if isinstance(yielded, EvalYield):
+                    return yielded.value
+                exc = None
+                try:
+                    value = yield yielded
+                except BaseException as err:
+                    exc = err
+        finally:
+            self.running = False
+
+    def __del__(self):
+        """Close the body's coroutine, if it was started and didn't finish."""
+        if not self.done:
+            self.done = True
+            if self.coro is not None:
+                self.coro.close()
+
+
+async def eval_aiter(iterable):
+    """Iterate over iterable, which can be an EvalGenerator or a regular iterable."""
+    if isinstance(iterable, EvalGenerator):
+        async for value in iterable:
+            yield value
+    else:
+        for value in iterable:
+            yield value
+
+
+def eval_async_iter(iterable):
+    """Return an asynchronous iterator for async for, which also accepts regular iterables."""
+    if hasattr(iterable, "__aiter__"):
+        return iterable
+    return eval_aiter(iterable)
+
+
+def eval_comp_iter(gen, iterable):
+    """Return an asynchronous iterator for the comprehension gen, which might use async for."""
+    return eval_async_iter(iterable) if gen.is_async else eval_aiter(iterable)
+
+
+async def generator_all(gen):
+    """Implement all() for an EvalGenerator, stopping at the first false value."""
+    async for value in gen:
+        if not value:
+            return False
+    return True
+
+
+async def generator_any(gen):
+    """Implement any() for an EvalGenerator, stopping at the first true value."""
+    async for value in gen:
+        if value:
+            return True
+    return False
+
+
+async def generator_sum(gen, start=0):
+    """Implement sum() for an EvalGenerator."""
+    async for value in gen:
+        start = start + value
+    return start
+
+
+async def generator_next(gen, *default):
+    """Implement next() for an EvalGenerator."""
+    try:
+        return await gen.__anext__()
+    except StopAsyncIteration as stop:
+        if default:
+            return default[0]
+        raise EvalStopIteration(StopIteration(*stop.args)) from None
+
+
+async def generator_len(gen):
+    """Implement len() for an EvalGenerator, which, as in Python, doesn't have a length."""
+    raise TypeError("object of type 'generator' has no len()")
+
+
+async def generator_contains(gen, value):
+    """Implement value in gen for an EvalGenerator, stopping at the first match."""
+    async for elt in gen:
+        if elt is value or elt == value:
+            return True
+    return False
+
+
+#
+# builtins that consume a generator argument as its values are produced, rather
+# than requiring a list of all of them first
+#
+GENERATOR_BUILTIN_FUNCS = {
+    all: generator_all,
+    any: generator_any,
+    sum: generator_sum,
+    next: generator_next,
+    len: generator_len,
+}
+
+#
+# builtins that are passed the generator itself: either they iterate over it lazily,
+# returning an iterator, or they don't iterate over it at all
+#
+GENERATOR_LAZY_BUILTIN_FUNCS = {
+    callable,
+    enumerate,
+    filter,
+    hash,
+    id,
+    isinstance,
+    iter,
+    map,
+    repr,
+    str,
+    type,
+    zip,
+}
+
+
+def attribute_dotted_name(arg):
+    """Return the first name and the dotted name of a chain of attributes on a name.
+
+    For example, Attribute(value=Attribute(value=Name(id='i'), attr='j'), attr='k') gives
+    ("i", "i.j.k").  Both are None if the chain doesn't start with a name.  The result
+    only depends on the ast, so it's cached on the node.
+    """
+    dotted = getattr(arg, "eval_dotted_name", None)
+    if dotted is None:
+        name = arg.attr
+        val = arg.value
+        while isinstance(val, ast.Attribute):
+            name = val.attr + "." + name
+            val = val.value
+        dotted = (val.id, val.id + "." + name) if isinstance(val, ast.Name) else (None, None)
+        arg.eval_dotted_name = dotted
+    return dotted
+
+
 class EvalName:
     """Identifier that hasn't yet been resolved."""
 
@@ -205,6 +498,17 @@ class EvalName:
         raise NameError(f"name '{self.name}.{attr}' is not defined")
 
 
+#
+# returned by compiled name lookups instead of allocating an EvalName when only
+# whether the name is defined matters
+#
+UNDEFINED = object()
+
+
+class EvalSyncFallback(Exception):
+    """Raised by compiled synchronous code when its node has to be evaluated asynchronously."""
+
+
 class EvalAttrSet:
     """Class for object and attribute on lhs of assignment."""
 
@@ -234,12 +538,20 @@ class EvalFunc:
         self.logger = logging.getLogger(LOGGER_PATH + "." + self.global_ctx_name)
         self.defaults = []
         self.kw_defaults = []
+        self.arg_names = [arg.arg for arg in func_def.args.args]
+        self.num_arg = len(self.arg_names)
+        self.bind_fill = {self.num_arg: {}}
+        self.kwonly_names = [arg.arg for arg in func_def.args.kwonlyargs]
+        self.kwonly_defaults = {}
+        self.vararg_name = func_def.args.vararg.arg if func_def.args.vararg else None
+        self.kwarg_name = func_def.args.kwarg.arg if func_def.args.kwarg else None
+        self.bind_positional_only = not (self.kwonly_names or self.vararg_name or self.kwarg_name)
         self.decorators = []
         self.global_names = set()
         self.nonlocal_names = set()
         self.local_sym_table = {}
         self.doc_string = ast.get_docstring(func_def)
-        self.num_posn_arg = len(self.func_def.args.args) - len(self.defaults)
+        self.num_posn_arg = self.num_arg
         self.code_list = code_list
         self.code_str = code_str
         self.exception = None
@@ -248,6 +560,23 @@ class EvalFunc:
         self.trigger = None
         self.trigger_service = False
         self.has_closure = False
+        self.is_generator = self.body_has_yield(func_def)
+
+    @staticmethod
+    def body_has_yield(func_def):
+        """Return whether the function body contains yield, which makes it a generator."""
+        has_yield = getattr(func_def, "eval_has_yield", None)
+        if has_yield is None:
+            has_yield = False
+            todo = list(func_def.body)
+            while todo and not has_yield:
+                node = todo.pop()
+                if isinstance(node, (ast.Yield, ast.YieldFrom)):
+                    has_yield = True
+                elif not isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.Lambda, ast.ClassDef)):
+                    todo += ast.iter_child_nodes(node)
+            func_def.eval_has_yield = has_yield
+        return has_yield
 
     def get_name(self):
         """Return the function name."""
@@ -258,10 +587,77 @@ class EvalFunc:
         self.defaults = []
         for val in self.func_def.args.defaults:
             self.defaults.append(await ast_ctx.aeval(val))
-        self.num_posn_arg = len(self.func_def.args.args) - len(self.defaults)
+        self.num_posn_arg = self.num_arg - len(self.defaults)
         self.kw_defaults = []
         for val in self.func_def.args.kw_defaults:
             self.kw_defaults.append({"ok": bool(val), "val": None if not val else await ast_ctx.aeval(val)})
+        #
+        # the binding plan: for each valid number of positional args, the defaults that
+        # fill in the rest, and the keyword-only args that have defaults
+        #
+        default_items = list(zip(self.arg_names[self.num_posn_arg :], self.defaults))
+        self.bind_fill = {
+            num_args: dict(default_items[num_args - self.num_posn_arg :])
+            for num_args in range(self.num_posn_arg, self.num_arg + 1)
+        }
+        self.kwonly_defaults = {
+            name: default["val"]
+            for name, default in zip(self.kwonly_names, self.kw_defaults)
+            if default["ok"]
+        }
+
+    def bind_args(self, args, kwargs):
+        """Return the symbol table of the function's arguments for a call with args and kwargs."""
+        if not kwargs and self.bind_positional_only:
+            #
+            # fast path for the common case of a call with just positional args
+            #
+            fill = self.bind_fill.get(len(args))
+            if fill is not None:
+                sym_table = dict(zip(self.arg_names, args))
+                if fill:
+                    sym_table.update(fill)
+                return sym_table
+        return self.bind_args_full(args, kwargs)
+
+    def bind_args_full(self, args, kwargs):
+        """Bind args and kwargs to the function's arguments, handling every case."""
+        sym_table = {}
+        if args is None:
+            args = []
+        kwargs = kwargs.copy() if kwargs else {}
+        for i, var_name in enumerate(self.arg_names):
+            val = None
+            if i < len(args):
+                val = args[i]
+                if var_name in kwargs:
+                    raise TypeError(f"{self.name}() got multiple values for argument '{var_name}'")
+            elif var_name in kwargs:
+                val = kwargs[var_name]
+                del kwargs[var_name]
+            elif self.num_posn_arg <= i:
+                val = self.defaults[i - self.num_posn_arg]
+            else:
+                raise TypeError(
+                    f"{self.name}() missing {self.num_posn_arg - i} required positional arguments"
+                )
+            sym_table[var_name] = val
+        for var_name in self.kwonly_names:
+            if var_name in kwargs:
+                val = kwargs[var_name]
+                del kwargs[var_name]
+            elif var_name in self.kwonly_defaults:
+                val = self.kwonly_defaults[var_name]
+            else:
+                raise TypeError(f"{self.name}() missing required keyword-only arguments")
+            sym_table[var_name] = val
+        if self.kwarg_name:
+            sym_table[self.kwarg_name] = kwargs
+        if self.vararg_name:
+            sym_table[self.vararg_name] = tuple(args[self.num_arg :])
+        elif len(args) > self.num_arg:
+            raise TypeError(f"{self.name}() called with too many positional arguments")
+        return sym_table
 
     async def trigger_init(self):
         """Initialize decorator triggers for this function."""
@@ -278,7 +674,9 @@ class EvalFunc:
             "event_trigger",
             "state_active",
             "time_active",
+            "task_limit",
             "task_unique",
+            "trigger_queue",
         }
         decorator_used = set()
         for dec in self.decorators:
@@ -366,6 +764,7 @@ class EvalFunc:
                     DOMAIN, self.name, pyscript_service_factory(self.name, self),
                 )
                 async_set_service_schema(Function.hass, DOMAIN, self.name, service_desc)
+                Function.service_cache_invalidate()
                 self.trigger_service = True
             else:
                 self.logger.warning(
@@ -381,15 +780,17 @@ class EvalFunc:
 
         #
         # check that we have the right number of arguments, and that they are
-        # strings
+        # strings (or the other types allowed, or only the types given with "mesg")
         #
         arg_check = {
             "event_trigger": {"arg_cnt": {1, 2}},
             "state_active": {"arg_cnt": {1}},
             "state_trigger": {"arg_cnt": {"*"}, "type": {list, set}},
+            "task_limit": {"arg_cnt": {1}, "type": {int}, "mesg": "integer"},
             "task_unique": {"arg_cnt": {1}},
             "time_active": {"arg_cnt": {"*"}},
             "time_trigger": {"arg_cnt": {0, "*"}},
+            "trigger_queue": {"arg_cnt": {0}},
         }
         for dec_name, arg_info in arg_check.items():
             arg_cnt = arg_info["arg_cnt"]
@@ -418,10 +819,15 @@ class EvalFunc:
                 del trig_args[dec_name]
                 continue
             for arg_num, arg in enumerate(trig_args[dec_name]["args"]):
-                if isinstance(arg, str):
+                if "mesg" in arg_info:
+                    if type(arg) in arg_info["type"]:
+                        continue
+                    mesg = arg_info["mesg"]
+                elif isinstance(arg, str):
                     continue
-                mesg = "string"
-                if "type" in arg_info:
+                else:
+                    mesg = "string"
+                if "type" in arg_info and "mesg" not in arg_info:
                     if type(arg) in arg_info["type"]:
                         for val in arg:
                             if not isinstance(val, str):
@@ -441,11 +847,20 @@ class EvalFunc:
                 )
                 del trig_args[dec_name]
                 continue
-            if arg_cnt == {1}:
+            if arg_cnt == {1} and dec_name in trig_args:
                 trig_args[dec_name]["args"] = trig_args[dec_name]["args"][0]
 
+        #
+        # the valid keyword arguments for each decorator; None means any (they are
+        # the @event_trigger event data filters)
+        #
         kwarg_check = {
+            "event_trigger": None,
+            "state_trigger": {"debounce", "hold", "throttle"},
+            "task_limit": {"queue"},
             "task_unique": {"kill_me"},
+            "time_trigger": {"startup_delay", "startup_priority"},
+            "trigger_queue": {"size", "policy"},
         }
         for dec_name in trig_args:
             if dec_name not in kwarg_check and "kwargs" in trig_args[dec_name]:
@@ -457,7 +872,7 @@ class EvalFunc:
                 )
             if dec_name in kwarg_check and "kwargs" in trig_args[dec_name]:
                 used_kw = set(trig_args[dec_name]["kwargs"].keys())
-                if not used_kw.issubset(kwarg_check[dec_name]):
+                if kwarg_check[dec_name] is not None and not used_kw.issubset(kwarg_check[dec_name]):
                     self.logger.error(
                         "%s defined in %s: decorator @%s valid keyword arguments are: %s; others ignored",
                         self.name,
@@ -501,6 +916,7 @@ class EvalFunc:
         if self.trigger_service:
             self.trigger_service = False
             Function.hass.services.async_remove(DOMAIN, self.name)
+            Function.service_cache_invalidate()
 
     async def eval_decorators(self, ast_ctx):
         """Evaluate the function decorators arguments."""
@@ -549,6 +965,11 @@ class EvalFunc:
                     stmt, nonlocal_names=nonlocal_names, global_names=global_names, local_names=local_names,
                 )
             )
+        #
+        # global declarations apply to the whole function body, as in Python, which
+        # also matches how the compiled name lookups in the body were resolved
+        #
+        self.global_names.update(global_names)
         for var_name in var_names:
             got_dot = var_name.find(".")
             if got_dot >= 0:
@@ -591,58 +1012,22 @@ class EvalFunc:
             args.append(arg.arg)
         return args
 
-    async def try_aeval(self, ast_ctx, arg):
-        """Call self.aeval and capture exceptions."""
-        try:
-            return await ast_ctx.aeval(arg)
-        except asyncio.CancelledError:
-            raise
-        except Exception as err:
-            if ast_ctx.exception_long is None:
-                ast_ctx.exception_long = ast_ctx.format_exc(err, arg.lineno, arg.col_offset)
+    def call(self, ast_ctx, *args, **kwargs):
+        """Return an awaitable that calls the function with the given context and arguments."""
+        if self.is_generator:
+            return self.call_generator(ast_ctx, *args, **kwargs)
+        return self.call_body(ast_ctx, *args, **kwargs)
+
+    async def call_generator(self, ast_ctx, *args, **kwargs):
+        """Return a generator that runs the body of the function each time it's resumed."""
+        gen_ctx = ast_ctx.generator_ctx(ast_ctx.sym_table)
+        return EvalGenerator(ast_ctx, gen_ctx, functools.partial(self.call_body, gen_ctx, *args, **kwargs))
 
-    async def call(self, ast_ctx, *args, **kwargs):
+    async def call_body(self, ast_ctx, *args, **kwargs):
         """Call the function with the given context and arguments."""
-        sym_table = {}
-        if args is None:
-            args = []
-        kwargs = kwargs.copy() if kwargs else {}
-        for i in range(len(self.func_def.args.args)):
-            var_name = self.func_def.args.args[i].arg
-            val = None
-            if i < len(args):
-                val = args[i]
-                if var_name in kwargs:
-                    raise TypeError(f"{self.name}() got multiple values for argument '{var_name}'")
-            elif var_name in kwargs:
-                val = kwargs[var_name]
-                del kwargs[var_name]
-            elif self.num_posn_arg <= i < len(self.defaults) + self.num_posn_arg:
-                val = self.defaults[i - self.num_posn_arg]
-            else:
-                raise TypeError(
-                    f"{self.name}() missing {self.num_posn_arg - i} required positional arguments"
-                )
-            sym_table[var_name] = val
-        for i in range(len(self.func_def.args.kwonlyargs)):
-            var_name = self.func_def.args.kwonlyargs[i].arg
-            if var_name in kwargs:
-                val = kwargs[var_name]
-                del kwargs[var_name]
-            elif i < len(self.kw_defaults) and self.kw_defaults[i]["ok"]:
-                val = self.kw_defaults[i]["val"]
-            else:
-                raise TypeError(f"{self.name}() missing required keyword-only arguments")
-            sym_table[var_name] = val
-        if self.func_def.args.kwarg:
-            sym_table[self.func_def.args.kwarg.arg] = kwargs
-        if self.func_def.args.vararg:
-            if len(args) > len(self.func_def.args.args):
-                sym_table[self.func_def.args.vararg.arg] = tuple(args[len(self.func_def.args.args) :])
-            else:
-                sym_table[self.func_def.args.vararg.arg] = ()
-        elif len(args) > len(self.func_def.args.args):
-            raise TypeError(f"{self.name}() called with too many positional arguments")
+        if time.monotonic() > ast_ctx.slice_end:
+            await ast_ctx.time_slice_yield()
+        sym_table = self.bind_args(args, kwargs)
         for name, value in self.local_sym_table.items():
             if name in sym_table:
                 sym_table[name] = EvalLocalVar(name, value=sym_table[name])
@@ -668,15 +1053,28 @@ class EvalFunc:
         self.exception_long = None
         prev_func = ast_ctx.curr_func
         ast_ctx.curr_func = self
-        for arg1 in self.func_def.body:
-            val = await self.try_aeval(ast_ctx, arg1)
-            if isinstance(val, EvalReturn):
-                val = val.value
-                break
-            # return None at end if there isn't a return
+        AstCompile.compile_body(self.func_def)
+        #
+        # one try for the whole body, rather than one per statement; an exception
+        # stops the function, which returns None
+        #
+        val = None
+        try:
+            for arg1 in self.func_def.body:
+                val = await ast_ctx.aeval(arg1)
+                if isinstance(val, EvalReturn):
+                    val = val.value
+                    break
+                # return None at end if there isn't a return
+                val = None
+                if ast_ctx.get_exception_obj():
+                    break
+        except asyncio.CancelledError:
+            raise
+        except Exception as err:
+            if ast_ctx.exception_long is None:
+                ast_ctx.exception_long = ast_ctx.format_exc(err, arg1.lineno, arg1.col_offset)
             val = None
-            if ast_ctx.get_exception_obj():
-                break
         ast_ctx.curr_func = prev_func
         ast_ctx.code_str, ast_ctx.code_list = code_str, code_list
         if ast_ctx.global_ctx != self.global_ctx:
@@ -746,6 +1144,9 @@ class AstEval:
         self.logger = None
         self.set_logger_name(logger_name if logger_name is not None else self.name)
         self.config_entry = Function.hass.data.get(DOMAIN, {})
+        self.slice_start = None
+        self.slice_end = None
+        self.time_slice_reset()
 
     async def ast_not_implemented(self, arg, *args):
         """Raise NotImplementedError exception for unimplemented AST types."""
@@ -753,24 +1154,36 @@ class AstEval:
         raise NotImplementedError(f"{self.name}: not implemented ast " + name)
 
     async def aeval(self, arg, undefined_check=True):
-        """Vector to specific function based on ast class type."""
-        name = "ast_" + arg.__class__.__name__.lower()
+        """Vector to compiled code if available, otherwise specific function based on ast class type."""
         try:
-            if hasattr(arg, "lineno"):
-                self.lineno = arg.lineno
-                self.col_offset = arg.col_offset
-            val = await getattr(self, name, self.ast_not_implemented)(arg)
+            code = getattr(arg, "eval_code", None)
+            if code is not None:
+                val = await code(self)
+            else:
+                if hasattr(arg, "lineno"):
+                    self.lineno = arg.lineno
+                    self.col_offset = arg.col_offset
+                ast_func = getattr(self, "ast_" + arg.__class__.__name__.lower(), self.ast_not_implemented)
+                val = await ast_func(arg)
             if undefined_check and isinstance(val, EvalName):
                 raise NameError(f"name '{val.name}' is not defined")
             return val
         except Exception as err:
-            if not self.exception_obj:
-                func_name = self.curr_func.get_name() + "(), " if self.curr_func else ""
-                self.exception_obj = err
-                self.exception = f"Exception in {func_name}{self.filename} line {self.lineno} column {self.col_offset}: {err}"
-                self.exception_long = self.format_exc(err, self.lineno, self.col_offset)
+            self.record_exception(err)
             raise
 
+    def record_exception(self, err):
+        """Record the exception at the current line, unless one was already recorded."""
+        if not self.exception_obj:
+            func_name = self.curr_func.get_name() + "(), " if self.curr_func else ""
+            self.exception_obj = err
+            if isinstance(err, EvalStopIteration):
+                err = err.stop
+            self.exception = (
+                f"Exception in {func_name}{self.filename} line {self.lineno} column {self.col_offset}: {err}"
+            )
+            self.exception_long = self.format_exc(err, self.lineno, self.col_offset)
+
     # Statements return NONE, EvalBreak, EvalContinue, EvalReturn
     async def ast_module(self, arg):
         """Execute ast_module - a list of statements."""
@@ -860,7 +1273,17 @@ class AstEval:
 
     async def ast_for(self, arg):
         """Execute for statement."""
-        for loop_var in await self.aeval(arg.iter):
+        return await self.for_loop(arg, eval_aiter(await self.aeval(arg.iter)))
+
+    async def ast_asyncfor(self, arg):
+        """Execute async for statement."""
+        return await self.for_loop(arg, eval_async_iter(await self.aeval(arg.iter)))
+
+    async def for_loop(self, arg, loop_iter):
+        """Execute the body of a for or async for statement for each value of loop_iter."""
+        async for loop_var in loop_iter:
+            if time.monotonic() > self.slice_end:
+                await self.time_slice_yield()
             await self.recurse_assign(arg.target, loop_var)
             for arg1 in arg.body:
                 val = await self.aeval(arg1)
@@ -877,13 +1300,11 @@ class AstEval:
                     return val
         return None
 
-    async def ast_asyncfor(self, arg):
-        """Execute async for statement."""
-        return await self.ast_for(arg)
-
     async def ast_while(self, arg):
         """Execute while statement."""
         while await self.aeval(arg.test):
+            if time.monotonic() > self.slice_end:
+                await self.time_slice_yield()
             for arg1 in arg.body:
                 val = await self.aeval(arg1)
                 if isinstance(val, EvalStopFlow):
@@ -936,9 +1357,10 @@ class AstEval:
 
     async def ast_lambda(self, arg):
         """Evaluate lambda definition."""
-        funcdef = ast.FunctionDef(
-            args=arg.args, body=[ast.Return(value=arg.body)], name="lambda", decorator_list=None,
-        )
+        body = [ast.Return(value=arg.body)]
+        if getattr(arg.body, "eval_code", None) is not None:
+            AstCompile.compile_nodes(body)
+        funcdef = ast.FunctionDef(args=arg.args, body=body, name="lambda", decorator_list=None)
         func = EvalFunc(funcdef, self.code_list, self.code_str, self.global_ctx)
         await func.eval_defaults(self)
         return EvalFuncVar(func)
@@ -956,64 +1378,13 @@ class AstEval:
                     return val
                 if self.exception_obj is not None:
                     raise self.exception_obj
+        except EvalStopIteration as err:
+            #
+            # a StopIteration is carried by EvalStopIteration, which the script doesn't see
+            #
+            return await self.try_handlers(arg, err, err.stop)
         except Exception as err:
-            curr_exc = self.exception_curr
-            self.exception_curr = err
-            for handler in arg.handlers:
-                match = False
-                if handler.type:
-                    exc_list = await self.aeval(handler.type)
-                    if not isinstance(exc_list, tuple):
-                        exc_list = [exc_list]
-                    for exc in exc_list:
-                        if isinstance(err, exc):
-                            match = True
-                            break
-                else:
-                    match = True
-                if match:
-                    save_obj = self.exception_obj
-                    save_exc_long = self.exception_long
-                    save_exc = self.exception
-                    self.exception_obj = None
-                    self.exception = None
-                    self.exception_long = None
-                    if handler.name is not None:
-                        if handler.name in self.sym_table and isinstance(
-                            self.sym_table[handler.name], EvalLocalVar
-                        ):
-                            self.sym_table[handler.name].set(err)
-                        else:
-                            self.sym_table[handler.name] = err
-                    for arg1 in handler.body:
-                        try:
-                            val = await self.aeval(arg1)
-                            if isinstance(val, EvalStopFlow):
-                                if handler.name is not None:
-                                    del self.sym_table[handler.name]
-                                self.exception_curr = curr_exc
-                                return val
-                        except Exception:
-                            if self.exception_obj is not None:
-                                if handler.name is not None:
-                                    del self.sym_table[handler.name]
-                                self.exception_curr = curr_exc
-                                if self.exception_obj == save_obj:
-                                    self.exception_long = save_exc_long
-                                    self.exception = save_exc
-                                else:
-                                    self.exception_long = (
-                                        save_exc_long
-                                        + "\n\nDuring handling of the above exception, another exception occurred:\n\n"
-                                        + self.exception_long
-                                    )
-                                raise self.exception_obj  # pylint: disable=raise-missing-from
-                    if handler.name is not None:
-                        del self.sym_table[handler.name]
-                    break
-            else:
-                self.exception_curr = curr_exc
-                raise err
+            return await self.try_handlers(arg, err, err)
         else:
             for arg1 in arg.orelse:
                 val = await self.aeval(arg1)
@@ -1026,6 +1397,68 @@ class AstEval:
                     return val  # pylint: disable=lost-exception
         return None
 
+    async def try_handlers(self, arg, err, script_err):
+        """Run the first except handler of try statement arg that matches script_err.
+
+        err is re-raised if no handler matches.
+        """
+        curr_exc = self.exception_curr
+        self.exception_curr = script_err
+        for handler in arg.handlers:
+            match = False
+            if handler.type:
+                exc_list = await self.aeval(handler.type)
+                if not isinstance(exc_list, tuple):
+                    exc_list = [exc_list]
+                for exc in exc_list:
+                    if isinstance(script_err, exc):
+                        match = True
+                        break
+            else:
+                match = True
+            if match:
+                save_obj = self.exception_obj
+                save_exc_long = self.exception_long
+                save_exc = self.exception
+                self.exception_obj = None
+                self.exception = None
+                self.exception_long = None
+                if handler.name is not None:
+                    if handler.name in self.sym_table and isinstance(
+                        self.sym_table[handler.name], EvalLocalVar
+                    ):
+                        self.sym_table[handler.name].set(script_err)
+                    else:
+                        self.sym_table[handler.name] = script_err
+                for arg1 in handler.body:
+                    try:
+                        val = await self.aeval(arg1)
+                        if isinstance(val, EvalStopFlow):
+                            if handler.name is not None:
+                                del self.sym_table[handler.name]
+                            self.exception_curr = curr_exc
+                            return val
+                    except Exception:
+                        if self.exception_obj is not None:
+                            if handler.name is not None:
+                                del self.sym_table[handler.name]
+                            self.exception_curr = curr_exc
+                            if self.exception_obj == save_obj:
+                                self.exception_long = save_exc_long
+                                self.exception = save_exc
+                            else:
+                                self.exception_long = (
+                                    save_exc_long
+                                    + "\n\nDuring handling of the above exception, another exception occurred:\n\n"
+                                    + self.exception_long
+                                )
+                            raise self.exception_obj  # pylint: disable=raise-missing-from
+                if handler.name is not None:
+                    del self.sym_table[handler.name]
+                return None
+        self.exception_curr = curr_exc
+        raise err
+
     async def ast_raise(self, arg):
         """Execute raise statement."""
         if not arg.exc:
@@ -1034,6 +1467,10 @@ class AstEval:
             exc = self.exception_curr
         else:
             exc = await self.aeval(arg.exc)
+        if isinstance(exc, type) and issubclass(exc, StopIteration):
+            exc = exc()
+        if isinstance(exc, StopIteration):
+            exc = EvalStopIteration(exc)
         if self.exception_curr:
             exc.__cause__ = self.exception_curr
         if arg.cause:
@@ -1121,15 +1558,22 @@ class AstEval:
     async def recurse_assign(self, lhs, val):
         """Recursive assignment."""
         if isinstance(lhs, ast.Tuple):
-            try:
-                vals = [*(val.__iter__())]
-            except Exception:
-                raise TypeError("cannot unpack non-iterable object")  # pylint: disable=raise-missing-from
             got_star = 0
             for lhs_elt in lhs.elts:
                 if isinstance(lhs_elt, ast.Starred):
                     got_star = 1
                     break
+            if isinstance(val, EvalGenerator):
+                #
+                # as in Python, stop after one more value than needed to fill the targets
+                #
+                vals = await val.values(None if got_star else len(lhs.elts) + 1)
+            else:
+                try:
+                    vals = [*(val.__iter__())]
+                except Exception:
+                    # pylint: disable=raise-missing-from
+                    raise TypeError("cannot unpack non-iterable object")
             if len(lhs.elts) > len(vals) + got_star:
                 if got_star:
                     err_msg = f"at least {len(lhs.elts) - got_star}"
@@ -1176,13 +1620,17 @@ class AstEval:
                 return
             if dot_count > 0:
                 raise NotImplementedError(f"variable names may contain at most 2 dots")
-            if self.curr_func and var_name in self.curr_func.global_names:
-                self.global_sym_table[var_name] = val
-                return
-            if var_name in self.sym_table and isinstance(self.sym_table[var_name], EvalLocalVar):
-                self.sym_table[var_name].set(val)
-            else:
-                self.sym_table[var_name] = val
+            self.assign_name(var_name, val)
+
+    def assign_name(self, var_name, val):
+        """Assign a value to a variable name without dots."""
+        if self.curr_func and var_name in self.curr_func.global_names:
+            self.global_sym_table[var_name] = val
+            return
+        if var_name in self.sym_table and isinstance(self.sym_table[var_name], EvalLocalVar):
+            self.sym_table[var_name].set(val)
+        else:
+            self.sym_table[var_name] = val
 
     async def ast_assign(self, arg):
         """Execute assignment statement."""
@@ -1249,22 +1697,11 @@ class AstEval:
 
     async def ast_attribute_collapse(self, arg, check_undef=True):
         """Combine dotted attributes to allow variable names to have dots."""
-        # collapse dotted names, eg:
-        #   Attribute(value=Attribute(value=Name(id='i', ctx=Load()), attr='j', ctx=Load()), attr='k', ctx=Store())
-        name = arg.attr
-        val = arg.value
-        while isinstance(val, ast.Attribute):
-            name = val.attr + "." + name
-            val = val.value
-        if isinstance(val, ast.Name):
-            name = val.id + "." + name
-            # ensure the first portion of name is undefined
-            if check_undef and not isinstance(
-                await self.ast_name(ast.Name(id=val.id, ctx=ast.Load())), EvalName
-            ):
-                return None
-            return name
-        return None
+        first_name, name = attribute_dotted_name(arg)
+        # ensure the first portion of name is undefined
+        if name is None or (check_undef and not isinstance(self.lookup_name(first_name), EvalName)):
+            return None
+        return name
 
     async def ast_attribute(self, arg):
         """Apply attributes."""
@@ -1272,7 +1709,7 @@ class AstEval:
         if full_name is not None:
             if isinstance(arg.ctx, ast.Store):
                 return full_name
-            val = await self.ast_name(ast.Name(id=full_name, ctx=arg.ctx))
+            val = await self.load_name(full_name)
             if not isinstance(val, EvalName):
                 return val
         val = await self.aeval(arg.value)
@@ -1280,48 +1717,60 @@ class AstEval:
             return EvalAttrSet(val, arg.attr)
         return getattr(val, arg.attr)
 
+    def lookup_name(self, name):
+        """Look up identifier in the symbol tables, builtins and functions, returning EvalName if not found."""
+        #
+        # check other scopes if required by global declarations
+        #
+        if self.curr_func and name in self.curr_func.global_names:
+            if name in self.global_sym_table:
+                return self.global_sym_table[name]
+            raise NameError(f"global name '{name}' is not defined")
+        #
+        # now check in our current symbol table, and then some other places
+        #
+        if name in self.sym_table:
+            if isinstance(self.sym_table[name], EvalLocalVar):
+                return self.sym_table[name].get()
+            return self.sym_table[name]
+        if name in self.local_sym_table:
+            return self.local_sym_table[name]
+        if name in self.global_sym_table:
+            return self.global_sym_table[name]
+        if name in BUILTIN_AST_FUNCS_FACTORY:
+            return BUILTIN_AST_FUNCS_FACTORY[name](self)
+        if hasattr(builtins, name) and name not in BUILTIN_EXCLUDE and name[0] != "_":
+            return getattr(builtins, name)
+        func = Function.get(name)
+        if func:
+            return func
+        return EvalName(name)
+
     async def ast_name(self, arg):
         """Look up value of identifier on load, or returns name on set."""
         if isinstance(arg.ctx, ast.Load):
-            #
-            # check other scopes if required by global declarations
-            #
-            if self.curr_func and arg.id in self.curr_func.global_names:
-                if arg.id in self.global_sym_table:
-                    return self.global_sym_table[arg.id]
-                raise NameError(f"global name '{arg.id}' is not defined")
-            #
-            # now check in our current symbol table, and then some other places
-            #
-            if arg.id in self.sym_table:
-                if isinstance(self.sym_table[arg.id], EvalLocalVar):
-                    return self.sym_table[arg.id].get()
-                return self.sym_table[arg.id]
-            if arg.id in self.local_sym_table:
-                return self.local_sym_table[arg.id]
-            if arg.id in self.global_sym_table:
-                return self.global_sym_table[arg.id]
-            if arg.id in BUILTIN_AST_FUNCS_FACTORY:
-                return BUILTIN_AST_FUNCS_FACTORY[arg.id](self)
-            if hasattr(builtins, arg.id) and arg.id not in BUILTIN_EXCLUDE and arg.id[0] != "_":
-                return getattr(builtins, arg.id)
-            if Function.get(arg.id):
-                return Function.get(arg.id)
-            num_dots = arg.id.count(".")
-            #
-            # any single-dot name could be a state variable
-            # a two-dot name for state.attr needs to exist
-            #
-            if num_dots == 1 or (num_dots == 2 and State.exist(arg.id)):
-                return await State.get(arg.id)
-            #
-            # Couldn't find it, so return just the name wrapped in EvalName to
-            # distinguish from a string variable value.  This is to support
-            # names with ".", which are joined by ast_attribute
-            #
-            return EvalName(arg.id)
+            return await self.load_name(arg.id)
         return arg.id
 
+    async def load_name(self, name):
+        """Look up value of identifier, which might be a state variable if it has dots."""
+        val = self.lookup_name(name)
+        if not isinstance(val, EvalName):
+            return val
+        num_dots = name.count(".")
+        #
+        # any single-dot name could be a state variable
+        # a two-dot name for state.attr needs to exist
+        #
+        if num_dots == 1 or (num_dots == 2 and State.exist(name)):
+            return await State.get(name)
+        #
+        # Couldn't find it, so return just the name wrapped in EvalName to
+        # distinguish from a string variable value.  This is to support
+        # names with ".", which are joined by ast_attribute
+        #
+        return val
+
     async def ast_binop(self, arg):
         """Evaluate binary operators by calling function based on class."""
         name = "ast_binop_" + arg.op.__class__.__name__.lower()
@@ -1441,11 +1890,17 @@ class AstEval:
 
     async def ast_cmpop_in(self, arg0, arg1):
         """Evaluate comparison operator: in."""
-        return (await self.aeval(arg0)) in (await self.aeval(arg1))
+        val0, val1 = await self.aeval(arg0), await self.aeval(arg1)
+        if isinstance(val1, EvalGenerator):
+            return await generator_contains(val1, val0)
+        return val0 in val1
 
     async def ast_cmpop_notin(self, arg0, arg1):
         """Evaluate comparison operator: not in."""
-        return (await self.aeval(arg0)) not in (await self.aeval(arg1))
+        val0, val1 = await self.aeval(arg0), await self.aeval(arg1)
+        if isinstance(val1, EvalGenerator):
+            return not await generator_contains(val1, val0)
+        return val0 not in val1
 
     async def ast_boolop(self, arg):
         """Evaluate boolean operators and and or."""
@@ -1468,7 +1923,8 @@ class AstEval:
         val = []
         for arg in elts:
             if isinstance(arg, ast.Starred):
-                val += await self.aeval(arg.value)
+                star_val = await self.aeval(arg.value)
+                val += await star_val.values() if isinstance(star_val, EvalGenerator) else star_val
             else:
                 val.append(await self.aeval(arg))
         return val
@@ -1497,13 +1953,18 @@ class AstEval:
             if var_name in save_vars:
                 self.sym_table[var_name] = save_vars[var_name]
             else:
-                del self.sym_table[var_name]
+                #
+                # the loop variable isn't set if there were no iterations
+                #
+                self.sym_table.pop(var_name, None)
 
     async def listcomp_loop(self, generators, elt):
         """Recursive list comprehension."""
         out = []
         gen = generators[0]
-        for loop_var in await self.aeval(gen.iter):
+        async for loop_var in eval_comp_iter(gen, await self.aeval(gen.iter)):
+            if time.monotonic() > self.slice_end:
+                await self.time_slice_yield()
             await self.recurse_assign(gen.target, loop_var)
             for cond in gen.ifs:
                 if not await self.aeval(cond):
@@ -1541,7 +2002,9 @@ class AstEval:
         """Recursive dict comprehension."""
         out = {}
         gen = generators[0]
-        for loop_var in await self.aeval(gen.iter):
+        async for loop_var in eval_comp_iter(gen, await self.aeval(gen.iter)):
+            if time.monotonic() > self.slice_end:
+                await self.time_slice_yield()
             await self.recurse_assign(gen.target, loop_var)
             for cond in gen.ifs:
                 if not await self.aeval(cond):
@@ -1575,7 +2038,9 @@ class AstEval:
         """Recursive list comprehension."""
         out = set()
         gen = generators[0]
-        for loop_var in await self.aeval(gen.iter):
+        async for loop_var in eval_comp_iter(gen, await self.aeval(gen.iter)):
+            if time.monotonic() > self.slice_end:
+                await self.time_slice_yield()
             await self.recurse_assign(gen.target, loop_var)
             for cond in gen.ifs:
                 if not await self.aeval(cond):
@@ -1660,9 +2125,29 @@ class AstEval:
                 await inst.__init__evalfunc_wrap__.call(self, *args, **kwargs)
             return inst
         if asyncio.iscoroutinefunction(func):
+            if any(isinstance(arg, EvalGenerator) for arg in args):
+                #
+                # eg, task.executor(list, gen), which iterates in another thread
+                #
+                args = [await arg.values() if isinstance(arg, EvalGenerator) else arg for arg in args]
             return await func(*args, **kwargs)
         if callable(func):
-            return func(*args, **kwargs)
+            if any(isinstance(arg, EvalGenerator) for arg in args):
+                #
+                # a generator body can await, which regular functions can't do while
+                # iterating, so either use a version of the builtin that stops as soon
+                # as it can, pass the generator to builtins that iterate lazily (where
+                # the body is stepped synchronously), or pass a list of the values
+                #
+                is_builtin = isinstance(func, (types.BuiltinFunctionType, type))
+                if is_builtin and func in GENERATOR_BUILTIN_FUNCS and isinstance(args[0], EvalGenerator):
+                    return await GENERATOR_BUILTIN_FUNCS[func](*args, **kwargs)
+                if not is_builtin or func not in GENERATOR_LAZY_BUILTIN_FUNCS:
+                    args = [await arg.values() if isinstance(arg, EvalGenerator) else arg for arg in args]
+            try:
+                return func(*args, **kwargs)
+            except StopIteration as stop:
+                raise EvalStopIteration(stop) from None
         raise TypeError(f"'{func_name}' is not callable (got {func})")
 
     async def ast_ifexp(self, arg):
@@ -1701,6 +2186,59 @@ class AstEval:
             return f"{val:{fmt}}"
         return f"{val}"
 
+    async def ast_yield(self, arg):
+        """Execute yield expression, suspending the generator's body until its next value is needed."""
+        if not self.curr_func or not self.curr_func.is_generator:
+            raise SyntaxError("'yield' outside function")
+        return await EvalYield(await self.aeval(arg.value) if arg.value else None)
+
+    async def ast_yieldfrom(self, arg):
+        """Execute yield from expression."""
+        if not self.curr_func or not self.curr_func.is_generator:
+            raise SyntaxError("'yield from' outside function")
+        iterable = await self.aeval(arg.value)
+        async for value in eval_aiter(iterable):
+            await EvalYield(value)
+        return iterable.return_value if isinstance(iterable, EvalGenerator) else None
+
+    async def ast_generatorexp(self, arg):
+        """Evaluate generator expression, which returns a generator that computes values on demand."""
+        #
+        # as in Python, the first iterable is evaluated now, and the rest lazily in the
+        # generator's own scope, so its loop variables don't change ours
+        #
+        loop_iter = await self.aeval(arg.generators[0].iter)
+        gen_ctx = self.generator_ctx(ChainMap({}, self.sym_table))
+        return EvalGenerator(
+            self, gen_ctx, functools.partial(gen_ctx.genexp_loop, arg.generators, arg.elt, loop_iter)
+        )
+
+    async def genexp_loop(self, generators, elt, loop_iter):
+        """Recursive generator expression, which yields each value."""
+        gen = generators[0]
+        async for loop_var in eval_comp_iter(gen, loop_iter):
+            await self.recurse_assign(gen.target, loop_var)
+            for cond in gen.ifs:
+                if not await self.aeval(cond):
+                    break
+            else:
+                if len(generators) == 1:
+                    await EvalYield(await self.aeval(elt))
+                else:
+                    await self.genexp_loop(generators[1:], elt, await self.aeval(generators[1].iter))
+
+    def generator_ctx(self, sym_table):
+        """Return a new context for running a generator, which uses sym_table for its local variables."""
+        gen_ctx = AstEval(self.name, self.global_ctx, logger_name=self.logger_name)
+        gen_ctx.filename = self.filename
+        gen_ctx.code_str, gen_ctx.code_list = self.code_str, self.code_list
+        gen_ctx.local_sym_table = self.local_sym_table
+        gen_ctx.global_sym_table = self.global_sym_table
+        gen_ctx.sym_table_stack = self.sym_table_stack.copy()
+        gen_ctx.sym_table = sym_table
+        gen_ctx.curr_func = self.curr_func
+        return gen_ctx
+
     async def ast_await(self, arg):
         """Evaluate await expr."""
         return await self.aeval(arg.value)
@@ -1821,8 +2359,12 @@ class AstEval:
             )
         return names
 
-    def parse(self, code_str, filename=None):
-        """Parse the code_str source code into an AST tree."""
+    def parse(self, code_str, filename=None, compile_ast=True, ast_tree=None):
+        """Parse the code_str source code into an AST tree, and optionally compile it.
+
+        If ast_tree is given it's used as the already parsed (and possibly compiled)
+        tree for code_str, eg, from a previous parse of an unchanged file.
+        """
         self.exception = None
         self.exception_obj = None
         self.exception_long = None
@@ -1839,7 +2381,12 @@ class AstEval:
             else:
                 self.code_str = code_str
                 self.code_list = []
+            if ast_tree is not None:
+                self.ast = ast_tree
+                return True
             self.ast = ast.parse(self.code_str, filename=self.filename)
+            if compile_ast:
+                AstCompile.compile(self.ast)
             return True
         except SyntaxError as err:
             self.exception_obj = err
@@ -1887,6 +2434,15 @@ class AstEval:
         """Return the last exception in a longer str form."""
         return self.exception_long
 
+    def reset(self):
+        """Clear the exception and position from the last run, so the context can run again."""
+        self.exception = None
+        self.exception_obj = None
+        self.exception_long = None
+        self.exception_curr = None
+        self.lineno = 1
+        self.col_offset = 0
+
     def set_local_sym_table(self, sym_table):
         """Set the local symbol table."""
         self.local_sym_table = sym_table
@@ -1906,6 +2462,27 @@ class AstEval:
         """Return the global context."""
         return self.global_ctx
 
+    def time_slice_reset(self):
+        """Start a new time slice, after the event loop has had a chance to run other tasks."""
+        self.slice_start = time.monotonic()
+        time_slice = self.global_ctx.get_time_slice() if self.global_ctx else None
+        self.slice_end = self.slice_start + time_slice if time_slice else math.inf
+
+    async def time_slice_yield(self):
+        """Let the event loop run other tasks, since this one has used up its time slice."""
+        #
+        # the slice also restarts on each eval(), but not when a called function like
+        # task.sleep() suspends, so this is an upper bound on how long we held the loop
+        #
+        _LOGGER.debug(
+            "%s: yielding at line %s after running for %.3f seconds",
+            self.name,
+            self.lineno,
+            time.monotonic() - self.slice_start,
+        )
+        await asyncio.sleep(0)
+        self.time_slice_reset()
+
     def get_global_ctx_name(self):
         """Return the global context name."""
         return self.global_ctx.get_name()
@@ -1975,18 +2552,1327 @@ class AstEval:
         if new_state_vars:
             self.local_sym_table.update(new_state_vars)
         if self.ast:
+            self.time_slice_reset()
             try:
-                val = await self.aeval(self.ast)
+                #
+                # expressions without calls or awaits (eg, most trigger expressions) are
+                # evaluated without creating any coroutines
+                #
+                sync_code = vars(self.ast).get("eval_sync")
+                if sync_code is None:
+                    val = await self.aeval(self.ast)
+                else:
+                    try:
+                        val = sync_code(self)
+                    except EvalSyncFallback:
+                        val = await self.aeval(self.ast)
                 if isinstance(val, EvalStopFlow):
                     return None
                 return val
             except asyncio.CancelledError:
                 raise
             except Exception as err:
-                if self.exception_long is None:
-                    self.exception_long = self.format_exc(err, self.lineno, self.col_offset)
+                self.record_exception(err)
         return None
 
     def dump(self, this_ast=None):
         """Dump the AST tree for debugging."""
         return ast.dump(this_ast if this_ast else self.ast)
+
+
+#
+# Operator functions used by compiled binary, unary and comparison nodes
+#
+BINOP_FUNCS = {
+    "add": operator.add,
+    "sub": operator.sub,
+    "mult": operator.mul,
+    "div": operator.truediv,
+    "mod": operator.mod,
+    "pow": operator.pow,
+    "lshift": operator.lshift,
+    "rshift": operator.rshift,
+    "bitor": operator.or_,
+    "bitxor": operator.xor,
+    "bitand": operator.and_,
+    "floordiv": operator.floordiv,
+}
+
+UNARYOP_FUNCS = {
+    "not": operator.not_,
+    "invert": operator.invert,
+    "uadd": lambda val: val,
+    "usub": operator.neg,
+}
+
+
+def cmpop_in(val0, val1):
+    """Return val0 in val1, for compiled code, which searches generators asynchronously."""
+    if isinstance(val1, EvalGenerator):
+        raise EvalSyncFallback
+    return val0 in val1
+
+
+def cmpop_notin(val0, val1):
+    """Return val0 not in val1, for compiled code, which searches generators asynchronously."""
+    if isinstance(val1, EvalGenerator):
+        raise EvalSyncFallback
+    return val0 not in val1
+
+
+CMPOP_FUNCS = {
+    "eq": operator.eq,
+    "noteq": operator.ne,
+    "lt": operator.lt,
+    "lte": operator.le,
+    "gt": operator.gt,
+    "gte": operator.ge,
+    "is": operator.is_,
+    "isnot": operator.is_not,
+    "in": cmpop_in,
+    "notin": cmpop_notin,
+}
+
+#
+# whether in/not in negate the test of whether a generator contains a value
+#
+CMPOP_CONTAINS_NEGATE = {ast.In: False, ast.NotIn: True}
+
+
+#
+# Builtin functions that compiled synchronous code can call directly, since they
+# don't block and don't call back into pyscript functions
+#
+SYNC_BUILTIN_FUNCS = {
+    name: getattr(builtins, name)
+    for name in [
+        "abs",
+        "all",
+        "any",
+        "bool",
+        "chr",
+        "dict",
+        "divmod",
+        "float",
+        "format",
+        "frozenset",
+        "hex",
+        "int",
+        "isinstance",
+        "len",
+        "list",
+        "max",
+        "min",
+        "oct",
+        "ord",
+        "pow",
+        "repr",
+        "round",
+        "set",
+        "sorted",
+        "str",
+        "sum",
+        "tuple",
+    ]
+}
+
+
+class AstCompile:
+    """Compile AST trees into trees of closures, one per node.
+
+    Each node gets an eval_code attribute, which is a callable that takes the
+    AstEval context and returns an awaitable that evaluates the node.  The
+    callable for each node is resolved once, and the common expression and
+    statement types bind their children's callables directly, so they don't
+    go through AstEval.aeval() dispatching on every evaluation.  Everything
+    else calls the regular AstEval.ast_* handler for the node.
+
+    Expressions that can't reach a call (other than a few builtins), an await
+    or an asynchronous state variable lookup are also compiled into plain
+    functions, stored in eval_sync, which evaluate the whole subtree without
+    creating any coroutines.  Their eval_code runs the eval_sync function.
+    If a synchronous function finds at run time that it can't complete (eg,
+    a builtin name has been redefined) it raises EvalSyncFallback, and the
+    node is evaluated again using its asynchronous code.  This is only safe
+    because synchronous code just loads values and applies operators to
+    them, so it has no side effects to repeat.
+
+    Like AstEval.aeval(), every callable updates the context's lineno and
+    col_offset before evaluating its node, so error reporting is unchanged.
+    Exceptions are recorded by the nearest enclosing AstEval.aeval() call,
+    which happens at least once per statement in a function or module body.
+    """
+
+    def __init__(self):
+        """Warn on AstCompile instantiation."""
+        _LOGGER.error("AstCompile class is not meant to be instantiated")
+
+    @classmethod
+    def compile(cls, node):
+        """Compile node and its children, returning the node's callable."""
+        code = getattr(node, "eval_code", None)
+        if code is None:
+            #
+            # nodes we create ourselves don't have a lineno, so they just call their handler
+            #
+            if hasattr(node, "lineno"):
+                name = "compile_" + node.__class__.__name__.lower()
+                code = getattr(cls, name, cls.compile_generic)(node)
+            else:
+                code = cls.compile_generic(node)
+            sync_code = cls.compile_sync(node)
+            if sync_code is not None:
+                code = cls.compile_sync_adapter(sync_code, code)
+            node.eval_code = code
+        return code
+
+    @classmethod
+    def compile_nodes(cls, nodes):
+        """Compile a list of nodes, returning a list of callables."""
+        return [cls.compile(node) for node in nodes]
+
+    @classmethod
+    def compile_generic(cls, node, children=None):
+        """Compile node, or just the given children, into a call of its AstEval handler."""
+        for child in ast.iter_child_nodes(node) if children is None else children:
+            cls.compile(child)
+        handler = getattr(AstEval, "ast_" + node.__class__.__name__.lower(), AstEval.ast_not_implemented)
+        if not hasattr(node, "lineno"):
+            return lambda ctx: handler(ctx, node)
+        lineno, col_offset = node.lineno, node.col_offset
+
+        def code(ctx):
+            ctx.lineno, ctx.col_offset = lineno, col_offset
+            return handler(ctx, node)
+
+        return code
+
+    @classmethod
+    def compile_functiondef(cls, node):
+        """Compile function definition; the body is compiled by compile_body() on the first call."""
+        children = node.decorator_list + [node.args]
+        if node.returns:
+            children.append(node.returns)
+        return cls.compile_generic(node, children=children)
+
+    @classmethod
+    def compile_asyncfunctiondef(cls, node):
+        """Compile async function definition; the body is compiled by compile_body() on the first call."""
+        return cls.compile_functiondef(node)
+
+    @classmethod
+    def compile_body(cls, func_def):
+        """Compile the body of a compiled function definition, if that hasn't been done yet.
+
+        Compiling takes several times longer than parsing, so function bodies are
+        only compiled when they are first called, which avoids that cost at startup
+        for the functions that are rarely or never called.
+        """
+        if getattr(func_def, "eval_code", None) is None or getattr(func_def, "eval_body", False):
+            return
+        cls.resolve_scope(func_def)
+        cls.compile_nodes(func_def.body)
+        func_def.eval_body = True
+
+    @classmethod
+    def resolve_scope(cls, func_def):
+        """Set eval_global on each name in the function body to whether it's declared global.
+
+        The bodies of nested functions, lambdas and classes are a different scope, so
+        their names aren't set, although their decorators and default arguments are
+        evaluated in this scope.  Names without eval_global check the current function's
+        global declarations at run time.
+        """
+        global_names = set()
+        name_nodes = []
+        todo = list(func_def.body)
+        while todo:
+            node = todo.pop()
+            if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.Lambda)):
+                if not isinstance(node, ast.Lambda):
+                    todo += node.decorator_list
+                todo += node.args.defaults + [val for val in node.args.kw_defaults if val]
+                continue
+            if isinstance(node, ast.ClassDef):
+                todo += node.decorator_list + node.bases + [keyw.value for keyw in node.keywords]
+                continue
+            if isinstance(node, ast.Global):
+                global_names.update(node.names)
+            elif isinstance(node, ast.Name):
+                name_nodes.append(node)
+            todo += ast.iter_child_nodes(node)
+        for node in name_nodes:
+            node.eval_global = node.id in global_names
+
+    @classmethod
+    def compile_name_lookup(cls, name, is_global=None, undefined=None):
+        """Return a function that looks up name like AstEval.lookup_name().
+
+        The steps that don't depend on run-time state (whether name is a builtin or an
+        ast function) are done now.  is_global says whether name is declared global in
+        its function, or is None if the current function's declarations should be checked.
+        If name isn't found, undefined is returned, or a new EvalName if it's None.
+        """
+        factory = BUILTIN_AST_FUNCS_FACTORY.get(name)
+        is_builtin = hasattr(builtins, name) and name not in BUILTIN_EXCLUDE and name[0] != "_"
+        builtin_val = getattr(builtins, name) if is_builtin else None
+
+        def lookup(ctx):
+            if is_global or (is_global is None and ctx.curr_func and name in ctx.curr_func.global_names):
+                if name in ctx.global_sym_table:
+                    return ctx.global_sym_table[name]
+                raise NameError(f"global name '{name}' is not defined")
+            sym_table = ctx.sym_table
+            if name in sym_table:
+                val = sym_table[name]
+                if isinstance(val, EvalLocalVar):
+                    return val.get()
+                return val
+            if name in ctx.local_sym_table:
+                return ctx.local_sym_table[name]
+            if name in ctx.global_sym_table:
+                return ctx.global_sym_table[name]
+            if factory:
+                return factory(ctx)
+            if is_builtin:
+                return builtin_val
+            func = Function.get(name)
+            if func:
+                return func
+            return EvalName(name) if undefined is None else undefined
+
+        return lookup
+
+    @classmethod
+    def compile_name(cls, node):
+        """Compile name store, which returns the name; loads are always synchronous."""
+        if isinstance(node.ctx, ast.Load):
+            return cls.compile_generic(node)
+        name = node.id
+        lineno, col_offset = node.lineno, node.col_offset
+
+        async def code_store(ctx):
+            ctx.lineno, ctx.col_offset = lineno, col_offset
+            return name
+
+        return code_store
+
+    @classmethod
+    def compile_binop(cls, node):
+        """Compile binary operator."""
+        func = BINOP_FUNCS.get(node.op.__class__.__name__.lower())
+        if func is None:
+            return cls.compile_generic(node)
+        left, right = cls.compile(node.left), cls.compile(node.right)
+        lineno, col_offset = node.lineno, node.col_offset
+
+        async def code(ctx):
+            ctx.lineno, ctx.col_offset = lineno, col_offset
+            return func(await left(ctx), await right(ctx))
+
+        return code
+
+    @classmethod
+    def compile_unaryop(cls, node):
+        """Compile unary operator."""
+        func = UNARYOP_FUNCS.get(node.op.__class__.__name__.lower())
+        if func is None:
+            return cls.compile_generic(node)
+        operand = cls.compile(node.operand)
+        lineno, col_offset = node.lineno, node.col_offset
+
+        async def code(ctx):
+            ctx.lineno, ctx.col_offset = lineno, col_offset
+            return func(await operand(ctx))
+
+        return code
+
+    @classmethod
+    def compile_compare(cls, node):
+        """Compile comparison operators."""
+        funcs = [CMPOP_FUNCS.get(cmp_op.__class__.__name__.lower()) for cmp_op in node.ops]
+        if None in funcs:
+            return cls.compile_generic(node)
+        left = cls.compile(node.left)
+        comparators = cls.compile_nodes(node.comparators)
+        lineno, col_offset = node.lineno, node.col_offset
+
+        negates = [CMPOP_CONTAINS_NEGATE.get(type(cmp_op)) for cmp_op in node.ops]
+        if any(negate is not None for negate in negates):
+            #
+            # generators can only be searched asynchronously
+            #
+            contains_ops = list(zip(funcs, comparators, negates))
+
+            async def code_contains(ctx):
+                ctx.lineno, ctx.col_offset = lineno, col_offset
+                val0 = await left(ctx)
+                for func, right, negate in contains_ops:
+                    val1 = await right(ctx)
+                    if negate is not None and isinstance(val1, EvalGenerator):
+                        if await generator_contains(val1, val0) == negate:
+                            return False
+                    elif not func(val0, val1):
+                        return False
+                    val0 = val1
+                return True
+
+            return code_contains
+
+        if len(funcs) == 1:
+            func, right = funcs[0], comparators[0]
+
+            async def code_single(ctx):
+                ctx.lineno, ctx.col_offset = lineno, col_offset
+                return bool(func(await left(ctx), await right(ctx)))
+
+            return code_single
+
+        ops = list(zip(funcs, comparators))
+
+        async def code(ctx):
+            ctx.lineno, ctx.col_offset = lineno, col_offset
+            val0 = await left(ctx)
+            for func, right in ops:
+                val1 = await right(ctx)
+                if not func(val0, val1):
+                    return False
+                val0 = val1
+            return True
+
+        return code
+
+    @classmethod
+    def compile_boolop(cls, node):
+        """Compile boolean operators and and or."""
+        values = cls.compile_nodes(node.values)
+        lineno, col_offset = node.lineno, node.col_offset
+        if isinstance(node.op, ast.And):
+
+            async def code_and(ctx):
+                ctx.lineno, ctx.col_offset = lineno, col_offset
+                val = 1
+                for value in values:
+                    this_val = await value(ctx)
+                    if this_val == 0:
+                        return 0
+                    val = this_val
+                return val
+
+            return code_and
+
+        async def code_or(ctx):
+            ctx.lineno, ctx.col_offset = lineno, col_offset
+            for value in values:
+                val = await value(ctx)
+                if val != 0:
+                    return val
+            return 0
+
+        return code_or
+
+    @classmethod
+    def compile_ifexp(cls, node):
+        """Compile if expression."""
+        test, body, orelse = cls.compile(node.test), cls.compile(node.body), cls.compile(node.orelse)
+        lineno, col_offset = node.lineno, node.col_offset
+
+        async def code(ctx):
+            ctx.lineno, ctx.col_offset = lineno, col_offset
+            return await body(ctx) if (await test(ctx)) else await orelse(ctx)
+
+        return code
+
+    @classmethod
+    def compile_subscript(cls, node):
+        """Compile subscript load."""
+        if not isinstance(node.ctx, ast.Load) or not isinstance(node.slice, (ast.Index, ast.Slice)):
+            return cls.compile_generic(node)
+        value = cls.compile(node.value)
+        lineno, col_offset = node.lineno, node.col_offset
+        if isinstance(node.slice, ast.Index):
+            index = cls.compile(node.slice.value)
+
+            async def code_index(ctx):
+                ctx.lineno, ctx.col_offset = lineno, col_offset
+                var = await value(ctx)
+                return var[await index(ctx)]
+
+            return code_index
+
+        lower, upper, step = [
+            cls.compile(part) if part else None
+            for part in [node.slice.lower, node.slice.upper, node.slice.step]
+        ]
+
+        async def code_slice(ctx):
+            ctx.lineno, ctx.col_offset = lineno, col_offset
+            var = await value(ctx)
+            return var[
+                slice(
+                    (await lower(ctx)) if lower else None,
+                    (await upper(ctx)) if upper else None,
+                    (await step(ctx)) if step else None,
+                )
+            ]
+
+        return code_slice
+
+    @classmethod
+    def compile_list(cls, node):
+        """Compile list."""
+        if not isinstance(node.ctx, ast.Load) or any(isinstance(elt, ast.Starred) for elt in node.elts):
+            return cls.compile_generic(node)
+        elts = cls.compile_nodes(node.elts)
+        lineno, col_offset = node.lineno, node.col_offset
+
+        async def code(ctx):
+            ctx.lineno, ctx.col_offset = lineno, col_offset
+            return [await elt(ctx) for elt in elts]
+
+        return code
+
+    @classmethod
+    def compile_tuple(cls, node):
+        """Compile tuple."""
+        if not isinstance(node.ctx, ast.Load) or any(isinstance(elt, ast.Starred) for elt in node.elts):
+            return cls.compile_generic(node)
+        elts = cls.compile_nodes(node.elts)
+        lineno, col_offset = node.lineno, node.col_offset
+
+        async def code(ctx):
+            ctx.lineno, ctx.col_offset = lineno, col_offset
+            return tuple([await elt(ctx) for elt in elts])
+
+        return code
+
+    @classmethod
+    def compile_call(cls, node):
+        """Compile function call."""
+        func = cls.compile(node.func)
+        keywords = [(kw_arg.arg, cls.compile(kw_arg.value)) for kw_arg in node.keywords]
+        args = [
+            (True, cls.compile(arg.value)) if isinstance(arg, ast.Starred) else (False, cls.compile(arg))
+            for arg in node.args
+        ]
+        #
+        # try to deduce function name, although this only works in simple cases
+        #
+        if isinstance(node.func, ast.Name):
+            func_name = node.func.id
+        elif isinstance(node.func, ast.Attribute):
+            func_name = node.func.attr
+        else:
+            func_name = "<function>"
+        lineno, col_offset = node.lineno, node.col_offset
+
+        async def code(ctx):
+            ctx.lineno, ctx.col_offset = lineno, col_offset
+            func_val = await func(ctx)
+            kwargs = {}
+            for kw_name, kw_value in keywords:
+                if kw_name is None:
+                    kwargs.update(await kw_value(ctx))
+                else:
+                    kwargs[kw_name] = await kw_value(ctx)
+            arg_vals = []
+            for starred, arg in args:
+                if starred:
+                    star_val = await arg(ctx)
+                    arg_vals += await star_val.values() if isinstance(star_val, EvalGenerator) else star_val
+                else:
+                    arg_vals.append(await arg(ctx))
+            this_name = func_name
+            if isinstance(func_val, EvalLocalVar):
+                this_name = func_val.get_name()
+                func_val = func_val.get()
+            if _LOGGER.isEnabledFor(logging.DEBUG):
+                arg_str = ", ".join(
+                    ['"' + elt + '"' if isinstance(elt, str) else str(elt) for elt in arg_vals]
+                )
+                _LOGGER.debug("%s: calling %s(%s, %s)", ctx.name, this_name, arg_str, kwargs)
+            return await ctx.call_func(func_val, this_name, *arg_vals, **kwargs)
+
+        return code
+
+    @classmethod
+    def compile_store(cls, target):
+        """Return a function that assigns to target if it's a plain name, otherwise None."""
+        cls.compile(target)
+        if not isinstance(target, ast.Name) or not hasattr(target, "lineno"):
+            return None
+        name = target.id
+        is_global = getattr(target, "eval_global", None)
+        lineno, col_offset = target.lineno, target.col_offset
+
+        if is_global is None:
+
+            def store(ctx, val):
+                ctx.lineno, ctx.col_offset = lineno, col_offset
+                ctx.assign_name(name, val)
+
+            return store
+
+        if is_global:
+
+            def store_global(ctx, val):
+                ctx.lineno, ctx.col_offset = lineno, col_offset
+                ctx.global_sym_table[name] = val
+
+            return store_global
+
+        def store_local(ctx, val):
+            ctx.lineno, ctx.col_offset = lineno, col_offset
+            sym_table = ctx.sym_table
+            if name in sym_table and isinstance(sym_table[name], EvalLocalVar):
+                sym_table[name].set(val)
+            else:
+                sym_table[name] = val
+
+        return store_local
+
+    @classmethod
+    def compile_expr(cls, node):
+        """Compile expression statement."""
+        value = cls.compile(node.value)
+        lineno, col_offset = node.lineno, node.col_offset
+
+        async def code(ctx):
+            ctx.lineno, ctx.col_offset = lineno, col_offset
+            return await value(ctx)
+
+        return code
+
+    @classmethod
+    def compile_assign(cls, node):
+        """Compile assignment statement."""
+        value = cls.compile(node.value)
+        targets = [(cls.compile_store(target), target) for target in node.targets]
+        lineno, col_offset = node.lineno, node.col_offset
+
+        async def code(ctx):
+            ctx.lineno, ctx.col_offset = lineno, col_offset
+            rhs = await value(ctx)
+            for store, target in targets:
+                if store:
+                    store(ctx, rhs)
+                else:
+                    await ctx.recurse_assign(target, rhs)
+
+        return code
+
+    @classmethod
+    def compile_augassign(cls, node):
+        """Compile augmented assignment statement (lhs <BinOp>= value)."""
+        #
+        # evaluate a load copy of the target, rather than changing the target's ctx
+        # at run time
+        #
+        target = node.target
+        fields = {field: getattr(target, field) for field in target._fields}
+        fields["ctx"] = ast.Load()
+        load_target = ast.copy_location(type(target)(**fields), target)
+        bin_op = ast.copy_location(ast.BinOp(left=load_target, op=node.op, right=node.value), target)
+        new_val = cls.compile(bin_op)
+        store = cls.compile_store(target)
+        lineno, col_offset = node.lineno, node.col_offset
+
+        async def code(ctx):
+            ctx.lineno, ctx.col_offset = lineno, col_offset
+            val = await new_val(ctx)
+            if store:
+                store(ctx, val)
+            else:
+                await ctx.recurse_assign(target, val)
+
+        return code
+
+    @classmethod
+    def compile_if(cls, node):
+        """Compile if statement."""
+        test = cls.compile(node.test)
+        body, orelse = cls.compile_nodes(node.body), cls.compile_nodes(node.orelse)
+        lineno, col_offset = node.lineno, node.col_offset
+
+        async def code(ctx):
+            ctx.lineno, ctx.col_offset = lineno, col_offset
+            val = None
+            for stmt in body if await test(ctx) else orelse:
+                val = await stmt(ctx)
+                if isinstance(val, EvalStopFlow):
+                    return val
+            return val
+
+        return code
+
+    @classmethod
+    def compile_while(cls, node):
+        """Compile while statement."""
+        test = cls.compile(node.test)
+        body, orelse = cls.compile_nodes(node.body), cls.compile_nodes(node.orelse)
+        lineno, col_offset = node.lineno, node.col_offset
+
+        async def code(ctx):
+            ctx.lineno, ctx.col_offset = lineno, col_offset
+            while await test(ctx):
+                if time.monotonic() > ctx.slice_end:
+                    await ctx.time_slice_yield()
+                for stmt in body:
+                    val = await stmt(ctx)
+                    if isinstance(val, EvalStopFlow):
+                        break
+                if isinstance(val, EvalBreak):
+                    break
+                if isinstance(val, EvalReturn):
+                    return val
+            else:
+                for stmt in orelse:
+                    val = await stmt(ctx)
+                    if isinstance(val, EvalReturn):
+                        return val
+            return None
+
+        return code
+
+    @classmethod
+    def compile_for(cls, node):
+        """Compile for statement."""
+        iter_code = cls.compile(node.iter)
+        body, orelse = cls.compile_nodes(node.body), cls.compile_nodes(node.orelse)
+        target = node.target
+        store = cls.compile_store(target)
+        lineno, col_offset = node.lineno, node.col_offset
+
+        async def generator_loop(ctx, loop_iter):
+            async for loop_var in loop_iter:
+                if time.monotonic() > ctx.slice_end:
+                    await ctx.time_slice_yield()
+                if store:
+                    store(ctx, loop_var)
+                else:
+                    await ctx.recurse_assign(target, loop_var)
+                for stmt in body:
+                    val = await stmt(ctx)
+                    if isinstance(val, EvalStopFlow):
+                        break
+                if isinstance(val, EvalBreak):
+                    break
+                if isinstance(val, EvalReturn):
+                    return val
+            else:
+                for stmt in orelse:
+                    val = await stmt(ctx)
+                    if isinstance(val, EvalReturn):
+                        return val
+            return None
+
+        async def code(ctx):
+            ctx.lineno, ctx.col_offset = lineno, col_offset
+            loop_iter = await iter_code(ctx)
+            if isinstance(loop_iter, EvalGenerator):
+                return await generator_loop(ctx, loop_iter)
+            for loop_var in loop_iter:
+                if time.monotonic() > ctx.slice_end:
+                    await ctx.time_slice_yield()
+                if store:
+                    store(ctx, loop_var)
+                else:
+                    await ctx.recurse_assign(target, loop_var)
+                for stmt in body:
+                    val = await stmt(ctx)
+                    if isinstance(val, EvalStopFlow):
+                        break
+                if isinstance(val, EvalBreak):
+                    break
+                if isinstance(val, EvalReturn):
+                    return val
+            else:
+                for stmt in orelse:
+                    val = await stmt(ctx)
+                    if isinstance(val, EvalReturn):
+                        return val
+            return None
+
+        return code
+
+    @classmethod
+    def compile_return(cls, node):
+        """Compile return statement."""
+        value = cls.compile(node.value) if node.value else None
+        lineno, col_offset = node.lineno, node.col_offset
+
+        async def code(ctx):
+            ctx.lineno, ctx.col_offset = lineno, col_offset
+            return EvalReturn(await value(ctx) if value else None)
+
+        return code
+
+    @classmethod
+    def compile_pass(cls, node):
+        """Compile pass statement."""
+        lineno, col_offset = node.lineno, node.col_offset
+
+        async def code(ctx):
+            ctx.lineno, ctx.col_offset = lineno, col_offset
+
+        return code
+
+    @classmethod
+    def compile_break(cls, node):
+        """Compile break statement."""
+        lineno, col_offset = node.lineno, node.col_offset
+
+        async def code(ctx):
+            ctx.lineno, ctx.col_offset = lineno, col_offset
+            return EvalBreak()
+
+        return code
+
+    @classmethod
+    def compile_continue(cls, node):
+        """Compile continue statement."""
+        lineno, col_offset = node.lineno, node.col_offset
+
+        async def code(ctx):
+            ctx.lineno, ctx.col_offset = lineno, col_offset
+            return EvalContinue()
+
+        return code
+
+    @classmethod
+    def compile_comprehension(cls, node, add_elt):
+        """Compile a comprehension, where add_elt(ctx, out) adds the next element to out."""
+        generators = [
+            (
+                cls.compile_store(gen.target),
+                gen.target,
+                cls.compile(gen.iter),
+                cls.compile_nodes(gen.ifs),
+                gen.is_async,
+            )
+            for gen in node.generators
+        ]
+        num_gen = len(generators)
+        lineno, col_offset = node.lineno, node.col_offset
+        target_vars = set()
+        target_vars_found = False
+
+        async def loop(ctx, gen_idx, out):
+            store, target, iter_code, ifs, is_async = generators[gen_idx]
+            loop_iter = await iter_code(ctx)
+            if is_async or isinstance(loop_iter, EvalGenerator):
+                #
+                # rare enough that the values are just collected first
+                #
+                loop_iter = [value async for value in eval_async_iter(loop_iter)]
+            for loop_var in loop_iter:
+                if time.monotonic() > ctx.slice_end:
+                    await ctx.time_slice_yield()
+                if store:
+                    store(ctx, loop_var)
+                else:
+                    await ctx.recurse_assign(target, loop_var)
+                for cond in ifs:
+                    if not await cond(ctx):
+                        break
+                else:
+                    if gen_idx == num_gen - 1:
+                        await add_elt(ctx, out)
+                    else:
+                        await loop(ctx, gen_idx + 1, out)
+
+        async def code(ctx, out):
+            nonlocal target_vars_found
+            ctx.lineno, ctx.col_offset = lineno, col_offset
+            #
+            # the loop target names only depend on the ast, so only find them once
+            #
+            if not target_vars_found:
+                found_vars, save_values = await ctx.loopvar_scope_save(node.generators)
+                target_vars.update(found_vars)
+                target_vars_found = True
+            else:
+                save_values = {var: ctx.sym_table[var] for var in target_vars if var in ctx.sym_table}
+            await loop(ctx, 0, out)
+            await ctx.loopvar_scope_restore(target_vars, save_values)
+            return out
+
+        return code
+
+    @classmethod
+    def compile_listcomp(cls, node):
+        """Compile list comprehension."""
+        elt = cls.compile(node.elt)
+
+        async def add_elt(ctx, out):
+            out.append(await elt(ctx))
+
+        comp = cls.compile_comprehension(node, add_elt)
+        return lambda ctx: comp(ctx, [])
+
+    @classmethod
+    def compile_setcomp(cls, node):
+        """Compile set comprehension."""
+        elt = cls.compile(node.elt)
+
+        async def add_elt(ctx, out):
+            out.add(await elt(ctx))
+
+        comp = cls.compile_comprehension(node, add_elt)
+        return lambda ctx: comp(ctx, set())
+
+    @classmethod
+    def compile_dictcomp(cls, node):
+        """Compile dict comprehension."""
+        key, value = cls.compile(node.key), cls.compile(node.value)
+
+        async def add_elt(ctx, out):
+            #
+            # key is evaluated before value starting in 3.8
+            #
+            key_val = await key(ctx)
+            out[key_val] = await value(ctx)
+
+        comp = cls.compile_comprehension(node, add_elt)
+        return lambda ctx: comp(ctx, {})
+
+    @classmethod
+    def compile_sync(cls, node):
+        """Compile node into a synchronous function if possible, otherwise return None."""
+        if not hasattr(node, "eval_sync"):
+            sync_code = None
+            if hasattr(node, "lineno") or isinstance(node, ast.Module):
+                handler = getattr(cls, "sync_" + node.__class__.__name__.lower(), None)
+                if handler is not None:
+                    sync_code = handler(node)
+            node.eval_sync = sync_code
+        return node.eval_sync
+
+    @classmethod
+    def compile_sync_nodes(cls, nodes):
+        """Compile a list of nodes into synchronous functions, returning None if any can't be."""
+        sync_codes = [cls.compile_sync(node) for node in nodes]
+        return None if None in sync_codes else sync_codes
+
+    @classmethod
+    def compile_sync_adapter(cls, sync_code, code):
+        """Return an async callable that runs sync_code, falling back to code."""
+
+        async def code_adapter(ctx):
+            try:
+                return sync_code(ctx)
+            except EvalSyncFallback:
+                return await code(ctx)
+
+        return code_adapter
+
+    @classmethod
+    def sync_module(cls, node):
+        """Compile a module that consists of a single expression, eg, a trigger expression."""
+        if len(node.body) != 1:
+            return None
+        return cls.compile_sync(node.body[0])
+
+    @classmethod
+    def sync_expr(cls, node):
+        """Compile expression statement."""
+        value = cls.compile_sync(node.value)
+        if value is None:
+            return None
+        lineno, col_offset = node.lineno, node.col_offset
+
+        def code(ctx):
+            ctx.lineno, ctx.col_offset = lineno, col_offset
+            return value(ctx)
+
+        return code
+
+    @classmethod
+    def sync_constant(cls, node):
+        """Compile constant."""
+        value = node.value
+        lineno, col_offset = node.lineno, node.col_offset
+
+        def code(ctx):
+            ctx.lineno, ctx.col_offset = lineno, col_offset
+            return value
+
+        return code
+
+    @classmethod
+    def sync_num(cls, node):
+        """Compile number (python < 3.8)."""
+        return cls.sync_constant(ast.copy_location(ast.Constant(value=node.n), node))
+
+    @classmethod
+    def sync_str(cls, node):
+        """Compile string (python < 3.8)."""
+        return cls.sync_constant(ast.copy_location(ast.Constant(value=node.s), node))
+
+    @classmethod
+    def sync_nameconstant(cls, node):
+        """Compile name constant (python < 3.8)."""
+        return cls.sync_constant(ast.copy_location(ast.Constant(value=node.value), node))
+
+    @classmethod
+    def sync_name(cls, node):
+        """Compile name load; names without dots are never state variables."""
+        if not isinstance(node.ctx, ast.Load):
+            return None
+        name = node.id
+        lookup = cls.compile_name_lookup(name, getattr(node, "eval_global", None))
+        lineno, col_offset = node.lineno, node.col_offset
+
+        def code(ctx):
+            ctx.lineno, ctx.col_offset = lineno, col_offset
+            val = lookup(ctx)
+            if isinstance(val, EvalName):
+                raise NameError(f"name '{name}' is not defined")
+            return val
+
+        return code
+
+    @classmethod
+    def sync_attribute(cls, node):
+        """Compile attribute load, including dotted variable names, as in AstEval.ast_attribute()."""
+        if not isinstance(node.ctx, ast.Load):
+            return None
+        value = cls.compile_sync(node.value)
+        if value is None:
+            return None
+        attr = node.attr
+        lineno, col_offset = node.lineno, node.col_offset
+        #
+        # the dotted name doesn't depend on run-time values, so we collapse it now
+        #
+        first_name, full_name = attribute_dotted_name(node)
+        if first_name is None or (
+            first_name in BUILTIN_AST_FUNCS_FACTORY
+            or (hasattr(builtins, first_name) and first_name not in BUILTIN_EXCLUDE and first_name[0] != "_")
+        ):
+            #
+            # the first name is always defined, so this is always a regular attribute
+            #
+            def code_attr(ctx):
+                ctx.lineno, ctx.col_offset = lineno, col_offset
+                return getattr(value(ctx), attr)
+
+            return code_attr
+
+        num_dots = full_name.count(".")
+        first_global = getattr(node.value, "eval_global", None)
+        first_lookup = cls.compile_name_lookup(first_name, first_global, UNDEFINED)
+        #
+        # names with dots can't be declared global
+        #
+        full_lookup = cls.compile_name_lookup(full_name, False, UNDEFINED)
+
+        def code(ctx):
+            ctx.lineno, ctx.col_offset = lineno, col_offset
+            if first_lookup(ctx) is UNDEFINED:
+                val = full_lookup(ctx)
+                if val is UNDEFINED:
+                    if num_dots == 1 or (num_dots == 2 and State.exist(full_name)):
+                        if State.persist_pending(full_name):
+                            raise EvalSyncFallback
+                        return State.get_value(full_name)
+                else:
+                    return val
+            return getattr(value(ctx), attr)
+
+        return code
+
+    @classmethod
+    def sync_binop(cls, node):
+        """Compile binary operator."""
+        func = BINOP_FUNCS.get(node.op.__class__.__name__.lower())
+        left, right = cls.compile_sync(node.left), cls.compile_sync(node.right)
+        if func is None or left is None or right is None:
+            return None
+        lineno, col_offset = node.lineno, node.col_offset
+
+        def code(ctx):
+            ctx.lineno, ctx.col_offset = lineno, col_offset
+            return func(left(ctx), right(ctx))
+
+        return code
+
+    @classmethod
+    def sync_unaryop(cls, node):
+        """Compile unary operator."""
+        func = UNARYOP_FUNCS.get(node.op.__class__.__name__.lower())
+        operand = cls.compile_sync(node.operand)
+        if func is None or operand is None:
+            return None
+        lineno, col_offset = node.lineno, node.col_offset
+
+        def code(ctx):
+            ctx.lineno, ctx.col_offset = lineno, col_offset
+            return func(operand(ctx))
+
+        return code
+
+    @classmethod
+    def sync_compare(cls, node):
+        """Compile comparison operators."""
+        funcs = [CMPOP_FUNCS.get(cmp_op.__class__.__name__.lower()) for cmp_op in node.ops]
+        left = cls.compile_sync(node.left)
+        comparators = cls.compile_sync_nodes(node.comparators)
+        if None in funcs or left is None or comparators is None:
+            return None
+        lineno, col_offset = node.lineno, node.col_offset
+
+        if len(funcs) == 1:
+            func, right = funcs[0], comparators[0]
+
+            def code_single(ctx):
+                ctx.lineno, ctx.col_offset = lineno, col_offset
+                return bool(func(left(ctx), right(ctx)))
+
+            return code_single
+
+        ops = list(zip(funcs, comparators))
+
+        def code(ctx):
+            ctx.lineno, ctx.col_offset = lineno, col_offset
+            val0 = left(ctx)
+            for func, right in ops:
+                val1 = right(ctx)
+                if not func(val0, val1):
+                    return False
+                val0 = val1
+            return True
+
+        return code
+
+    @classmethod
+    def sync_boolop(cls, node):
+        """Compile boolean operators and and or."""
+        values = cls.compile_sync_nodes(node.values)
+        if values is None:
+            return None
+        lineno, col_offset = node.lineno, node.col_offset
+        if isinstance(node.op, ast.And):
+
+            def code_and(ctx):
+                ctx.lineno, ctx.col_offset = lineno, col_offset
+                val = 1
+                for value in values:
+                    this_val = value(ctx)
+                    if this_val == 0:
+                        return 0
+                    val = this_val
+                return val
+
+            return code_and
+
+        def code_or(ctx):
+            ctx.lineno, ctx.col_offset = lineno, col_offset
+            for value in values:
+                val = value(ctx)
+                if val != 0:
+                    return val
+            return 0
+
+        return code_or
+
+    @classmethod
+    def sync_ifexp(cls, node):
+        """Compile if expression."""
+        codes = cls.compile_sync_nodes([node.test, node.body, node.orelse])
+        if codes is None:
+            return None
+        test, body, orelse = codes
+        lineno, col_offset = node.lineno, node.col_offset
+
+        def code(ctx):
+            ctx.lineno, ctx.col_offset = lineno, col_offset
+            return body(ctx) if test(ctx) else orelse(ctx)
+
+        return code
+
+    @classmethod
+    def sync_subscript(cls, node):
+        """Compile subscript load."""
+        if not isinstance(node.ctx, ast.Load):
+            return None
+        value = cls.compile_sync(node.value)
+        lineno, col_offset = node.lineno, node.col_offset
+        if isinstance(node.slice, ast.Index):
+            index = cls.compile_sync(node.slice.value)
+            if value is None or index is None:
+                return None
+
+            def code_index(ctx):
+                ctx.lineno, ctx.col_offset = lineno, col_offset
+                var = value(ctx)
+                return var[index(ctx)]
+
+            return code_index
+
+        if not isinstance(node.slice, ast.Slice):
+            return None
+        parts = [node.slice.lower, node.slice.upper, node.slice.step]
+        if value is None or cls.compile_sync_nodes([part for part in parts if part]) is None:
+            return None
+        lower, upper, step = [cls.compile_sync(part) if part else None for part in parts]
+
+        def code_slice(ctx):
+            ctx.lineno, ctx.col_offset = lineno, col_offset
+            var = value(ctx)
+            return var[
+                slice(
+                    lower(ctx) if lower else None,
+                    upper(ctx) if upper else None,
+                    step(ctx) if step else None,
+                )
+            ]
+
+        return code_slice
+
+    @classmethod
+    def sync_list(cls, node):
+        """Compile list."""
+        elts = cls.compile_sync_nodes(node.elts) if isinstance(node.ctx, ast.Load) else None
+        if elts is None:
+            return None
+        lineno, col_offset = node.lineno, node.col_offset
+
+        def code(ctx):
+            ctx.lineno, ctx.col_offset = lineno, col_offset
+            return [elt(ctx) for elt in elts]
+
+        return code
+
+    @classmethod
+    def sync_tuple(cls, node):
+        """Compile tuple."""
+        elts = cls.compile_sync_nodes(node.elts) if isinstance(node.ctx, ast.Load) else None
+        if elts is None:
+            return None
+        lineno, col_offset = node.lineno, node.col_offset
+
+        def code(ctx):
+            ctx.lineno, ctx.col_offset = lineno, col_offset
+            return tuple([elt(ctx) for elt in elts])
+
+        return code
+
+    @classmethod
+    def sync_set(cls, node):
+        """Compile set."""
+        elts = cls.compile_sync_nodes(node.elts)
+        if elts is None:
+            return None
+        lineno, col_offset = node.lineno, node.col_offset
+
+        def code(ctx):
+            ctx.lineno, ctx.col_offset = lineno, col_offset
+            return {elt(ctx) for elt in elts}
+
+        return code
+
+    @classmethod
+    def sync_dict(cls, node):
+        """Compile dict; a key of None means the value is a dict to unpack."""
+        values = cls.compile_sync_nodes(node.values)
+        keys = cls.compile_sync_nodes([key for key in node.keys if key is not None])
+        if values is None or keys is None:
+            return None
+        items = [(cls.compile_sync(key) if key else None, value) for key, value in zip(node.keys, values)]
+        lineno, col_offset = node.lineno, node.col_offset
+
+        def code(ctx):
+            ctx.lineno, ctx.col_offset = lineno, col_offset
+            val = {}
+            for key, value in items:
+                this_val = value(ctx)
+                if key is None:
+                    val.update(this_val)
+                else:
+                    val[key(ctx)] = this_val
+            return val
+
+        return code
+
+    @classmethod
+    def sync_joinedstr(cls, node):
+        """Compile joined string."""
+        values = cls.compile_sync_nodes(node.values)
+        if values is None:
+            return None
+        lineno, col_offset = node.lineno, node.col_offset
+
+        def code(ctx):
+            ctx.lineno, ctx.col_offset = lineno, col_offset
+            return "".join([str(value(ctx)) for value in values])
+
+        return code
+
+    @classmethod
+    def sync_formattedvalue(cls, node):
+        """Compile formatted value."""
+        value = cls.compile_sync(node.value)
+        format_spec = cls.compile_sync(node.format_spec) if node.format_spec is not None else None
+        if value is None or (node.format_spec is not None and format_spec is None):
+            return None
+        lineno, col_offset = node.lineno, node.col_offset
+
+        def code(ctx):
+            ctx.lineno, ctx.col_offset = lineno, col_offset
+            val = value(ctx)
+            if format_spec is not None:
+                return f"{val:{format_spec(ctx)}}"
+            return f"{val}"
+
+        return code
+
+    @classmethod
+    def sync_call(cls, node):
+        """Compile call of one of the SYNC_BUILTIN_FUNCS, which falls back if the name is redefined."""
+        if not isinstance(node.func, ast.Name) or node.func.id not in SYNC_BUILTIN_FUNCS:
+            return None
+        func = cls.compile_sync(node.func)
+        keywords = [(kw_arg.arg, cls.compile_sync(kw_arg.value)) for kw_arg in node.keywords]
+        args = [
+            (True, cls.compile_sync(arg.value))
+            if isinstance(arg, ast.Starred)
+            else (False, cls.compile_sync(arg))
+            for arg in node.args
+        ]
+        if func is None or any(code is None for _, code in keywords + args):
+            return None
+        func_name = node.func.id
+        builtin_func = SYNC_BUILTIN_FUNCS[func_name]
+        lineno, col_offset = node.lineno, node.col_offset
+
+        def code(ctx):
+            ctx.lineno, ctx.col_offset = lineno, col_offset
+            if func(ctx) is not builtin_func:
+                raise EvalSyncFallback
+            kwargs = {}
+            for kw_name, kw_value in keywords:
+                if kw_name is None:
+                    kwargs.update(kw_value(ctx))
+                else:
+                    kwargs[kw_name] = kw_value(ctx)
+            arg_vals = []
+            for starred, arg in args:
+                val = arg(ctx)
+                if isinstance(val, EvalGenerator):
+                    #
+                    # generators can only be consumed asynchronously
+                    #
+                    raise EvalSyncFallback
+                if starred:
+                    arg_vals += val
+                else:
+                    arg_vals.append(val)
+            if _LOGGER.isEnabledFor(logging.DEBUG):
+                arg_str = ", ".join(
+                    ['"' + elt + '"' if isinstance(elt, str) else str(elt) for elt in arg_vals]
+                )
+                _LOGGER.debug("%s: calling %s(%s, %s)", ctx.name, func_name, arg_str, kwargs)
+            return builtin_func(*arg_vals, **kwargs)
+
+        return code
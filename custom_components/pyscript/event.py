@@ -3,6 +3,7 @@
 import logging
 
 from .const import LOGGER_PATH
+from .function import Function
 
 _LOGGER = logging.getLogger(LOGGER_PATH + ".event")
 
@@ -16,11 +17,20 @@ class Event:
     hass = None
 
     #
-    # notify message queues by event type
+    # notify message queues by event type, each with its optional filter
+    # (event data key -> frozenset of allowed values)
     #
     notify = {}
     notify_remove = {}
 
+    #
+    # index of the notify queues by event type, used to find the queues for
+    # an event without checking every filter: each entry is a set of queues
+    # without filters, and a dict of key -> value -> queues for the first
+    # key of each filter
+    #
+    notify_index = {}
+
     def __init__(self):
         """Warn on Event instantiation."""
         _LOGGER.error("Event class is not meant to be instantiated")
@@ -44,14 +54,64 @@ class Event:
         await cls.update(event.event_type, func_args)
 
     @classmethod
-    def notify_add(cls, event_type, queue):
-        """Register to notify for events of given type to be sent to queue."""
+    def filter_parse(cls, filter_kwargs):
+        """Return an event filter from keyword arguments, which are values or lists of values.
+
+        Raises ValueError if a value can't be used in a filter.
+        """
+        if not filter_kwargs:
+            return None
+        event_filter = {}
+        for key, value in filter_kwargs.items():
+            try:
+                if isinstance(value, (list, tuple, set, frozenset)):
+                    event_filter[key] = frozenset(value)
+                else:
+                    event_filter[key] = frozenset([value])
+            except TypeError as err:
+                raise ValueError(
+                    f"event filter {key}={value!r} should be a hashable value or a list of them"
+                ) from err
+        return event_filter
+
+    @classmethod
+    def filter_match(cls, event_filter, func_args):
+        """Return whether the event data in func_args passes event_filter."""
+        for key, values in event_filter.items():
+            if key not in func_args:
+                return False
+            try:
+                if func_args[key] not in values:
+                    return False
+            except TypeError:
+                return False
+        return True
+
+    @classmethod
+    def notify_index_update(cls, event_type):
+        """Rebuild the notify index for the given event type."""
+        queues_all = set()
+        index = {}
+        for queue, event_filter in cls.notify[event_type].items():
+            if not event_filter:
+                queues_all.add(queue)
+                continue
+            key = min(event_filter)
+            key_index = index.setdefault(key, {})
+            for value in event_filter[key]:
+                key_index.setdefault(value, []).append(queue)
+        cls.notify_index[event_type] = (queues_all, index)
+
+    @classmethod
+    def notify_add(cls, event_type, queue, event_filter=None):
+        """Register to notify for events of given type, optionally filtered, to be sent to queue."""
 
         if event_type not in cls.notify:
-            cls.notify[event_type] = set()
+            cls.notify[event_type] = {}
             _LOGGER.debug("event.notify_add(%s) -> adding event listener", event_type)
             cls.notify_remove[event_type] = cls.hass.bus.async_listen(event_type, cls.event_listener)
-        cls.notify[event_type].add(queue)
+        cls.notify[event_type][queue] = event_filter
+        cls.notify_index_update(event_type)
 
     @classmethod
     def notify_del(cls, event_type, queue):
@@ -59,18 +119,38 @@ class Event:
 
         if event_type not in cls.notify or queue not in cls.notify[event_type]:
             return
-        cls.notify[event_type].discard(queue)
+        del cls.notify[event_type][queue]
         if len(cls.notify[event_type]) == 0:
             cls.notify_remove[event_type]()
             _LOGGER.debug("event.notify_del(%s) -> removing event listener", event_type)
             del cls.notify[event_type]
             del cls.notify_remove[event_type]
+            del cls.notify_index[event_type]
+        else:
+            cls.notify_index_update(event_type)
 
     @classmethod
     async def update(cls, event_type, func_args):
         """Deliver all notifications for an event of the given type."""
 
         _LOGGER.debug("event.update(%s, %s, %s)", event_type, vars, func_args)
-        if event_type in cls.notify:
-            for queue in cls.notify[event_type]:
-                await queue.put(["event", func_args])
+        if event_type not in cls.notify:
+            return
+        queues_all, index = cls.notify_index[event_type]
+        queues = list(queues_all)
+        #
+        # a filtered queue can only match if the event has one of the values of
+        # its indexed key; its other keys are then checked
+        #
+        for key, key_index in index.items():
+            if key not in func_args:
+                continue
+            try:
+                queues_key = key_index.get(func_args[key])
+            except TypeError:
+                continue
+            if queues_key:
+                notify = cls.notify[event_type]
+                queues += [queue for queue in queues_key if cls.filter_match(notify[queue], func_args)]
+        for queue in queues:
+            Function.notify_put(queue, ["event", func_args])
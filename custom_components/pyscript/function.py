@@ -5,11 +5,34 @@ import functools
 import logging
 import traceback
 
+from homeassistant.const import EVENT_SERVICE_REGISTERED, EVENT_SERVICE_REMOVED
+from homeassistant.core import callback
+
 from .const import LOGGER_PATH
 
 _LOGGER = logging.getLogger(LOGGER_PATH + ".function")
 
 
+class AstFuncTable(dict):
+    """Local symbol table that creates each ast function the first time it's used."""
+
+    def __init__(self, ast_ctx, factories):
+        """Initialize table for ast_ctx, with the given ast function factories."""
+        super().__init__()
+        self.ast_ctx = ast_ctx
+        self.factories = factories
+
+    def __contains__(self, name):
+        """Return whether name is in the table, or is an ast function."""
+        return dict.__contains__(self, name) or name in self.factories
+
+    def __missing__(self, name):
+        """Create the ast function name and remember it."""
+        func = self.factories[name](self.ast_ctx)
+        self[name] = func
+        return func
+
+
 class Function:
     """Define function handler functions."""
 
@@ -41,6 +64,17 @@ class Function:
     #
     ast_functions = {}
 
+    #
+    # Cache of "domain.service" names to their service call functions, or None
+    # if there is no such service; cleared whenever a service is registered or removed
+    #
+    service_cache = {}
+
+    #
+    # Functions that remove the service_cache invalidation listeners
+    #
+    service_cache_remove = []
+
     def __init__(self):
         """Warn on Function instantiation."""
         _LOGGER.error("Function class is not meant to be instantiated")
@@ -69,6 +103,22 @@ class Function:
             }
         )
 
+        cls.service_cache = {}
+
+        @callback
+        def service_cache_invalidate_listener(event):
+            cls.service_cache_invalidate()
+
+        #
+        # remove the listeners from any previous init, so they aren't registered twice
+        #
+        for remove in cls.service_cache_remove:
+            remove()
+        cls.service_cache_remove = [
+            hass.bus.async_listen(event_type, service_cache_invalidate_listener)
+            for event_type in (EVENT_SERVICE_REGISTERED, EVENT_SERVICE_REMOVED)
+        ]
+
         #
         # start a task which is a reaper for canceled tasks, since some # functions
         # like TrigInfo.stop() can't be async (it's called from a __del__ method)
@@ -198,9 +248,8 @@ class Function:
 
     @classmethod
     def install_ast_funcs(cls, ast_ctx):
-        """Install ast functions into the local symbol table."""
-        sym_table = {name: func(ast_ctx) for name, func in cls.ast_functions.items()}
-        ast_ctx.set_local_sym_table(sym_table)
+        """Install ast functions into the local symbol table; each is only created when first used."""
+        ast_ctx.set_local_sym_table(AstFuncTable(ast_ctx, cls.ast_functions))
 
     @classmethod
     def get(cls, name):
@@ -209,19 +258,29 @@ class Function:
         if func:
             return func
 
+        if name in cls.service_cache:
+            return cls.service_cache[name]
+
         name_parts = name.split(".")
         if len(name_parts) != 2:
             return None
 
         domain, service = name_parts
         if not cls.service_has_service(domain, service):
+            cls.service_cache[name] = None
             return None
 
         async def service_call(*args, **kwargs):
             await cls.hass.services.async_call(domain, service, kwargs)
 
+        cls.service_cache[name] = service_call
         return service_call
 
+    @classmethod
+    def service_cache_invalidate(cls):
+        """Forget cached service lookups, since services have changed."""
+        cls.service_cache.clear()
+
     @classmethod
     async def run_coro(cls, coro):
         """Run coroutine task and update unique task on start and exit."""
@@ -247,6 +306,18 @@ class Function:
         """Create a new task that runs a coroutine."""
         return cls.hass.loop.create_task(cls.run_coro(coro))
 
+    @classmethod
+    def notify_put(cls, queue, item):
+        """Put item on a trigger's notification queue without waiting.
+
+        A full queue (a @trigger_queue with the block policy) gets item from a task
+        that waits for room, so one slow trigger doesn't hold up notifying the others.
+        """
+        if queue.full():
+            cls.create_task(queue.put(item))
+        else:
+            queue.put_nowait(item)
+
     @classmethod
     def task_cancel(cls, task):
         """Send a task to be canceled by the reaper."""
@@ -4,7 +4,7 @@ import logging
 import os
 from types import ModuleType
 
-from .const import FOLDER, LOGGER_PATH
+from .const import DEFAULT_TIME_SLICE, FOLDER, LOGGER_PATH
 from .eval import AstEval
 from .function import Function
 from .trigger import TrigInfo
@@ -26,6 +26,7 @@ class GlobalContext:
         self.auto_start = False
         self.module = None
         self.rel_import_path = rel_import_path
+        self.time_slice = DEFAULT_TIME_SLICE
 
     def trigger_register(self, func):
         """Register a trigger function; return True if start now."""
@@ -66,6 +67,16 @@ class GlobalContext:
         """Return the global symbol table."""
         return self.global_sym_table
 
+    def get_time_slice(self):
+        """Return the number of seconds tasks run before yielding to the event loop."""
+        return self.time_slice
+
+    def set_time_slice(self, time_slice):
+        """Set the number of seconds tasks run before yielding to the event loop; None disables it."""
+        if time_slice is not None and (not isinstance(time_slice, (int, float)) or time_slice <= 0):
+            raise ValueError(f"time slice should be a positive number of seconds or None, not {time_slice}")
+        self.time_slice = time_slice
+
     def get_trig_info(self, name, trig_args):
         """Return a new trigger info instance with the given args."""
         return TrigInfo(name, trig_args, self)
@@ -168,6 +179,23 @@ class GlobalContextMgr:
     #
     name_seq = 0
 
+    #
+    # parsed and compiled source files, indexed by path, so reloading an unchanged
+    # file skips parsing and compiling it; each entry is [source, ast_tree]
+    #
+    # the cache is deliberately kept in memory rather than on disk: unpickling a
+    # saved tree is only about 25% faster than parsing the source (and the pickle is
+    # about four times larger), while the compiled closures, which cost more than
+    # parsing, can't be saved at all.  At startup, function bodies are instead only
+    # compiled on their first call.
+    #
+    parse_cache = {}
+
+    #
+    # paths of the source files loaded since the parse cache was last pruned
+    #
+    parse_cache_used = set()
+
     def __init__(self):
         """Report an error if GlobalContextMgr in instantiated."""
         _LOGGER.error("GlobalContextMgr class is not meant to be instantiated")
@@ -207,10 +235,20 @@ class GlobalContextMgr:
 
             return set_global_ctx
 
+        def set_time_slice_factory(ast_ctx):
+            """Generate a pyscript.set_time_slice() function with given ast_ctx."""
+
+            async def set_time_slice(time_slice):
+                ast_ctx.get_global_ctx().set_time_slice(time_slice)
+                ast_ctx.time_slice_reset()
+
+            return set_time_slice
+
         ast_funcs = {
             "pyscript.get_global_ctx": get_global_ctx_factory,
             "pyscript.list_global_ctx": list_global_ctx_factory,
             "pyscript.set_global_ctx": set_global_ctx_factory,
+            "pyscript.set_time_slice": set_time_slice_factory,
         }
 
         Function.register_ast(ast_funcs)
@@ -247,6 +285,13 @@ class GlobalContextMgr:
             if name not in cls.contexts:
                 return name
 
+    @classmethod
+    def parse_cache_prune(cls):
+        """Remove parse cache entries for files that weren't loaded since the last prune."""
+        for path in set(cls.parse_cache.keys()) - cls.parse_cache_used:
+            del cls.parse_cache[path]
+        cls.parse_cache_used = set()
+
     @classmethod
     async def load_file(cls, filepath, global_ctx):
         """Load, parse and run the given script file; returns error ast_ctx on error, or None if ok."""
@@ -270,11 +315,19 @@ class GlobalContextMgr:
         ast_ctx = AstEval(global_ctx.get_name(), global_ctx)
         Function.install_ast_funcs(ast_ctx)
 
-        if not ast_ctx.parse(source, filename=filepath):
+        cls.parse_cache_used.add(filepath)
+        cache_entry = cls.parse_cache.get(filepath, None)
+        if cache_entry is not None and cache_entry[0] == source:
+            _LOGGER.debug("using cached parse of unchanged %s", filepath)
+            ast_ctx.parse(source, filename=filepath, ast_tree=cache_entry[1])
+        elif not ast_ctx.parse(source, filename=filepath):
+            cls.parse_cache.pop(filepath, None)
             exc = ast_ctx.get_exception_long()
             ast_ctx.get_logger().error(exc)
             global_ctx.stop()
             return ast_ctx
+        else:
+            cls.parse_cache[filepath] = [source, ast_ctx.ast]
         await ast_ctx.eval()
         exc = ast_ctx.get_exception_long()
         if exc is not None:
@@ -1,6 +1,9 @@
 """Handles state variable access and change notification."""
 
+import collections
+import fnmatch
 import logging
+import re
 
 from homeassistant.helpers.restore_state import RestoreStateData
 
@@ -23,13 +26,39 @@ class State:
     #
     notify = {}
 
+    #
+    # notify message queues for wildcard state variable names (eg, "sensor.*_battery"),
+    # indexed by domain and then pattern, together with the compiled patterns, and a
+    # cache of the matching patterns' queues for each state variable name that has
+    # been checked, which is cleared when patterns are added or removed
+    #
+    notify_wildcard = {}
+    notify_wildcard_re = {}
+    notify_wildcard_cache = {}
+
+    #
+    # for queues that read attributes of a state variable, the attribute names
+    # and whether they only read attributes (so they are only notified when one
+    # of those attributes changes), by state variable and then queue
+    #
+    notify_attrs = {}
+
     #
     # Last value of state variable notifications.  We maintain this
     # so that trigger evaluation can use the last notified value,
     # rather than fetching the current value, which is subject to
     # race conditions when multiple state variables are set.
     #
+    # notify_var_last has the state variables that are being watched
+    # (ie, are in notify), and is pruned when they are no longer watched.
+    # The last values of other state variables (eg, ones that were
+    # watched, or set by pyscript) are kept in notify_var_recent, which
+    # drops the least recently used ones beyond notify_var_recent_max
+    # (None means no limit).
+    #
     notify_var_last = {}
+    notify_var_recent = collections.OrderedDict()
+    notify_var_recent_max = 256
 
     #
     # pyscript yaml configuration
@@ -50,55 +79,197 @@ class State:
         """Initialize State."""
         cls.hass = hass
 
+    @classmethod
+    def is_wildcard(cls, var_name):
+        """Return whether var_name is a wildcard pattern, rather than a state variable name."""
+        return "*" in var_name or "?" in var_name or "[" in var_name
+
+    @classmethod
+    def wildcard_match(cls, var_name, var_names):
+        """Return whether var_name matches one of the wildcard patterns in var_names."""
+        for pattern in var_names:
+            pattern_re = cls.notify_wildcard_re.get(pattern)
+            if pattern_re and pattern_re.match(var_name):
+                return True
+        return False
+
+    @classmethod
+    def notify_wildcard_get(cls, var_name):
+        """Return the queues of each wildcard pattern that matches state variable var_name."""
+        domain = var_name.split(".", 1)[0]
+        if domain not in cls.notify_wildcard:
+            return []
+        matches = cls.notify_wildcard_cache.get(var_name)
+        if matches is None:
+            matches = [
+                queues
+                for pattern, queues in cls.notify_wildcard[domain].items()
+                if cls.notify_wildcard_re[pattern].match(var_name)
+            ]
+            cls.notify_wildcard_cache[var_name] = matches
+        return matches
+
     @classmethod
     async def notify_add(cls, var_names, queue):
         """Register to notify state variables changes to be sent to queue."""
 
+        entity_attrs = {}
         for var_name in var_names if isinstance(var_names, set) else {var_names}:
+            if cls.is_wildcard(var_name):
+                domain = var_name.split(".", 1)[0]
+                patterns = cls.notify_wildcard.setdefault(domain, {})
+                if var_name not in patterns:
+                    patterns[var_name] = {}
+                    cls.notify_wildcard_re[var_name] = re.compile(fnmatch.translate(var_name))
+                    cls.notify_wildcard_cache = {}
+                patterns[var_name][queue] = var_names
+                continue
             parts = var_name.split(".")
+            if len(parts) == 4 and parts[3] == "old":
+                parts.pop()
             if len(parts) != 2 and len(parts) != 3:
                 continue
             state_var_name = f"{parts[0]}.{parts[1]}"
+            attr_info = entity_attrs.setdefault(state_var_name, [set(), True])
+            if len(parts) == 2 or parts[2] == "old":
+                attr_info[1] = False
+            else:
+                attr_info[0].add(parts[2])
             if state_var_name not in cls.notify:
                 cls.notify[state_var_name] = {}
+                if state_var_name in cls.notify_var_recent:
+                    cls.notify_var_last[state_var_name] = cls.notify_var_recent.pop(state_var_name)
             cls.notify[state_var_name][queue] = var_names
             await cls.register_persist(state_var_name)
+        for state_var_name, (attr_names, attrs_only) in entity_attrs.items():
+            if attr_names:
+                cls.notify_attrs.setdefault(state_var_name, {})[queue] = (attr_names, attrs_only)
 
     @classmethod
     def notify_del(cls, var_names, queue):
         """Unregister notify of state variables changes for given queue."""
 
         for var_name in var_names if isinstance(var_names, set) else {var_names}:
+            if cls.is_wildcard(var_name):
+                domain = var_name.split(".", 1)[0]
+                patterns = cls.notify_wildcard.get(domain, {})
+                if var_name in patterns:
+                    patterns[var_name].pop(queue, None)
+                    if not patterns[var_name]:
+                        del patterns[var_name]
+                        del cls.notify_wildcard_re[var_name]
+                        cls.notify_wildcard_cache = {}
+                        if not patterns:
+                            del cls.notify_wildcard[domain]
+                continue
             parts = var_name.split(".")
+            if len(parts) == 4 and parts[3] == "old":
+                parts.pop()
             if len(parts) != 2 and len(parts) != 3:
                 continue
             state_var_name = f"{parts[0]}.{parts[1]}"
+            if state_var_name in cls.notify_attrs:
+                cls.notify_attrs[state_var_name].pop(queue, None)
+                if not cls.notify_attrs[state_var_name]:
+                    del cls.notify_attrs[state_var_name]
             if state_var_name not in cls.notify or queue not in cls.notify[state_var_name]:
-                return
+                continue
             del cls.notify[state_var_name][queue]
+            if not cls.notify[state_var_name]:
+                del cls.notify[state_var_name]
+                if state_var_name in cls.notify_var_last:
+                    cls.notify_var_recent_set(state_var_name, cls.notify_var_last.pop(state_var_name))
 
     @classmethod
-    async def update(cls, new_vars, func_args):
-        """Deliver all notifications for state variable changes."""
+    def notify_var_recent_set(cls, var_name, value):
+        """Remember the last value of a state variable that isn't being watched."""
+        cls.notify_var_recent[var_name] = value
+        cls.notify_var_recent.move_to_end(var_name)
+        if cls.notify_var_recent_max is not None:
+            while len(cls.notify_var_recent) > cls.notify_var_recent_max:
+                cls.notify_var_recent.popitem(last=False)
 
+    @classmethod
+    def notify_var_last_info(cls):
+        """Return the number of last values kept for watched and other state variables."""
+        return {
+            "watched": len(cls.notify_var_last),
+            "recent": len(cls.notify_var_recent),
+            "recent_max": cls.notify_var_recent_max,
+        }
+
+    @classmethod
+    def notify_attrs_check(cls, var_name, queues, old_attrs, new_attrs, attr_vars):
+        """Return the queues to notify for a change to state variable var_name.
+
+        Queues that only read attributes of var_name are left out unless one of those
+        attributes changed.  The old and new values of the attributes read by the queues
+        are added to attr_vars as domain.entity.attr and domain.entity.attr.old.
+        """
+        notify_attrs = cls.notify_attrs[var_name]
         notify = {}
+        for queue, var_names in queues.items():
+            if queue not in notify_attrs:
+                notify[queue] = var_names
+                continue
+            attr_names, attrs_only = notify_attrs[queue]
+            changed = False
+            for attr in attr_names:
+                if attr in new_attrs:
+                    attr_vars[f"{var_name}.{attr}"] = new_attrs[attr]
+                if attr in old_attrs:
+                    attr_vars[f"{var_name}.{attr}.old"] = old_attrs[attr]
+                if (attr in old_attrs) != (attr in new_attrs) or old_attrs.get(attr) != new_attrs.get(attr):
+                    changed = True
+            if changed or not attrs_only:
+                notify[queue] = var_names
+        return notify
+
+    @classmethod
+    async def update(cls, new_vars, func_args, old_attrs=None, new_attrs=None):
+        """Deliver all notifications for state variable changes.
+
+        If the old and new attributes are given, queues that only read attributes are
+        only notified if one of their attributes changed.
+        """
+
+        notify = {}
+        attr_vars = {}
         for var_name, var_val in new_vars.items():
+            if var_name in cls.notify_var_recent:
+                cls.notify_var_recent[var_name] = var_val
             if var_name in cls.notify:
                 cls.notify_var_last[var_name] = var_val
-                notify.update(cls.notify[var_name])
-
+                if var_name in cls.notify_attrs and new_attrs is not None:
+                    notify.update(
+                        cls.notify_attrs_check(
+                            var_name, cls.notify[var_name], old_attrs, new_attrs, attr_vars
+                        )
+                    )
+                else:
+                    notify.update(cls.notify[var_name])
+            if cls.notify_wildcard and var_name.count(".") == 1:
+                for queues in cls.notify_wildcard_get(var_name):
+                    notify.update(queues)
+
+        if attr_vars:
+            new_vars = {**new_vars, **attr_vars}
         if notify:
             _LOGGER.debug("state.update(%s, %s)", new_vars, func_args)
             for queue, var_names in notify.items():
-                await queue.put(["state", [cls.notify_var_get(var_names, new_vars), func_args]])
+                Function.notify_put(queue, ["state", [cls.notify_var_get(var_names, new_vars), func_args]])
 
     @classmethod
     def notify_var_get(cls, var_names, new_vars):
         """Return the most recent value of a state variable change."""
         notify_vars = {}
         for var_name in var_names if var_names is not None else []:
+            if var_name in cls.notify_wildcard_re:
+                continue
             if var_name in cls.notify_var_last:
                 notify_vars[var_name] = cls.notify_var_last[var_name]
+            elif var_name in cls.notify_var_recent:
+                notify_vars[var_name] = cls.notify_var_recent[var_name]
             elif var_name in new_vars:
                 notify_vars[var_name] = new_vars[var_name]
             elif 1 <= var_name.count(".") <= 2 and not cls.exist(var_name):
@@ -139,15 +310,23 @@ class State:
             new_attributes = new_attributes.copy()
             new_attributes.update(kwargs)
         _LOGGER.debug("setting %s = %s, attr = %s", var_name, value, new_attributes)
-        cls.notify_var_last[var_name] = str(value)
+        if var_name in cls.notify:
+            cls.notify_var_last[var_name] = str(value)
+        else:
+            cls.notify_var_recent_set(var_name, str(value))
 
         await cls.register_persist(var_name)
         cls.hass.states.async_set(var_name, value, new_attributes)
 
+    @classmethod
+    def persist_pending(cls, var_name):
+        """Return whether register_persist() still needs to be awaited for var_name."""
+        return var_name.startswith("pyscript.") and var_name not in cls.persisted_vars
+
     @classmethod
     async def register_persist(cls, var_name):
         """Persists a pyscript state variable using RestoreState."""
-        if var_name.startswith("pyscript.") and var_name not in cls.persisted_vars:
+        if cls.persist_pending(var_name):
             restore_data = await RestoreStateData.async_get_instance(cls.hass)
             restore_data.async_restore_entity_added(var_name)
             cls.persisted_vars.add(var_name)
@@ -191,11 +370,17 @@ class State:
     @classmethod
     async def get(cls, var_name):
         """Get a state variable value or attribute from hass."""
+        if var_name.count(".") in {1, 2}:
+            await cls.register_persist(var_name)
+        return cls.get_value(var_name)
+
+    @classmethod
+    def get_value(cls, var_name):
+        """Get a state variable value or attribute from hass, without registering it for persistence."""
         parts = var_name.split(".")
         if len(parts) != 2 and len(parts) != 3:
             raise NameError(f"invalid name '{var_name}' (should be 'domain.entity')")
         value = cls.hass.states.get(f"{parts[0]}.{parts[1]}")
-        await cls.register_persist(var_name)
         if not value:
             raise NameError(f"name '{parts[0]}.{parts[1]}' is not defined")
         if len(parts) == 2:
@@ -1,18 +1,26 @@
 """Implements all the trigger logic."""
 
+import ast
 import asyncio
+import collections
 import datetime as dt
+import functools
+import heapq
+import itertools
 import locale
 import logging
 import math
 import re
 import time
+import weakref
 
 from croniter import croniter
 
+from homeassistant.const import EVENT_CORE_CONFIG_UPDATE
+from homeassistant.core import callback
 import homeassistant.helpers.sun as sun
 
-from .const import LOGGER_PATH
+from .const import DEFAULT_STARTUP_CONCURRENCY, LOGGER_PATH
 from .eval import AstEval
 from .event import Event
 from .function import Function
@@ -22,6 +30,7 @@ _LOGGER = logging.getLogger(LOGGER_PATH + ".trigger")
 
 
 STATE_RE = re.compile(r"[a-zA-Z]\w*\.[a-zA-Z]\w*$")
+STATE_WILDCARD_RE = re.compile(r"[a-zA-Z]\w*\.[\w\[\]!-]*[*?[][\w*?\[\]!-]*$")
 
 
 def dt_now():
@@ -61,6 +70,34 @@ class TrigTime:
     #
     dow2int = {}
 
+    #
+    # Heap of pending timers for all the time triggers, wait_until() and watch() timeouts.
+    # Each timer is a list [loop_time, seq, notify_q, notify_info, notify_type]; notify_q is set to None
+    # once it fires or is canceled.  Only the earliest timer has an event loop callback.
+    #
+    timer_heap = []
+    timer_seq = itertools.count()
+    timer_handle = None
+    timer_when = None
+    timer_num_canceled = 0
+
+    #
+    # Cache of (sunrise or sunset, date) to the sun time, or None if it's not defined
+    # at this latitude.  It's cleared, and config_gen is incremented, whenever the
+    # location config changes, which tells each DateTimeSpec to clear its own cache.
+    #
+    sun_cache = {}
+    config_gen = 0
+    config_update_remove = []
+
+    #
+    # LRU cache of the parsed (and compiled) wait_until() and watch() expressions, by
+    # (global context id, trigger kind, expression string).  Each value is a weak
+    # reference to the global context and the AST.
+    #
+    wait_expr_cache = collections.OrderedDict()
+    wait_expr_cache_max = 128
+
     def __init__(self):
         """Warn on TrigTime instantiation."""
         _LOGGER.error("TrigTime class is not meant to be instantiated")
@@ -69,6 +106,20 @@ class TrigTime:
     def init(cls, hass):
         """Initialize TrigTime."""
         cls.hass = hass
+        if cls.timer_handle:
+            cls.timer_handle.cancel()
+        cls.timer_heap = []
+        cls.timer_handle = None
+        cls.timer_num_canceled = 0
+        cls.config_update()
+
+        @callback
+        def config_update_listener(event):
+            cls.config_update()
+
+        for remove in cls.config_update_remove:
+            remove()
+        cls.config_update_remove = [hass.bus.async_listen(EVENT_CORE_CONFIG_UPDATE, config_update_listener)]
 
         def wait_until_factory(ast_ctx):
             """Return wapper to call to astFunction with the ast context."""
@@ -78,8 +129,17 @@ class TrigTime:
 
             return wait_until_call
 
+        def watch_factory(ast_ctx):
+            """Return wapper to call to astFunction with the ast context."""
+
+            async def watch_call(*arg, **kw):
+                return await TrigWatch.create(ast_ctx, *arg, **kw)
+
+            return watch_call
+
         ast_funcs = {
             "task.wait_until": wait_until_factory,
+            "task.watch": watch_factory,
         }
         Function.register_ast(ast_funcs)
 
@@ -87,6 +147,99 @@ class TrigTime:
             cls.dow2int[locale.nl_langinfo(getattr(locale, f"ABDAY_{i + 1}")).lower()] = i
             cls.dow2int[locale.nl_langinfo(getattr(locale, f"DAY_{i + 1}")).lower()] = i
 
+    @classmethod
+    def config_update(cls):
+        """Forget cached sun times, since the location config might have changed."""
+        cls.sun_cache = {}
+        cls.config_gen += 1
+
+    @classmethod
+    def sun_time(cls, sun_event, date):
+        """Return the sunrise or sunset time on the given date, or None if it isn't defined."""
+        key = (sun_event, date)
+        if key in cls.sun_cache:
+            return cls.sun_cache[key]
+        location = sun.get_astral_location(cls.hass)
+        if isinstance(location, tuple):
+            #
+            # newer versions of HASS return (location, elevation)
+            #
+            location = location[0]
+        try:
+            if sun_event == "sunrise":
+                time_sun = location.sunrise(date)
+            else:
+                time_sun = location.sunset(date)
+        except ValueError as err:
+            #
+            # astral raises ValueError when the sun doesn't rise or set that day
+            #
+            _LOGGER.debug("%s isn't defined on %s: %s", sun_event, date, err)
+            time_sun = None
+        if len(cls.sun_cache) >= 64:
+            cls.sun_cache = {}
+        cls.sun_cache[key] = time_sun
+        return time_sun
+
+    @classmethod
+    def timer_add(cls, delay, notify_q, notify_info, notify_type="time"):
+        """Send [notify_type, notify_info] to notify_q after delay seconds, returning a timer for timer_cancel()."""
+        loop = asyncio.get_running_loop()
+        timer = [loop.time() + delay, next(cls.timer_seq), notify_q, notify_info, notify_type]
+        heapq.heappush(cls.timer_heap, timer)
+        cls.timer_schedule(loop)
+        return timer
+
+    @classmethod
+    def timer_cancel(cls, timer):
+        """Cancel a timer, unless it has already fired."""
+        if timer is None or timer[2] is None:
+            return
+        timer[2] = timer[3] = None
+        cls.timer_num_canceled += 1
+        #
+        # canceled timers are normally dropped when they reach the top of the heap;
+        # if they build up (eg, triggers that are mostly woken by state changes)
+        # we rebuild the heap without them
+        #
+        if cls.timer_num_canceled > 64 and 2 * cls.timer_num_canceled > len(cls.timer_heap):
+            cls.timer_heap = [timer for timer in cls.timer_heap if timer[2] is not None]
+            heapq.heapify(cls.timer_heap)
+            cls.timer_num_canceled = 0
+
+    @classmethod
+    def timer_schedule(cls, loop):
+        """Make sure there is an event loop callback for the earliest pending timer."""
+        heap = cls.timer_heap
+        while heap and heap[0][2] is None:
+            heapq.heappop(heap)
+            cls.timer_num_canceled -= 1
+        if not heap:
+            return
+        when = heap[0][0]
+        if cls.timer_handle:
+            if cls.timer_when <= when:
+                return
+            cls.timer_handle.cancel()
+        cls.timer_when = when
+        cls.timer_handle = loop.call_at(when, cls.timer_fire, loop)
+
+    @classmethod
+    def timer_fire(cls, loop):
+        """Deliver all the timers that are due, and schedule the next one."""
+        cls.timer_handle = None
+        now = max(loop.time(), cls.timer_when)
+        heap = cls.timer_heap
+        while heap and heap[0][0] <= now:
+            timer = heapq.heappop(heap)
+            if timer[2] is None:
+                cls.timer_num_canceled -= 1
+                continue
+            notify_q, notify_info = timer[2], timer[3]
+            timer[2] = timer[3] = None
+            Function.notify_put(notify_q, [timer[4], notify_info])
+        cls.timer_schedule(loop)
+
     @classmethod
     async def wait_until(
         cls,
@@ -96,6 +249,8 @@ class TrigTime:
         time_trigger=None,
         event_trigger=None,
         timeout=None,
+        queue_size=None,
+        queue_policy=None,
         **kwargs,
     ):
         """Wait for zero or more triggers, until an optional timeout."""
@@ -104,46 +259,18 @@ class TrigTime:
                 await asyncio.sleep(timeout)
                 return {"trigger_type": "timeout"}
             return {"trigger_type": "none"}
+        if time_trigger is not None:
+            time_trigger = cls.time_spec_parse_list(time_trigger)
         state_trig_ident = set()
         state_trig_ident_any = set()
         state_trig_eval = None
         event_trig_expr = None
         exc = None
-        notify_q = asyncio.Queue(0)
+        notify_q = NotifyQueue(ast_ctx.name, size=queue_size, policy=queue_policy)
         if state_trigger is not None:
-            state_trig = []
-            if isinstance(state_trigger, str):
-                state_trigger = [state_trigger]
-            elif isinstance(state_trigger, set):
-                state_trigger = list(state_trigger)
-            #
-            # separate out the entries that are just state var names, which mean trigger
-            # on any change (no expr)
-            #
-            for trig in state_trigger:
-                if STATE_RE.match(trig):
-                    state_trig_ident_any.add(trig)
-                else:
-                    state_trig.append(trig)
-
-            if len(state_trig) > 0:
-                if len(state_trig) == 1:
-                    state_trig_expr = state_trig[0]
-                else:
-                    state_trig_expr = f"any([{', '.join(state_trig)}])"
-                state_trig_eval = AstEval(
-                    f"{ast_ctx.name} state_trigger",
-                    ast_ctx.get_global_ctx(),
-                    logger_name=ast_ctx.get_logger_name(),
-                )
-                Function.install_ast_funcs(state_trig_eval)
-                state_trig_eval.parse(state_trig_expr)
-                state_trig_ident = await state_trig_eval.get_names()
-                exc = state_trig_eval.get_exception_obj()
-                if exc is not None:
-                    raise exc
-
-            state_trig_ident.update(state_trig_ident_any)
+            state_trig_ident, state_trig_ident_any, state_trig_eval = await cls.state_trig_parse(
+                ast_ctx, state_trigger
+            )
             if state_trig_eval:
                 #
                 # check straight away to see if the condition is met (to avoid race conditions)
@@ -163,19 +290,12 @@ class TrigTime:
         if event_trigger is not None:
             if isinstance(event_trigger, str):
                 event_trigger = [event_trigger]
-            if len(event_trigger) > 1:
-                event_trig_expr = AstEval(
-                    f"{ast_ctx.name} event_trigger",
-                    ast_ctx.get_global_ctx(),
-                    logger_name=ast_ctx.get_logger_name(),
-                )
-                Function.install_ast_funcs(event_trig_expr)
-                event_trig_expr.parse(event_trigger[1])
-                exc = event_trig_expr.get_exception_obj()
-                if exc is not None:
-                    if len(state_trig_ident) > 0:
-                        State.notify_del(state_trig_ident, notify_q)
-                    raise exc
+            try:
+                event_trig_expr = await cls.event_trig_parse(ast_ctx, event_trigger)
+            except Exception:
+                if len(state_trig_ident) > 0:
+                    State.notify_del(state_trig_ident, notify_q)
+                raise
             Event.notify_add(event_trigger[0], notify_q)
         time0 = time.monotonic()
 
@@ -209,15 +329,20 @@ class TrigTime:
                 _LOGGER.debug("trigger %s wait_until no timeout", ast_ctx.name)
                 notify_type, notify_info = await notify_q.get()
             else:
+                _LOGGER.debug("trigger %s wait_until %s secs", ast_ctx.name, this_timeout)
+                if not ret:
+                    ret = {"trigger_type": "time"}
+                    if time_next is not None:
+                        ret["trigger_time"] = time_next
+                timer = cls.timer_add(this_timeout, notify_q, ret)
                 try:
-                    _LOGGER.debug("trigger %s wait_until %s secs", ast_ctx.name, this_timeout)
-                    notify_type, notify_info = await asyncio.wait_for(notify_q.get(), timeout=this_timeout)
-                except asyncio.TimeoutError:
-                    if not ret:
-                        ret = {"trigger_type": "time"}
-                        if time_next is not None:
-                            ret["trigger_time"] = time_next
-                    break
+                    notify_type, notify_info = await notify_q.get()
+                finally:
+                    cls.timer_cancel(timer)
+                ret = None
+            if notify_type == "time":
+                ret = notify_info
+                break
             if notify_type == "state":
                 if notify_info:
                     new_vars, func_args = notify_info
@@ -225,7 +350,8 @@ class TrigTime:
                     new_vars, func_args = None, {}
 
                 state_trig_ok = False
-                if func_args.get("var_name", "") in state_trig_ident_any:
+                var_name = func_args.get("var_name", "")
+                if var_name in state_trig_ident_any or State.wildcard_match(var_name, state_trig_ident_any):
                     state_trig_ok = True
                 elif state_trig_eval:
                     state_trig_ok = await state_trig_eval.eval(new_vars)
@@ -259,14 +385,180 @@ class TrigTime:
             raise exc
         return ret
 
+    @classmethod
+    async def state_trig_parse(cls, ast_ctx, state_trigger):
+        """Parse a state_trigger string or list of strings.
+
+        Returns the set of state variables to watch, the subset of those that trigger on
+        any change, and an AstEval for the expression (or None if there isn't one).
+        """
+        state_trig_ident = set()
+        state_trig_ident_any = set()
+        state_trig_eval = None
+        state_trig = []
+        if isinstance(state_trigger, str):
+            state_trigger = [state_trigger]
+        elif isinstance(state_trigger, set):
+            state_trigger = list(state_trigger)
+        #
+        # separate out the entries that are just state var names, which mean trigger
+        # on any change (no expr)
+        #
+        for trig in state_trigger:
+            if STATE_RE.match(trig) or STATE_WILDCARD_RE.match(trig):
+                state_trig_ident_any.add(trig)
+            else:
+                state_trig.append(trig)
+
+        if len(state_trig) > 0:
+            if len(state_trig) == 1:
+                state_trig_expr = state_trig[0]
+            else:
+                state_trig_expr = f"any([{', '.join(state_trig)}])"
+            state_trig_eval, names = await cls.wait_expr_parse(ast_ctx, "state_trigger", state_trig_expr)
+            state_trig_ident = set(names)
+
+        state_trig_ident.update(state_trig_ident_any)
+        return state_trig_ident, state_trig_ident_any, state_trig_eval
+
+    @classmethod
+    async def event_trig_parse(cls, ast_ctx, event_trigger):
+        """Parse the optional expression of an event_trigger list, returning an AstEval or None."""
+        if len(event_trigger) <= 1:
+            return None
+        event_trig_expr, _ = await cls.wait_expr_parse(ast_ctx, "event_trigger", event_trigger[1])
+        return event_trig_expr
+
+    @classmethod
+    async def wait_expr_parse(cls, ast_ctx, kind, expr_str):
+        """Return a new AstEval for a wait_until() or watch() expression, and its names for state triggers.
+
+        The AST is reused from the cache if the same expression was parsed before in this
+        global context.  Each call gets its own (cheap) AstEval, so concurrent waits don't
+        share evaluation state, and finds the names again, since whether a dotted name is
+        a state variable depends on the current symbols.  Raises the exception if the
+        expression doesn't parse.
+        """
+        global_ctx = ast_ctx.get_global_ctx()
+        expr = AstEval(f"{ast_ctx.name} {kind}", global_ctx, logger_name=ast_ctx.get_logger_name())
+        Function.install_ast_funcs(expr)
+        key = (id(global_ctx), kind, expr_str)
+        entry = cls.wait_expr_cache.get(key)
+        if entry is not None and entry[0]() is global_ctx:
+            cls.wait_expr_cache.move_to_end(key)
+            expr.parse(expr_str, ast_tree=entry[1])
+        else:
+            expr.parse(expr_str)
+            exc = expr.get_exception_obj()
+            if exc is not None:
+                raise exc
+            cls.wait_expr_cache[key] = (weakref.ref(global_ctx), expr.ast)
+            cls.wait_expr_cache.move_to_end(key)
+            while len(cls.wait_expr_cache) > cls.wait_expr_cache_max:
+                cls.wait_expr_cache.popitem(last=False)
+        names = await expr.get_names() if kind == "state_trigger" else None
+        return expr, names
+
     @classmethod
     def parse_date_time(cls, date_time_str, day_offset, now):
         """Parse a date time string, returning datetime."""
-        year = now.year
-        month = now.month
-        day = now.day
+        return DateTimeSpec(date_time_str).resolve(day_offset, now)
+
+    @classmethod
+    def time_spec_parse(cls, spec, active=False):
+        """Parse a time_trigger (or time_active if active) string into a TimeSpec.
+
+        Raises ValueError if the string isn't a valid specification.
+        """
+        if active:
+            spec_str = spec.strip()
+            negate = False
+            if spec_str.startswith("not"):
+                negate = True
+                spec_str = spec_str.replace("not ", "")
+            cron_match = re.match(r"cron\((?P<cron_expr>.*)\)", spec_str)
+            if cron_match:
+                return TimeSpecCron(spec, cron_match.group("cron_expr"), negate=negate)
+            range_expr = re.match(r"range\(([^,]+),\s?([^,]+)\)", spec_str)
+            if range_expr:
+                dt_start, dt_end = range_expr.groups()
+                return TimeSpecRange(spec, dt_start, dt_end, negate=negate)
+            raise ValueError(f"Can't parse {spec} in time_active check")
+
+        cron_match = re.search(r"cron\((?P<cron_expr>.*)\)", spec)
+        if cron_match:
+            return TimeSpecCron(spec, cron_match.group("cron_expr"))
+        match1 = re.split(r"once\((.*)\)", spec)
+        if len(match1) == 3:
+            return TimeSpecOnce(spec, match1[1])
+        match2 = re.split(r"period\(([^,]*),([^,]*)(?:,([^,]*))?\)", spec)
+        if len(match2) == 5:
+            return TimeSpecPeriod(spec, match2[1], match2[2], match2[3])
+        raise ValueError(f"Can't parse {spec} in time_trigger check")
+
+    @classmethod
+    def time_spec_parse_list(cls, time_spec, active=False):
+        """Parse a time_trigger or time_active string or list of strings into a list of TimeSpec."""
+        if not isinstance(time_spec, list):
+            time_spec = [time_spec]
+        return [
+            spec if isinstance(spec, TimeSpec) else cls.time_spec_parse(spec, active) for spec in time_spec
+        ]
+
+    @classmethod
+    def timer_active_check(cls, time_spec, now):
+        """Check if the given time matches the time specification."""
+        results = {"+": [], "-": []}
+        for spec in time_spec if isinstance(time_spec, list) else [time_spec]:
+            if not isinstance(spec, TimeSpec):
+                try:
+                    spec = cls.time_spec_parse(spec, active=True)
+                except ValueError as exc:
+                    _LOGGER.error("%s", exc)
+                    return False
+            if spec.negate:
+                results["-"].append(not spec.contains(now))
+            else:
+                results["+"].append(spec.contains(now))
+
+        # An empty spec, or only neg specs, is True
+        result = any(results["+"]) if results["+"] else True and all(results["-"])
+
+        return result
+
+    @classmethod
+    def timer_trigger_next(cls, time_spec, now):
+        """Return the next trigger time based on the given time and time specification."""
+        next_time = None
+        for spec in time_spec if isinstance(time_spec, list) else [time_spec]:
+            if not isinstance(spec, TimeSpec):
+                try:
+                    spec = cls.time_spec_parse(spec)
+                except ValueError as exc:
+                    _LOGGER.error("%s", exc)
+                    continue
+            this_t = spec.next_after(now)
+            if this_t is not None and (next_time is None or this_t < next_time):
+                next_time = this_t
+        return next_time
+
+
+class DateTimeSpec:
+    """Date time string used in once(), period() and range(), parsed into its date, time and offset."""
+
+    def __init__(self, date_time_str):
+        """Parse the date time string; the date and sun times are resolved later."""
+        self.date = None
+        self.dow = None
+        self.day_offset = None
+        self.time = None
+        self.sun = None
+        self.offset = None
+        self.resolve_cache = {}
+        self.resolve_cache_gen = None
 
         dt_str = date_time_str.strip().lower()
+        self.date_time_str = dt_str
         #
         # parse the date
         #
@@ -275,38 +567,25 @@ class TrigTime:
         match1 = re.split(r"^(\w+).*", dt_str)
         if len(match0) == 5:
             if match0[3] is None:
-                month, day = int(match0[1]), int(match0[2])
+                self.date = None, int(match0[1]), int(match0[2])
             else:
-                year, month, day = int(match0[1]), int(match0[2]), int(match0[3])
-            day_offset = 0  # explicit date means no offset
+                self.date = int(match0[1]), int(match0[2]), int(match0[3])
         elif len(match1) == 3:
-            if match1[1] in cls.dow2int:
-                dow = cls.dow2int[match1[1]]
-                if dow >= (now.isoweekday() % 7):
-                    day_offset = dow - (now.isoweekday() % 7)
-                else:
-                    day_offset = 7 + dow - (now.isoweekday() % 7)
+            if match1[1] in TrigTime.dow2int:
+                self.dow = TrigTime.dow2int[match1[1]]
             elif match1[1] == "today":
-                day_offset = 0
+                self.day_offset = 0
             elif match1[1] == "tomorrow":
-                day_offset = 1
+                self.day_offset = 1
             else:
                 skip = False
         else:
             skip = False
-        if day_offset != 0:
-            now = dt.datetime(year, month, day) + dt.timedelta(days=day_offset)
-            year = now.year
-            month = now.month
-            day = now.day
-        else:
-            now = dt.datetime(year, month, day)
         if skip:
             i = dt_str.find(" ")
-            if i >= 0:
-                dt_str = dt_str[i + 1 :].strip()
-            else:
-                return now
+            if i < 0:
+                return
+            dt_str = dt_str[i + 1 :].strip()
 
         #
         # parse the time
@@ -315,198 +594,639 @@ class TrigTime:
         match0 = re.split(r"0*(\d+):0*(\d+)(?::0*(\d*\.?\d+(?:[eE][-+]?\d+)?))?", dt_str)
         if len(match0) == 5:
             if match0[3] is not None:
-                hour, mins, sec = int(match0[1]), int(match0[2]), float(match0[3])
+                self.time = int(match0[1]), int(match0[2]), float(match0[3])
             else:
-                hour, mins, sec = int(match0[1]), int(match0[2]), 0
+                self.time = int(match0[1]), int(match0[2]), 0
         elif dt_str.startswith("sunrise") or dt_str.startswith("sunset"):
-            location = sun.get_astral_location(cls.hass)
-            try:
-                if dt_str.startswith("sunrise"):
-                    time_sun = location.sunrise(dt.date(year, month, day))
-                else:
-                    time_sun = location.sunset(dt.date(year, month, day))
-            except Exception:
-                _LOGGER.warning("'%s' not defined at this latitude", dt_str)
-                # return something in the past so it is ignored
-                return now - dt.timedelta(days=100)
-            now += time_sun.date() - now.date()
-            hour, mins, sec = time_sun.hour, time_sun.minute, time_sun.second
+            self.sun = "sunrise" if dt_str.startswith("sunrise") else "sunset"
+            self.sun_str = dt_str
         elif dt_str.startswith("noon"):
-            hour, mins, sec = 12, 0, 0
+            self.time = 12, 0, 0
         elif dt_str.startswith("midnight"):
-            hour, mins, sec = 0, 0, 0
+            self.time = 0, 0, 0
         else:
-            hour, mins, sec = 0, 0, 0
             skip = False
-        now += dt.timedelta(seconds=sec + 60 * (mins + 60 * hour))
         if skip:
             i = dt_str.find(" ")
-            if i >= 0:
-                dt_str = dt_str[i + 1 :].strip()
-            else:
-                return now
+            if i < 0:
+                return
+            dt_str = dt_str[i + 1 :].strip()
+
         #
         # parse the offset
         #
         if len(dt_str) > 0 and (dt_str[0] == "+" or dt_str[0] == "-"):
-            now = now + dt.timedelta(seconds=parse_time_offset(dt_str))
+            self.offset = dt.timedelta(seconds=parse_time_offset(dt_str))
+
+    def resolve(self, day_offset, now):
+        """Return the datetime relative to now, with day_offset days added unless the date is explicit.
+
+        The result only depends on the date of now, so it's cached for each date and day_offset.
+        """
+        key = (now.date(), day_offset)
+        if self.resolve_cache_gen == TrigTime.config_gen:
+            if key in self.resolve_cache:
+                return self.resolve_cache[key]
+            if len(self.resolve_cache) >= 8:
+                self.resolve_cache = {}
+        else:
+            self.resolve_cache = {}
+            self.resolve_cache_gen = TrigTime.config_gen
+        self.resolve_cache[key] = value = self.resolve_date(day_offset, now)
+        return value
+
+    def resolve_date(self, day_offset, now):
+        """Return the datetime relative to now without caching."""
+        year, month, day = now.year, now.month, now.day
+        if self.date:
+            if self.date[0] is not None:
+                year = self.date[0]
+            month, day = self.date[1], self.date[2]
+            day_offset = 0  # explicit date means no offset
+        elif self.dow is not None:
+            today = now.isoweekday() % 7
+            day_offset = self.dow - today if self.dow >= today else 7 + self.dow - today
+        elif self.day_offset is not None:
+            day_offset = self.day_offset
+        now = dt.datetime(year, month, day)
+        if day_offset != 0:
+            now += dt.timedelta(days=day_offset)
+
+        if self.sun:
+            time_sun = TrigTime.sun_time(self.sun, now.date())
+            if time_sun is None:
+                _LOGGER.warning("'%s' not defined at this latitude", self.sun_str)
+                # return something in the past so it is ignored
+                return now - dt.timedelta(days=100)
+            now += time_sun.date() - now.date()
+            now += dt.timedelta(seconds=time_sun.second + 60 * (time_sun.minute + 60 * time_sun.hour))
+        elif self.time:
+            hour, mins, sec = self.time
+            now += dt.timedelta(seconds=sec + 60 * (mins + 60 * hour))
+        if self.offset:
+            now += self.offset
         return now
 
+
+class TimeSpec:
+    """Parsed time_trigger or time_active specification."""
+
+    def __init__(self, spec, negate=False):
+        """Initialize time spec."""
+        self.spec = spec
+        self.negate = negate
+
+    def next_after(self, now):
+        """Return the next trigger time after now, or None if there isn't one."""
+        raise NotImplementedError(f"{self.spec} can't be used in time_trigger")
+
+    def contains(self, now):
+        """Return whether now is active."""
+        raise NotImplementedError(f"{self.spec} can't be used in time_active")
+
+
+class TimeSpecCron(TimeSpec):
+    """Time spec cron(expr)."""
+
+    def __init__(self, spec, cron_expr, negate=False):
+        """Initialize and check the cron expression."""
+        super().__init__(spec, negate=negate)
+        if not croniter.is_valid(cron_expr):
+            raise ValueError(f"Invalid cron expression: {cron_expr}")
+        self.cron_expr = cron_expr
+
+    def next_after(self, now):
+        """Return the next time the cron expression matches."""
+        return croniter(self.cron_expr, now, dt.datetime).get_next()
+
+    def contains(self, now):
+        """Return whether the cron expression matches now."""
+        return croniter.match(self.cron_expr, now)
+
+
+class TimeSpecOnce(TimeSpec):
+    """Time spec once(date_time)."""
+
+    def __init__(self, spec, date_time_str):
+        """Initialize and parse the date time."""
+        super().__init__(spec)
+        self.date_time = DateTimeSpec(date_time_str)
+
+    def next_after(self, now):
+        """Return the next time today or tomorrow, unless the date is explicit."""
+        this_t = self.date_time.resolve(0, now)
+        if this_t <= now:
+            #
+            # Try tomorrow (won't make a difference if spec has full date)
+            #
+            this_t = self.date_time.resolve(1, now)
+        return this_t if now < this_t else None
+
+
+class TimeSpecPeriod(TimeSpec):
+    """Time spec period(start, period) or period(start, period, end)."""
+
+    def __init__(self, spec, start_str, period_str, end_str=None):
+        """Initialize and parse the start, period and end."""
+        super().__init__(spec)
+        self.start = DateTimeSpec(start_str)
+        self.period = parse_time_offset(period_str.strip())
+        if self.period <= 0:
+            raise ValueError(f"Invalid non-positive period {self.period} in period(): {spec}")
+        self.end = None if end_str is None else DateTimeSpec(end_str)
+
+    def next_after(self, now):
+        """Return the next multiple of the period after start that is after now, and before end."""
+        period = self.period
+        start = self.start.resolve(0, now)
+        if self.end is None:
+            if now < start:
+                return start
+            secs = period * (1.0 + math.floor((now - start).total_seconds() / period))
+            this_t = start + dt.timedelta(seconds=secs)
+            return this_t if now < this_t else None
+
+        end = self.end.resolve(0, now)
+        end_offset = 1 if end < start else 0
+        for day in [-1, 0, 1]:
+            start = self.start.resolve(day, now)
+            end = self.end.resolve(day + end_offset, now)
+            if now < start:
+                return start
+            secs = period * (1.0 + math.floor((now - start).total_seconds() / period))
+            this_t = start + dt.timedelta(seconds=secs)
+            if start <= this_t <= end:
+                return this_t
+        return None
+
+
+class TimeSpecRange(TimeSpec):
+    """Time spec range(start, end), only used with time_active."""
+
+    def __init__(self, spec, start_str, end_str, negate=False):
+        """Initialize and parse the start and end."""
+        super().__init__(spec, negate=negate)
+        self.start = DateTimeSpec(start_str)
+        self.end = DateTimeSpec(end_str)
+
+    def contains(self, now):
+        """Return whether now is between start and end, which could span midnight."""
+        start = self.start.resolve(0, now)
+        end = self.end.resolve(0, start)
+        if start < end:
+            return start <= now <= end
+        # Over midnight
+        return now >= start or now <= end
+
+
+class NotifyQueue(asyncio.Queue):
+    """Queue of trigger notifications, with an optional size limit and a policy for when it's full.
+
+    The policies are "block" (notifications wait until there's room), "drop_oldest" (the
+    oldest notification is dropped), and "latest" (the oldest notification is dropped,
+    and a state notification replaces any queued one for the same state variable).
+    """
+
+    POLICIES = {"block", "drop_oldest", "latest"}
+
+    def __init__(self, name, size=None, policy=None):
+        """Initialize queue, checking the size and policy."""
+        if policy is None:
+            policy = "block" if size is None else "drop_oldest"
+        if policy not in self.POLICIES:
+            raise ValueError(
+                f"queue policy should be one of {', '.join(sorted(self.POLICIES))}, not {policy!r}"
+            )
+        if size is not None and (not isinstance(size, int) or isinstance(size, bool) or size <= 0):
+            raise ValueError(f"queue size should be a positive integer, not {size!r}")
+        if policy == "block" and size is not None:
+            super().__init__(size)
+        else:
+            #
+            # unbounded; the other policies drop notifications in _put() instead
+            #
+            super().__init__(0)
+        self.name = name
+        self.size = size or 0
+        self.policy = policy
+        self.num_dropped = 0
+        self.num_coalesced = 0
+
+    def _init(self, maxsize):
+        self._queue = collections.deque()
+        self.latest = {}
+
+    def _put(self, item):
+        if self.policy == "latest" and item[0] == "state":
+            var_name = item[1][1].get("var_name")
+            queued = self.latest.get(var_name)
+            if queued is not None:
+                queued[1] = item[1]
+                self.num_coalesced += 1
+                return
+            self.latest[var_name] = item
+        if self.policy != "block" and 0 < self.size <= len(self._queue):
+            self.forget(self._queue.popleft())
+            self.num_dropped += 1
+            if self.num_dropped & (self.num_dropped - 1) == 0:
+                _LOGGER.warning(
+                    "trigger %s queue is full; %d notifications dropped so far", self.name, self.num_dropped
+                )
+        self._queue.append(item)
+
+    def _get(self):
+        item = self._queue.popleft()
+        self.forget(item)
+        return item
+
+    def forget(self, item):
+        """Remove item from the latest state notifications, since it's no longer queued."""
+        if self.latest and item[0] == "state":
+            var_name = item[1][1].get("var_name")
+            if self.latest.get(var_name) is item:
+                del self.latest[var_name]
+
+
+class TrigWatch:
+    """Asynchronous iterator over state variable changes and events, used by task.watch()."""
+
+    def __init__(self, ast_ctx, timeout=None, queue_size=None, queue_policy=None):
+        """Initialize watcher with no triggers."""
+        self.ast_ctx = ast_ctx
+        self.notify_q = NotifyQueue(ast_ctx.name, size=queue_size, policy=queue_policy)
+        self.state_trig_ident = set()
+        self.state_trig_ident_any = set()
+        self.state_trig_eval = None
+        self.event_trigger = None
+        self.event_trig_expr = None
+        self.timeout = timeout
+        self.timer = None
+        self.running = False
+
     @classmethod
-    def timer_active_check(cls, time_spec, now):
-        """Check if the given time matches the time specification."""
-        results = {"+": [], "-": []}
-        for entry in time_spec if isinstance(time_spec, list) else [time_spec]:
-            this_match = False
-            negate = False
-            active_str = entry.strip()
-            if active_str.startswith("not"):
-                negate = True
-                active_str = active_str.replace("not ", "")
+    async def create(
+        cls,
+        ast_ctx,
+        state_trigger=None,
+        event_trigger=None,
+        timeout=None,
+        queue_size=None,
+        queue_policy=None,
+    ):
+        """Return a watcher for the given triggers, which starts collecting changes right away.
+
+        The trigger expressions are parsed and the notifications registered once, rather
+        than on each call as with task.wait_until() in a loop.
+        """
+        if state_trigger is None and event_trigger is None:
+            raise TypeError("task.watch() needs state_trigger or event_trigger")
+        watch = cls(ast_ctx, timeout=timeout, queue_size=queue_size, queue_policy=queue_policy)
+        if state_trigger is not None:
+            (
+                watch.state_trig_ident,
+                watch.state_trig_ident_any,
+                watch.state_trig_eval,
+            ) = await TrigTime.state_trig_parse(ast_ctx, state_trigger)
+        if event_trigger is not None:
+            if isinstance(event_trigger, str):
+                event_trigger = [event_trigger]
+            watch.event_trig_expr = await TrigTime.event_trig_parse(ast_ctx, event_trigger)
+            watch.event_trigger = event_trigger
+        _LOGGER.debug(
+            "trigger %s watch: watching vars %s, event %s",
+            ast_ctx.name,
+            watch.state_trig_ident,
+            event_trigger[0] if event_trigger else None,
+        )
+        if len(watch.state_trig_ident) > 0:
+            await State.notify_add(watch.state_trig_ident, watch.notify_q)
+        if watch.event_trigger is not None:
+            Event.notify_add(watch.event_trigger[0], watch.notify_q)
+        if timeout is not None:
+            watch.timer = TrigTime.timer_add(timeout, watch.notify_q, None)
+        watch.running = True
+        return watch
 
-            cron_match = re.match(r"cron\((?P<cron_expr>.*)\)", active_str)
-            range_expr = re.match(r"range\(([^,]+),\s?([^,]+)\)", active_str)
-            if cron_match:
-                if not croniter.is_valid(cron_match.group("cron_expr")):
-                    _LOGGER.error("Invalid cron expression: %s", cron_match)
-                    return False
+    def stop(self):
+        """Stop watching for changes."""
+        if not self.running:
+            return
+        self.running = False
+        if len(self.state_trig_ident) > 0:
+            State.notify_del(self.state_trig_ident, self.notify_q)
+        if self.event_trigger is not None:
+            Event.notify_del(self.event_trigger[0], self.notify_q)
+        TrigTime.timer_cancel(self.timer)
+
+    def __aiter__(self):
+        """Return the iterator."""
+        return self
+
+    async def __anext__(self):
+        """Return the trigger information of the next change that satisfies the triggers."""
+        while self.running:
+            notify_type, notify_info = await self.notify_q.get()
+            if notify_type == "time":
+                break
+            if notify_type == "state":
+                if notify_info:
+                    new_vars, func_args = notify_info
+                else:
+                    new_vars, func_args = None, {}
+                var_name = func_args.get("var_name", "")
+                if var_name in self.state_trig_ident_any or State.wildcard_match(
+                    var_name, self.state_trig_ident_any
+                ):
+                    return func_args
+                if self.state_trig_eval:
+                    state_trig_ok = await self.state_trig_eval.eval(new_vars)
+                    exc = self.state_trig_eval.get_exception_obj()
+                    if exc is not None:
+                        self.stop()
+                        raise exc
+                    if state_trig_ok:
+                        return func_args
+            elif notify_type == "event":
+                if self.event_trig_expr is None:
+                    return notify_info
+                event_trig_ok = await self.event_trig_expr.eval(notify_info)
+                exc = self.event_trig_expr.get_exception_obj()
+                if exc is not None:
+                    self.stop()
+                    raise exc
+                if event_trig_ok:
+                    return notify_info
+        self.stop()
+        raise StopAsyncIteration
 
-                this_match = croniter.match(cron_match.group("cron_expr"), now)
+    async def aclose(self):
+        """Stop watching for changes."""
+        self.stop()
 
-            elif range_expr:
-                try:
-                    dt_start, dt_end = range_expr.groups()
-                except ValueError as exc:
-                    _LOGGER.error("Invalid range expression: %s", exc)
-                    return False
+    def __del__(self):
+        """On deletion, stop watching for changes."""
+        self.stop()
 
-                start = cls.parse_date_time(dt_start.strip(), 0, now)
-                end = cls.parse_date_time(dt_end.strip(), 0, start)
 
-                if start < end:
-                    this_match = start <= now <= end
-                else:  # Over midnight
-                    this_match = now >= start or now <= end
+class TrigStartup:
+    """Scheduler for the startup runs of trigger functions.
 
-            if negate:
-                results["-"].append(not this_match)
-            else:
-                results["+"].append(this_match)
+    When Home Assistant starts (or scripts are reloaded) every function with a startup
+    trigger wants to run at once; this lets a limited number run at a time, in priority
+    order, and records how long each one took.
+    """
 
-        # An empty spec, or only neg specs, is True
-        result = any(results["+"]) if results["+"] else True and all(results["-"])
+    #
+    # Maximum number of startup runs at the same time
+    #
+    concurrency = DEFAULT_STARTUP_CONCURRENCY
 
-        return result
+    #
+    # A startup run that's still going after this many seconds (eg, a function that
+    # loops forever) gives up its slot, so the others aren't blocked
+    #
+    slot_timeout = 10
+
+    #
+    # Heap of startup runs waiting for a slot, each a list [-priority, seq, future, name],
+    # and the number of slots in use
+    #
+    waiting = []
+    waiting_seq = itertools.count()
+    num_running = 0
+    dispatch_handle = None
+
+    #
+    # Seconds each function's last startup run took, by trigger name
+    #
+    run_times = {}
+
+    def __init__(self):
+        """Warn on TrigStartup instantiation."""
+        _LOGGER.error("TrigStartup class is not meant to be instantiated")
 
     @classmethod
-    def timer_trigger_next(cls, time_spec, now):
-        """Return the next trigger time based on the given time and time specification."""
-        next_time = None
-        if not isinstance(time_spec, list):
-            time_spec = [time_spec]
-        for spec in time_spec:
-            cron_match = re.search(r"cron\((?P<cron_expr>.*)\)", spec)
-            match1 = re.split(r"once\((.*)\)", spec)
-            match2 = re.split(r"period\(([^,]*),([^,]*)(?:,([^,]*))?\)", spec)
-            if cron_match:
-                if not croniter.is_valid(cron_match.group("cron_expr")):
-                    _LOGGER.error("Invalid cron expression: %s", cron_match)
-                    continue
+    def init(cls, concurrency=None):
+        """Initialize TrigStartup."""
+        cls.waiting = []
+        cls.num_running = 0
+        cls.dispatch_handle = None
+        cls.run_times = {}
+        cls.set_concurrency(concurrency)
 
-                val = croniter(cron_match.group("cron_expr"), now, dt.datetime).get_next()
-                if next_time is None or val < next_time:
-                    next_time = val
+    @classmethod
+    def set_concurrency(cls, concurrency):
+        """Set the number of startup runs at the same time; None sets the default."""
+        cls.concurrency = DEFAULT_STARTUP_CONCURRENCY if concurrency is None else concurrency
 
-            elif len(match1) == 3:
-                this_t = cls.parse_date_time(match1[1].strip(), 0, now)
-                if this_t <= now:
-                    #
-                    # Try tomorrow (won't make a difference if spec has full date)
-                    #
-                    this_t = cls.parse_date_time(match1[1].strip(), 1, now)
-                if now < this_t and (next_time is None or this_t < next_time):
-                    next_time = this_t
-
-            elif len(match2) == 5:
-                start_str, period_str = match2[1].strip(), match2[2].strip()
-                start = cls.parse_date_time(start_str, 0, now)
-                period = parse_time_offset(period_str)
-                if period <= 0:
-                    _LOGGER.error("Invalid non-positive period %s in period(): %s", period, time_spec)
-                    continue
+    @classmethod
+    def request(cls, name, priority=0, delay=None):
+        """Return a future whose result is a slot for a startup run of trigger name.
+
+        Runs with a higher priority get a slot first.  The slots are given out in a later
+        loop callback, so all the triggers started at the same time compete on priority.
+        """
+        loop = asyncio.get_running_loop()
+        entry = [-priority, next(cls.waiting_seq), loop.create_future(), name]
+        if delay:
+            loop.call_later(delay, cls.enqueue, entry)
+        else:
+            cls.enqueue(entry)
+        return entry[2]
 
-                if match2[3] is None:
-                    if now < start and (next_time is None or start < next_time):
-                        next_time = start
-                    if now >= start:
-                        secs = period * (1.0 + math.floor((now - start).total_seconds() / period))
-                        this_t = start + dt.timedelta(seconds=secs)
-                        if now < this_t and (next_time is None or this_t < next_time):
-                            next_time = this_t
-                    continue
-                end_str = match2[3].strip()
-                end = cls.parse_date_time(end_str, 0, now)
-                end_offset = 1 if end < start else 0
-                for day in [-1, 0, 1]:
-                    start = cls.parse_date_time(start_str, day, now)
-                    end = cls.parse_date_time(end_str, day + end_offset, now)
-                    if now < start:
-                        if next_time is None or start < next_time:
-                            next_time = start
-                        break
-                    secs = period * (1.0 + math.floor((now - start).total_seconds() / period))
-                    this_t = start + dt.timedelta(seconds=secs)
-                    if start <= this_t <= end:
-                        if next_time is None or this_t < next_time:
-                            next_time = this_t
-                        break
+    @classmethod
+    def enqueue(cls, entry):
+        """Add a startup run to the waiting heap."""
+        heapq.heappush(cls.waiting, entry)
+        if cls.dispatch_handle is None:
+            cls.dispatch_handle = asyncio.get_running_loop().call_soon(cls.dispatch)
 
-            else:
-                _LOGGER.warning("Can't parse %s in time_trigger check", spec)
-        return next_time
+    @classmethod
+    def dispatch(cls):
+        """Give free slots to the highest priority waiting runs."""
+        cls.dispatch_handle = None
+        loop = asyncio.get_running_loop()
+        while cls.waiting and cls.num_running < cls.concurrency:
+            _, _, future, name = heapq.heappop(cls.waiting)
+            if future.done():
+                continue
+            #
+            # a slot is a list [start_time, timeout_handle]; the handle is None once released
+            #
+            slot = [time.monotonic(), None]
+            slot[1] = loop.call_later(cls.slot_timeout, cls.release_timeout, slot, name)
+            cls.num_running += 1
+            future.set_result(slot)
+
+    @classmethod
+    def release(cls, slot, name=None):
+        """Release a startup slot; if name is given, record how long its run took."""
+        if name is not None:
+            secs = time.monotonic() - slot[0]
+            cls.run_times[name] = secs
+            _LOGGER.debug("trigger %s startup run took %.3f secs", name, secs)
+        if slot[1] is None:
+            return
+        slot[1].cancel()
+        slot[1] = None
+        cls.num_running -= 1
+        cls.dispatch()
+
+    @classmethod
+    def release_timeout(cls, slot, name):
+        """Release a slot whose run is taking too long, letting other runs start."""
+        _LOGGER.debug(
+            "trigger %s startup run still going after %s secs; starting other startup runs",
+            name,
+            cls.slot_timeout,
+        )
+        slot[1] = None
+        cls.num_running -= 1
+        cls.dispatch()
+
+
+class TrigExpr:
+    """Trigger expression, shared by all the triggers in a global context with the same expression.
+
+    Each trigger notification is evaluated once, and the result is given to every
+    trigger that uses the expression.
+    """
+
+    #
+    # Shared expressions by (global context, expression ast dump); an expression is
+    # dropped once no trigger uses it
+    #
+    exprs = weakref.WeakValueDictionary()
+
+    def __init__(self, ast_ctx):
+        """Initialize shared expression from its parsed AstEval."""
+        self.ast_ctx = ast_ctx
+        self.names = None
+        self.lock = asyncio.Lock()
+        self.last_notify = None
+        self.last_vars = None
+        self.last_result = None
+        self.last_exc = None
+
+    @classmethod
+    def get(cls, name, global_ctx, expr_str, logger_name=None):
+        """Return the shared expression for expr_str, or None after logging an error if it doesn't parse."""
+        ast_ctx = AstEval(name, global_ctx, logger_name=logger_name)
+        Function.install_ast_funcs(ast_ctx)
+        if not ast_ctx.parse(expr_str):
+            ast_ctx.get_logger().error(ast_ctx.get_exception_long())
+            return None
+        #
+        # the ast dump ignores formatting, so equivalent expressions are shared too
+        #
+        key = (id(global_ctx), ast.dump(ast_ctx.ast))
+        expr = cls.exprs.get(key)
+        if expr is None:
+            expr = cls(ast_ctx)
+            cls.exprs[key] = expr
+        return expr
+
+    async def get_names(self):
+        """Return the names used in the expression."""
+        if self.names is None:
+            self.names = await self.ast_ctx.get_names()
+        return self.names
+
+    async def eval(self, new_vars, notify_info=None, logger=None):
+        """Evaluate the expression for the trigger notification notify_info, returning False on exceptions.
+
+        If the last evaluation was for the same notification (eg, the same state change
+        delivered to another trigger) and the same variable values, its result is reused.
+        Exceptions are logged to logger, the calling trigger's, even when the result is
+        reused, so each trigger sharing the expression reports them.
+        """
+        if logger is None:
+            logger = self.ast_ctx.get_logger()
+        async with self.lock:
+            expr_vars = {name: new_vars[name] for name in await self.get_names() if name in new_vars}
+            if notify_info is None or notify_info is not self.last_notify or expr_vars != self.last_vars:
+                result = await self.ast_ctx.eval(new_vars)
+                self.last_exc = self.ast_ctx.get_exception_long()
+                if self.last_exc is not None:
+                    result = False
+                self.last_notify, self.last_vars, self.last_result = notify_info, expr_vars, result
+            if self.last_exc is not None:
+                logger.error(self.last_exc)
+            return self.last_result
 
 
 class TrigInfo:
     """Class for all trigger-decorated functions."""
 
+    #
+    # maximum number of idle action contexts kept for reuse by each trigger
+    #
+    action_ctx_pool_max = 8
+
     def __init__(
         self, name, trig_cfg, global_ctx=None,
     ):
         """Create a new TrigInfo."""
         self.name = name
+        self.logger = logging.getLogger(LOGGER_PATH + "." + name)
         self.task = None
         self.global_ctx = global_ctx
         self.trig_cfg = trig_cfg
         self.state_trigger = trig_cfg.get("state_trigger", {}).get("args", None)
         self.time_trigger = trig_cfg.get("time_trigger", {}).get("args", None)
         self.event_trigger = trig_cfg.get("event_trigger", {}).get("args", None)
+        self.event_trigger_kwargs = trig_cfg.get("event_trigger", {}).get("kwargs", None)
         self.state_active = trig_cfg.get("state_active", {}).get("args", None)
         self.time_active = trig_cfg.get("time_active", {}).get("args", None)
         self.task_unique = trig_cfg.get("task_unique", {}).get("args", None)
         self.task_unique_kwargs = trig_cfg.get("task_unique", {}).get("kwargs", None)
+        self.task_limit = trig_cfg.get("task_limit", {}).get("args", None)
+        self.task_limit_kwargs = trig_cfg.get("task_limit", {}).get("kwargs", None) or {}
+        self.task_limit_queue = self.task_limit_kwargs.get("queue", "fifo")
+        self.trigger_queue_kwargs = trig_cfg.get("trigger_queue", {}).get("kwargs", None)
+        self.state_trigger_kwargs = trig_cfg.get("state_trigger", {}).get("kwargs", None) or {}
         self.action = trig_cfg.get("action")
         self.global_sym_table = trig_cfg.get("global_sym_table", {})
-        self.notify_q = asyncio.Queue(0)
+        self.notify_q = NotifyQueue(self.name)
+        self.timer = None
+        self.action_ctx_pool = []
         self.active_expr = None
         self.state_active_ident = None
         self.state_trig_expr = None
-        self.state_trig_eval = None
+        self.state_trig_terms = []
+        self.state_trig_term_vars = []
+        self.state_trig_term_vals = []
         self.state_trig_ident = None
         self.state_trig_ident_any = set()
+        self.state_debounce = None
+        self.state_throttle = None
+        self.state_hold = None
+        self.state_delay_timer = None
+        self.state_fire_last = None
         self.event_trig_expr = None
+        self.event_trig_filter = None
         self.have_trigger = False
         self.setup_ok = False
         self.run_on_startup = False
+        self.startup_priority = 0
+        self.startup_delay = None
+        self.startup_future = None
+        self.startup_slot = None
+        self.task_limit_running = 0
+        self.task_limit_pending = collections.deque()
+        self.task_limit_stats = {
+            "queued": 0,
+            "coalesced": 0,
+            "dropped": 0,
+            "wait_total": 0.0,
+            "wait_max": 0.0,
+        }
 
         if self.state_active is not None:
-            self.active_expr = AstEval(
-                f"{self.name} @state_active()", self.global_ctx, logger_name=self.name
+            self.active_expr = TrigExpr.get(
+                f"{self.name} @state_active()", self.global_ctx, self.state_active, logger_name=self.name
             )
-            Function.install_ast_funcs(self.active_expr)
-            self.active_expr.parse(self.state_active)
-            exc = self.active_expr.get_exception_long()
-            if exc is not None:
-                self.active_expr.get_logger().error(exc)
+            if self.active_expr is None:
                 return
 
         if self.time_trigger is not None:
@@ -518,6 +1238,55 @@ class TrigInfo:
         if "time_trigger" in trig_cfg and self.time_trigger is None:
             self.run_on_startup = True
 
+        #
+        # parse the time specs and queue settings once now, so errors are reported when the
+        # function is defined
+        #
+        try:
+            if self.trigger_queue_kwargs:
+                self.notify_q = NotifyQueue(
+                    self.name,
+                    size=self.trigger_queue_kwargs.get("size"),
+                    policy=self.trigger_queue_kwargs.get("policy"),
+                )
+            if self.time_trigger is not None:
+                self.time_trigger = TrigTime.time_spec_parse_list(self.time_trigger)
+            if self.time_active is not None:
+                self.time_active = TrigTime.time_spec_parse_list(self.time_active, active=True)
+            for kwarg in ("debounce", "throttle", "hold"):
+                secs = self.state_trigger_kwargs.get(kwarg)
+                if secs is None:
+                    continue
+                if not isinstance(secs, (int, float)) or isinstance(secs, bool) or secs < 0:
+                    raise ValueError(
+                        f"@state_trigger {kwarg} should be a number of seconds >= 0, not {secs!r}"
+                    )
+                setattr(self, f"state_{kwarg}", secs)
+            if self.state_debounce is not None and self.state_hold is not None:
+                raise ValueError("@state_trigger can't use both debounce and hold")
+            if self.task_limit is not None and self.task_limit < 1:
+                raise ValueError(f"@task_limit should be at least 1, not {self.task_limit}")
+            if self.task_limit_queue not in ("fifo", "latest", "drop"):
+                raise ValueError(
+                    f"@task_limit queue should be one of drop, fifo, latest, not {self.task_limit_queue!r}"
+                )
+            time_trigger_kwargs = trig_cfg.get("time_trigger", {}).get("kwargs", None) or {}
+            for kwarg, min_val in (("startup_priority", None), ("startup_delay", 0)):
+                val = time_trigger_kwargs.get(kwarg)
+                if val is None:
+                    continue
+                if (
+                    not isinstance(val, (int, float))
+                    or isinstance(val, bool)
+                    or (min_val is not None and val < min_val)
+                ):
+                    raise ValueError(f"@time_trigger {kwarg} should be a number, not {val!r}")
+                setattr(self, kwarg, val)
+            self.event_trig_filter = Event.filter_parse(self.event_trigger_kwargs)
+        except ValueError as exc:
+            self.logger.error("%s: %s", self.name, exc)
+            return
+
         if self.state_trigger is not None:
             state_trig = []
             for triggers in self.state_trigger:
@@ -530,7 +1299,7 @@ class TrigInfo:
                 # on any change (no expr)
                 #
                 for trig in triggers:
-                    if STATE_RE.match(trig):
+                    if STATE_RE.match(trig) or STATE_WILDCARD_RE.match(trig):
                         self.state_trig_ident_any.add(trig)
                     else:
                         state_trig.append(trig)
@@ -540,15 +1309,27 @@ class TrigInfo:
                     self.state_trig_expr = state_trig[0]
                 else:
                     self.state_trig_expr = f"any([{', '.join(state_trig)}])"
-                self.state_trig_eval = AstEval(
-                    f"{self.name} @state_trigger()", self.global_ctx, logger_name=self.name
+                #
+                # each term is shared with other triggers using the same expression;
+                # the trigger is true if any of them are
+                #
+                for trig in state_trig:
+                    term = TrigExpr.get(
+                        f"{self.name} @state_trigger()", self.global_ctx, trig, logger_name=self.name
+                    )
+                    if term is None:
+                        return
+                    self.state_trig_terms.append(term)
+            if self.state_hold is not None and self.state_trig_ident_any:
+                #
+                # a bare state variable name is true on every change, so it never stops holding
+                #
+                self.logger.error(
+                    "%s: @state_trigger hold needs expressions, not state variable names %s",
+                    self.name,
+                    ", ".join(sorted(self.state_trig_ident_any)),
                 )
-                Function.install_ast_funcs(self.state_trig_eval)
-                self.state_trig_eval.parse(self.state_trig_expr)
-                exc = self.state_trig_eval.get_exception_long()
-                if exc is not None:
-                    self.state_trig_eval.get_logger().error(exc)
-                    return
+                return
             self.have_trigger = True
 
         if self.event_trigger is not None:
@@ -570,6 +1351,15 @@ class TrigInfo:
         """Stop this trigger task."""
 
         if self.task:
+            self.startup_release()
+            TrigTime.timer_cancel(self.state_delay_timer)
+            #
+            # queued @task_limit actions won't run, so they count as dropped
+            #
+            while self.task_limit_pending:
+                _, _, ast_ctx = self.task_limit_pending.popleft()
+                self.action_ctx_put(ast_ctx)
+                self.task_limit_stats["dropped"] += 1
             if self.state_trig_ident:
                 State.notify_del(self.state_trig_ident, self.notify_q)
             if self.event_trigger is not None:
@@ -577,9 +1367,121 @@ class TrigInfo:
             if self.task:
                 Function.task_cancel(self.task)
 
+    async def state_trig_check(self, new_vars, func_args):
+        """Return whether any of the state trigger terms is true after a state variable change.
+
+        Only the terms that read the changed variable (or no state variables at all) are
+        evaluated; the others use their value from when they were last evaluated.  Once
+        a term is true, the remaining terms that need evaluating are just marked as unknown.
+        """
+        var_name = func_args["var_name"]
+        term_vals = self.state_trig_term_vals
+        trig_ok = False
+        for i, term in enumerate(self.state_trig_terms):
+            term_vars = self.state_trig_term_vars[i]
+            if term_vals[i] is None or var_name in term_vars or not term_vars:
+                if trig_ok:
+                    term_vals[i] = None
+                    continue
+                term_vals[i] = bool(await term.eval(new_vars, func_args, self.logger))
+            if term_vals[i]:
+                trig_ok = True
+        return trig_ok
+
+    def action_ctx_get(self):
+        """Return an action context, reusing an idle one if available."""
+        if self.action_ctx_pool:
+            return self.action_ctx_pool.pop()
+        ast_ctx = AstEval(f"{self.action.global_ctx_name}.{self.action.name}", self.action.global_ctx)
+        Function.install_ast_funcs(ast_ctx)
+        return ast_ctx
+
+    def action_ctx_put(self, ast_ctx):
+        """Return an action context to the pool once its action has finished."""
+        #
+        # only a context that finished cleanly (not in a function or using another
+        # global context) is reused
+        #
+        if (
+            len(self.action_ctx_pool) < self.action_ctx_pool_max
+            and ast_ctx.curr_func is None
+            and not ast_ctx.sym_table_stack
+            and ast_ctx.global_ctx is self.action.global_ctx
+        ):
+            ast_ctx.reset()
+            self.action_ctx_pool.append(ast_ctx)
+
+    def action_start(self, action_call, ast_ctx):
+        """Start an action task, or with @task_limit, queue it if enough are already running."""
+        if self.task_limit is None or self.task_limit_running < self.task_limit:
+            self.action_task_create(action_call, None)
+            return
+        stats = self.task_limit_stats
+        if self.task_limit_queue == "drop":
+            _LOGGER.debug(
+                "trigger %s: %d actions running; @task_limit dropped new action", self.name, self.task_limit
+            )
+            stats["dropped"] += 1
+            self.action_ctx_put(ast_ctx)
+            return
+        if self.task_limit_queue == "latest" and self.task_limit_pending:
+            #
+            # replace the queued action with this one, which has the more recent trigger
+            #
+            time_queued, _, old_ast_ctx = self.task_limit_pending.pop()
+            self.action_ctx_put(old_ast_ctx)
+            stats["coalesced"] += 1
+        else:
+            time_queued = time.monotonic()
+            stats["queued"] += 1
+        self.task_limit_pending.append((time_queued, action_call, ast_ctx))
+
+    def action_task_create(self, action_call, time_queued):
+        """Create a task to run an action, counting it against @task_limit."""
+        if self.task_limit is None:
+            Function.create_task(action_call())
+            return
+        self.task_limit_running += 1
+        if time_queued is not None:
+            wait = time.monotonic() - time_queued
+            self.task_limit_stats["wait_total"] += wait
+            self.task_limit_stats["wait_max"] = max(self.task_limit_stats["wait_max"], wait)
+            _LOGGER.debug("trigger %s: action waited %.3f secs for @task_limit", self.name, wait)
+
+        async def action_run():
+            try:
+                await action_call()
+            finally:
+                self.action_task_done()
+
+        Function.create_task(action_run())
+
+    def action_task_done(self):
+        """Note that a @task_limit action finished, and start the next queued one."""
+        self.task_limit_running -= 1
+        if self.task_limit_pending and self.task_limit_running < self.task_limit:
+            time_queued, action_call, _ = self.task_limit_pending.popleft()
+            self.action_task_create(action_call, time_queued)
+
+    def startup_release(self):
+        """Give up any startup slot this trigger has, or is waiting for."""
+        if self.startup_future is not None:
+            if self.startup_future.done() and not self.startup_future.cancelled():
+                TrigStartup.release(self.startup_future.result())
+            else:
+                self.startup_future.cancel()
+            self.startup_future = None
+        if self.startup_slot is not None:
+            TrigStartup.release(self.startup_slot)
+            self.startup_slot = None
+
     def start(self):
         """Start this trigger task."""
         if not self.task and self.setup_ok:
+            if self.run_on_startup:
+                self.startup_future = TrigStartup.request(
+                    self.name, self.startup_priority, self.startup_delay
+                )
             self.task = Function.create_task(self.trigger_watch())
             _LOGGER.debug("trigger %s is active", self.name)
 
@@ -590,8 +1492,17 @@ class TrigInfo:
 
             if self.state_trigger is not None:
                 self.state_trig_ident = set()
-                if self.state_trig_eval:
-                    self.state_trig_ident = await self.state_trig_eval.get_names()
+                for term in self.state_trig_terms:
+                    names = await term.get_names()
+                    self.state_trig_ident.update(names)
+                    #
+                    # remember which state variables each term reads, so it's only
+                    # re-evaluated when one of them changes
+                    #
+                    self.state_trig_term_vars.append(
+                        {".".join(name.split(".")[0:2]) for name in names if 1 <= name.count(".") <= 2}
+                    )
+                self.state_trig_term_vals = [None] * len(self.state_trig_terms)
                 self.state_trig_ident.update(self.state_trig_ident_any)
                 _LOGGER.debug("trigger %s: watching vars %s", self.name, self.state_trig_ident)
                 if len(self.state_trig_ident) > 0:
@@ -602,7 +1513,7 @@ class TrigInfo:
 
             if self.event_trigger is not None:
                 _LOGGER.debug("trigger %s adding event_trigger %s", self.name, self.event_trigger[0])
-                Event.notify_add(self.event_trigger[0], self.notify_q)
+                Event.notify_add(self.event_trigger[0], self.notify_q, self.event_trig_filter)
 
             while True:
                 timeout = None
@@ -610,8 +1521,12 @@ class TrigInfo:
                 notify_type = None
                 if self.run_on_startup:
                     #
-                    # first time only - skip waiting for other triggers
+                    # first time only - skip waiting for other triggers, but wait for a
+                    # startup slot
                     #
+                    if self.startup_future is not None:
+                        self.startup_slot = await self.startup_future
+                        self.startup_future = None
                     notify_info = {"trigger_type": "time", "trigger_time": None}
                     self.run_on_startup = False
                 else:
@@ -624,16 +1539,14 @@ class TrigInfo:
                         if time_next is not None:
                             timeout = (time_next - now).total_seconds()
                     if timeout is not None:
+                        _LOGGER.debug("trigger %s waiting for %s secs", self.name, timeout)
+                        self.timer = TrigTime.timer_add(
+                            timeout, self.notify_q, {"trigger_type": "time", "trigger_time": time_next},
+                        )
                         try:
-                            _LOGGER.debug("trigger %s waiting for %s secs", self.name, timeout)
-                            notify_type, notify_info = await asyncio.wait_for(
-                                self.notify_q.get(), timeout=timeout
-                            )
-                        except asyncio.TimeoutError:
-                            notify_info = {
-                                "trigger_type": "time",
-                                "trigger_time": time_next,
-                            }
+                            notify_type, notify_info = await self.notify_q.get()
+                        finally:
+                            TrigTime.timer_cancel(self.timer)
                     elif self.have_trigger:
                         _LOGGER.debug("trigger %s waiting for state change or event", self.name)
                         notify_type, notify_info = await self.notify_q.get()
@@ -649,15 +1562,37 @@ class TrigInfo:
                 if notify_type == "state":
                     new_vars, func_args = notify_info
 
-                    if func_args["var_name"] not in self.state_trig_ident_any:
-                        if self.state_trig_eval:
-                            trig_ok = await self.state_trig_eval.eval(new_vars)
-                            exc = self.state_trig_eval.get_exception_long()
-                            if exc is not None:
-                                self.state_trig_eval.get_logger().error(exc)
-                                trig_ok = False
-                        else:
-                            trig_ok = False
+                    var_name = func_args["var_name"]
+                    if var_name not in self.state_trig_ident_any and not State.wildcard_match(
+                        var_name, self.state_trig_ident_any
+                    ):
+                        trig_ok = await self.state_trig_check(new_vars, func_args)
+
+                    if self.state_debounce is not None or self.state_hold is not None:
+                        #
+                        # with debounce, each true trigger restarts the timer; with hold, the
+                        # timer starts when the trigger becomes true and is canceled if it
+                        # becomes false.  The action only runs when the timer fires, as a
+                        # "state_delay" notification.
+                        #
+                        if trig_ok and (self.state_debounce is not None or self.state_delay_timer is None):
+                            TrigTime.timer_cancel(self.state_delay_timer)
+                            self.state_delay_timer = TrigTime.timer_add(
+                                self.state_debounce if self.state_hold is None else self.state_hold,
+                                self.notify_q,
+                                notify_info,
+                                notify_type="state_delay",
+                            )
+                        elif not trig_ok and self.state_hold is not None:
+                            TrigTime.timer_cancel(self.state_delay_timer)
+                            self.state_delay_timer = None
+                        continue
+
+                elif notify_type == "state_delay":
+                    new_vars, func_args = notify_info
+                    notify_type = "state"
+                    if self.state_hold is None:
+                        self.state_delay_timer = None
 
                 elif notify_type == "event":
                     func_args = notify_info
@@ -672,24 +1607,24 @@ class TrigInfo:
                 #
                 if trig_ok and self.active_expr:
                     active_vars = State.notify_var_get(self.state_active_ident, new_vars)
-                    trig_ok = await self.active_expr.eval(active_vars)
-                    exc = self.active_expr.get_exception_long()
-                    if exc is not None:
-                        self.active_expr.get_logger().error(exc)
-                        trig_ok = False
+                    trig_ok = await self.active_expr.eval(active_vars, func_args, self.logger)
                 if trig_ok and self.time_active:
                     trig_ok = TrigTime.timer_active_check(self.time_active, dt_now())
+                if trig_ok and self.state_throttle is not None and notify_type == "state":
+                    now = asyncio.get_running_loop().time()
+                    if self.state_fire_last is not None and now - self.state_fire_last < self.state_throttle:
+                        _LOGGER.debug("trigger %s got state trigger, but throttled", self.name)
+                        continue
+                    self.state_fire_last = now
 
                 if not trig_ok:
                     _LOGGER.debug(
                         "trigger %s got %s trigger, but not active", self.name, notify_type,
                     )
+                    self.startup_release()
                     continue
 
-                action_ast_ctx = AstEval(
-                    f"{self.action.global_ctx_name}.{self.action.name}", self.action.global_ctx
-                )
-                Function.install_ast_funcs(action_ast_ctx)
+                action_ast_ctx = self.action_ctx_get()
                 task_unique_func = None
                 if self.task_unique is not None:
                     task_unique_func = Function.task_unique_factory(action_ast_ctx)
@@ -708,6 +1643,8 @@ class TrigInfo:
                         notify_type,
                         self.name,
                     )
+                    self.action_ctx_put(action_ast_ctx)
+                    self.startup_release()
                     continue
 
                 _LOGGER.debug(
@@ -717,24 +1654,39 @@ class TrigInfo:
                     func_args,
                 )
 
-                async def do_func_call(func, ast_ctx, task_unique, task_unique_func, **kwargs):
-                    if task_unique and task_unique_func:
-                        await task_unique_func(task_unique)
-                    await func.call(ast_ctx, **kwargs)
-                    if ast_ctx.get_exception_obj():
-                        ast_ctx.get_logger().error(ast_ctx.get_exception_long())
-
-                Function.create_task(
-                    do_func_call(
-                        self.action, action_ast_ctx, self.task_unique, task_unique_func, **func_args
-                    )
+                async def do_func_call(func, ast_ctx, task_unique, task_unique_func, startup_slot, **kwargs):
+                    try:
+                        if task_unique and task_unique_func:
+                            await task_unique_func(task_unique)
+                        await func.call(ast_ctx, **kwargs)
+                        if ast_ctx.get_exception_obj():
+                            ast_ctx.get_logger().error(ast_ctx.get_exception_long())
+                        self.action_ctx_put(ast_ctx)
+                    finally:
+                        if startup_slot is not None:
+                            TrigStartup.release(startup_slot, self.name)
+
+                self.action_start(
+                    functools.partial(
+                        do_func_call,
+                        self.action,
+                        action_ast_ctx,
+                        self.task_unique,
+                        task_unique_func,
+                        self.startup_slot,
+                        **func_args,
+                    ),
+                    action_ast_ctx,
                 )
+                self.startup_slot = None
 
         except asyncio.CancelledError:
             raise
 
         except Exception:
             # _LOGGER.error(f"{self.name}: " + traceback.format_exc(-1))
+            self.startup_release()
+            TrigTime.timer_cancel(self.state_delay_timer)
             if self.state_trig_ident:
                 State.notify_del(self.state_trig_ident, self.notify_q)
             if self.event_trigger is not None:
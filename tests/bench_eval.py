@@ -0,0 +1,203 @@
+"""Benchmarks for the Python interpreter.
+
+These aren't run as part of the regular tests; run them with:
+
+    pytest tests/bench_eval.py -s
+"""
+
+import time
+
+from custom_components.pyscript.const import CONF_ALLOW_ALL_IMPORTS, DOMAIN
+from custom_components.pyscript.eval import AstEval
+from custom_components.pyscript.function import Function
+from custom_components.pyscript.global_ctx import GlobalContext, GlobalContextMgr
+from custom_components.pyscript.state import State
+from custom_components.pyscript.trigger import TrigInfo, TrigTime
+from pytest_homeassistant_custom_component.common import MockConfigEntry
+
+benchPrograms = [
+    [
+        "while loop",
+        """
+i = 0
+total = 0
+while i < 10000:
+    total += i * 2 + 1
+    i += 1
+total
+""",
+    ],
+    [
+        "for loop",
+        """
+total = 0
+for i in range(10000):
+    if i % 3 == 0 or i % 5 == 0:
+        total = total + i
+total
+""",
+    ],
+    [
+        "expressions",
+        """
+i = 0
+count = 0
+while i < 10000:
+    if float(i) * 2 > 50 and i % 7 in [0, 3] or abs(i - 500) < 10:
+        count += 1
+    i += 1
+count
+""",
+    ],
+    [
+        "list comprehension",
+        """
+x = [i * i for i in range(10000) if i % 2 == 0]
+len(x)
+""",
+    ],
+    [
+        "function locals",
+        """
+def func(n):
+    total = 0
+    for i in range(n):
+        total += abs(i - 5) + len(str(i)) + i % 7
+    return total
+func(10000)
+""",
+    ],
+    [
+        "function calls",
+        """
+def add(a, b):
+    return a + b
+total = 0
+for i in range(5000):
+    total = add(total, i)
+total
+""",
+    ],
+]
+
+
+async def run_bench(source, compile_ast, repeat=3):
+    """Return the best time and result of evaluating source."""
+    best, result = None, None
+    for _ in range(repeat):
+        global_ctx = GlobalContext("bench", global_sym_table={}, manager=GlobalContextMgr)
+        ast_ctx = AstEval("bench", global_ctx=global_ctx)
+        ast_ctx.parse(source, compile_ast=compile_ast)
+        time0 = time.perf_counter()
+        result = await ast_ctx.eval()
+        elapsed = time.perf_counter() - time0
+        assert ast_ctx.get_exception() is None
+        if best is None or elapsed < best:
+            best = elapsed
+    return best, result
+
+
+async def test_bench_compile(hass):
+    """Compare interpreting the AST with running the compiled closures."""
+    hass.data[DOMAIN] = MockConfigEntry(domain=DOMAIN, data={CONF_ALLOW_ALL_IMPORTS: False})
+    Function.init(hass)
+    State.init(hass)
+    State.register_functions()
+
+    print()
+    for name, source in benchPrograms:
+        time_interp, result_interp = await run_bench(source, False)
+        time_compile, result_compile = await run_bench(source, True)
+        assert result_interp == result_compile
+        print(
+            f"{name:>20s}: interpreted {time_interp * 1000:8.1f} ms, compiled {time_compile * 1000:8.1f} ms, "
+            f"speedup {time_interp / time_compile:5.2f}x"
+        )
+
+
+bindCalls = [
+    ["positional", "def func(a, b, c):\n    pass", (1, 2, 3), {}],
+    ["positional, defaults", "def func(a, b=2, c=3):\n    pass", (1,), {}],
+    ["keywords", "def func(a, b=2, c=3):\n    pass", (1,), {"c": 4}],
+    ["keyword-only, **kwargs", "def func(a, *, b=2, **kw):\n    pass", (1,), {"b": 3, "d": 4}],
+]
+
+
+async def test_bench_call_binding(hass):
+    """Compare binding call arguments with the precomputed plan against the full binding."""
+    hass.data[DOMAIN] = MockConfigEntry(domain=DOMAIN, data={CONF_ALLOW_ALL_IMPORTS: False})
+    Function.init(hass)
+    State.init(hass)
+    State.register_functions()
+
+    print()
+    for name, source, args, kwargs in bindCalls:
+        global_ctx = GlobalContext("bench", global_sym_table={}, manager=GlobalContextMgr)
+        ast_ctx = AstEval("bench", global_ctx=global_ctx)
+        ast_ctx.parse(source)
+        await ast_ctx.eval()
+        func = global_ctx.get_global_sym_table()["func"].get_func()
+        assert func.bind_args(args, kwargs) == func.bind_args_full(args, kwargs)
+        times = []
+        for bind in [func.bind_args_full, func.bind_args]:
+            best = None
+            for _ in range(3):
+                time0 = time.perf_counter()
+                for _ in range(100000):
+                    bind(args, kwargs)
+                elapsed = time.perf_counter() - time0
+                if best is None or elapsed < best:
+                    best = elapsed
+            times.append(best * 1e9 / 100000)
+        print(
+            f"{name:>24s}: full {times[0]:6.0f} ns/call, plan {times[1]:6.0f} ns/call, "
+            f"speedup {times[0] / times[1]:5.2f}x"
+        )
+
+
+async def test_bench_action_setup(hass):
+    """Compare the per-firing cost of setting up a trigger action context."""
+    hass.data[DOMAIN] = MockConfigEntry(domain=DOMAIN, data={CONF_ALLOW_ALL_IMPORTS: False})
+    Function.init(hass)
+    State.init(hass)
+    State.register_functions()
+    TrigTime.init(hass)
+
+    global_ctx = GlobalContext("bench", global_sym_table={}, manager=GlobalContextMgr)
+    ast_ctx = AstEval("bench", global_ctx=global_ctx)
+    ast_ctx.parse("def func():\n    pass")
+    await ast_ctx.eval()
+    action = global_ctx.get_global_sym_table()["func"].get_func()
+    trig = TrigInfo("bench.func", {"action": action}, global_ctx)
+
+    def setup_eager():
+        ast_ctx = AstEval("bench.func", global_ctx)
+        ast_ctx.set_local_sym_table({name: func(ast_ctx) for name, func in Function.ast_functions.items()})
+        return ast_ctx
+
+    def setup_lazy():
+        ast_ctx = AstEval("bench.func", global_ctx)
+        Function.install_ast_funcs(ast_ctx)
+        return ast_ctx
+
+    def setup_pooled():
+        ast_ctx = trig.action_ctx_get()
+        trig.action_ctx_put(ast_ctx)
+        return ast_ctx
+
+    print()
+    times = []
+    for setup in [setup_eager, setup_lazy, setup_pooled]:
+        best = None
+        for _ in range(3):
+            time0 = time.perf_counter()
+            for _ in range(10000):
+                setup()
+            elapsed = time.perf_counter() - time0
+            if best is None or elapsed < best:
+                best = elapsed
+        times.append(best * 1e9 / 10000)
+    print(
+        f"action context setup: eager {times[0]:6.0f} ns, lazy {times[1]:6.0f} ns, pooled {times[2]:6.0f} ns, "
+        f"speedup {times[0] / times[2]:5.1f}x"
+    )
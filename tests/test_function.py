@@ -52,7 +52,16 @@ def test_install_ast_funcs(ast_functions):  # pylint: disable=redefined-outer-na
 
     with patch.object(Function, "ast_functions", ast_functions):
         Function.install_ast_funcs(ast_ctx)
-        assert len(ast_ctx.method_calls) == 3
+        assert len(ast_ctx.method_calls) == 1
+        sym_table = ast_ctx.set_local_sym_table.call_args[0][0]
+        #
+        # each ast function is only created when it's first looked up
+        #
+        assert "domain_ast.func_name" in sym_table and "domain_ast.other_func" in sym_table
+        assert len(ast_ctx.method_calls) == 1
+        assert sym_table["domain_ast.func_name"] == "ok"
+        assert sym_table["domain_ast.func_name"] == "ok"
+        assert len(ast_ctx.method_calls) == 2
 
 
 @pytest.mark.parametrize(
@@ -598,3 +607,41 @@ f = [factory(50), factory(51), factory(52), factory(53), factory(54)]
         seq_num += 1
         hass.states.async_set("pyscript.var1", 101)
         assert literal_eval(await wait_until_done(notify_q)) == seq_num
+
+
+async def test_task_watch(hass, caplog):
+    """Test task.watch async iteration over state changes and events."""
+    notify_q = asyncio.Queue(0)
+    await setup_script(
+        hass,
+        notify_q,
+        [dt(2020, 7, 1, 10, 59, 59, 999999), dt(2020, 7, 1, 11, 59, 59, 999999)],
+        """
+
+@time_trigger("startup")
+def func_startup_sync():
+    changes = []
+    watch = task.watch(state_trigger="int(pyscript.var1) % 2 == 0", event_trigger=["test_event5", "arg1 > 1"])
+    pyscript.done = "ready"
+    async for trig_info in watch:
+        if trig_info["trigger_type"] == "state":
+            changes.append(trig_info["value"])
+        else:
+            changes.append(trig_info["arg1"])
+        if len(changes) == 3:
+            break
+    pyscript.done = changes
+
+    changes = [trig_info["value"] async for trig_info in task.watch(state_trigger="pyscript.var2", timeout=1e-6)]
+    pyscript.done = changes
+""",
+    )
+    hass.bus.async_fire(EVENT_HOMEASSISTANT_STARTED)
+    assert await wait_until_done(notify_q) == "ready"
+
+    for value in range(4):
+        hass.states.async_set("pyscript.var1", value)
+        hass.bus.async_fire("test_event5", {"arg1": value})
+        await hass.async_block_till_done()
+    assert literal_eval(await wait_until_done(notify_q)) == ["0", "2", 2]
+    assert literal_eval(await wait_until_done(notify_q)) == []
@@ -125,7 +125,7 @@ def func7():
         in caplog.text
     )
     assert (
-        "func7 defined in file.hello: decorator @time_trigger doesn't take keyword arguments; ignored"
+        "func7 defined in file.hello: decorator @time_trigger valid keyword arguments are: startup_delay, startup_priority; others ignored"
         in caplog.text
     )
     assert (
@@ -276,6 +276,7 @@ async def test_jupyter_kernel_msgs(hass, caplog):
         "pyscript.get_global_ctx",
         "pyscript.list_global_ctx",
         "pyscript.set_global_ctx",
+        "pyscript.set_time_slice",
     ]
 
     hass.states.async_set("pyscript.f1var1", 0)
@@ -1,5 +1,11 @@
 """Unit tests for Python interpreter."""
 
+import asyncio
+import gc
+import time
+from unittest.mock import mock_open, patch
+import warnings
+
 from custom_components.pyscript.const import CONF_ALLOW_ALL_IMPORTS, DOMAIN
 from custom_components.pyscript.eval import AstEval
 from custom_components.pyscript.function import Function
@@ -866,6 +872,231 @@ func()
 """,
         3,
     ],
+    ["sym_local + 1 if sym_local > 5 else 0", 11],
+    ['f"{sym_local:>4}|{1 + 2}"', "  10|3"],
+    ["max(sym_local, *[3, 30], 4) - abs(-2)", 28],
+    ["def len(x):\n    return 42\nlen([1, 2])", 42],
+    [
+        """
+def func():
+    if False:
+        global gvar
+    gvar = 5
+    return gvar + 1
+[func(), gvar]
+""",
+        [6, 5],
+    ],
+    [
+        """
+def squares(n):
+    for i in range(n):
+        yield i * i
+[sum(squares(5)), list(squares(3)), [x for x in squares(4) if x > 1]]
+""",
+        [30, [0, 1, 4], [4, 9]],
+    ],
+    [
+        """
+seen = []
+def count():
+    for i in range(10):
+        seen.append(i)
+        yield i
+[any(x > 2 for x in count()), seen]
+""",
+        [True, [0, 1, 2, 3]],
+    ],
+    [
+        """
+def inner():
+    yield 1
+    yield 2
+    return 3
+def outer():
+    ret = yield from inner()
+    yield ret
+total = 0
+for x in outer():
+    total += x * 10
+[total, list(x + 1 for x in outer()), next(inner()), sorted({x for x in outer()})]
+""",
+        [60, [2, 3, 4], 1, [1, 2, 3]],
+    ],
+    [
+        """
+x = 100
+gen = (x * y for x in range(2) for y in range(3) if y)
+[list(gen), list(gen), x]
+""",
+        [[0, 0, 1, 2], [], 100],
+    ],
+    [
+        """
+def gen():
+    yield 1
+    yield 2
+out = []
+async for x in gen():
+    out.append(x)
+async for x in [3, 4]:
+    out.append(x)
+[out, [x async for x in gen()], {x async for x in gen() if x > 1}, [y for y in []]]
+""",
+        [[1, 2, 3, 4], [1, 2], {2}, []],
+    ],
+    [
+        """
+def gen():
+    yield 1
+    return 5
+it = gen()
+out = [next(it)]
+try:
+    next(it)
+except StopIteration as exc:
+    out.append(exc.value)
+try:
+    next(it)
+except StopIteration as exc:
+    out.append(exc.args)
+try:
+    next(iter([]))
+except StopIteration:
+    out.append("iter")
+[out, next(it, "default")]
+""",
+        [[1, 5, (), "iter"], "default"],
+    ],
+    [
+        """
+def gen():
+    total = 0
+    while True:
+        value = yield total
+        if value is None:
+            return
+        total += value
+it = gen()
+out = [next(it), it.send(3), it.send(4)]
+try:
+    it.send(None)
+except StopIteration:
+    out.append("stop")
+out
+""",
+        [0, 3, 7, "stop"],
+    ],
+    [
+        """
+def gen():
+    yield 1
+    yield 2
+    yield 3
+it = gen()
+try:
+    len(it)
+except TypeError as exc:
+    err = str(exc)
+[2 in it, list(it), 5 in gen(), 5 not in gen(), 1 < 2 in gen(), 3 in (x + 1 for x in gen()), err]
+""",
+        [True, [3], False, True, True, True, "object of type 'generator' has no len()"],
+    ],
+    [
+        """
+def gen():
+    yield 1
+    yield 2
+[task.executor(list, gen()), task.executor(sorted, (-x for x in gen()))]
+""",
+        [[1, 2], [-2, -1]],
+    ],
+    [
+        """
+def naturals():
+    i = 0
+    while True:
+        yield i
+        i += 1
+def gen():
+    yield 1
+    yield 2
+a, b = gen()
+c, *d = gen()
+try:
+    e, f = naturals()
+except ValueError as exc:
+    err = str(exc)
+[
+    a, b, c, d, err,
+    list(zip(naturals(), "abc")),
+    list(enumerate(gen(), 1)),
+    [x for _, x in zip(range(3), map(str, naturals()))],
+    next(iter(naturals())),
+    next(filter(None, naturals())),
+    type(gen()) is type(x for x in []),
+]
+""",
+        [
+            1,
+            2,
+            1,
+            [2],
+            "too many values to unpack (expected 2)",
+            [(0, "a"), (1, "b"), (2, "c")],
+            [(1, 1), (2, 2)],
+            ["0", "1", "2"],
+            0,
+            1,
+            True,
+        ],
+    ],
+    [
+        """
+def gen():
+    yield 1
+    task.sleep(0.001)
+    yield 2
+it = zip(gen(), range(5))
+out = [next(it)]
+try:
+    next(it)
+except RuntimeError as exc:
+    out.append(str(exc))
+out
+""",
+        [
+            (1, 0),
+            "generator can't be iterated by a regular function while it awaits; use list() on it first",
+        ],
+    ],
+    [
+        """
+def func(a, b=2, c=[]):
+    c.append(a + b)
+    return c
+[func(1), func(1, 3), func(1, 4, [5]), func(2), func(a=1, c=[6])]
+""",
+        [[3, 4, 4], [3, 4, 4], [5, 5], [3, 4, 4], [6, 3]],
+    ],
+    [
+        """
+class Obj:
+    attr1 = 5
+def func():
+    out = []
+    for i in range(3):
+        if i == 1:
+            sensor = Obj()
+        if i == 2:
+            del sensor
+        out.append(sensor.attr1 if i == 1 else sensor.xyz1.attr1)
+    return out
+state.set("sensor.xyz1", 10, attr1=20)
+[func(), func(), sensor.xyz1.attr1]
+""",
+        [[20, 5, 20], [20, 5, 20], 20],
+    ],
 ]
 
 
@@ -924,7 +1155,7 @@ evalTestsExceptions = [
     ["break", "Exception in test line 1 column 0: break statement outside loop"],
     ["continue", "Exception in test line 1 column 0: continue statement outside loop"],
     ["raise", "Exception in test line 1 column 0: No active exception to reraise"],
-    ["yield", "Exception in test line 1 column 0: test: not implemented ast ast_yield"],
+    ["yield", "Exception in test line 1 column 0: 'yield' outside function"],
     ["task.executor(5)", "Exception in test line 1 column 14: function is not callable by task.executor()"],
     [
         "state.get('pyscript.xyz1.abc')",
@@ -1042,6 +1273,7 @@ func()
 """,
         "Exception in func2(), test line 4 column 12: name 'x' is not defined",
     ],
+    ["float('x') > 1", "Exception in test line 1 column 6: could not convert string to float: 'x'"],
 ]
 
 
@@ -1072,3 +1304,146 @@ async def test_eval_exceptions(hass):
 
     for test_data in evalTestsExceptions:
         await run_one_test_exception(test_data)
+
+
+async def test_eval_time_slice(hass):
+    """Test long-running loops yield to the event loop once their time slice is used up."""
+    hass.data[DOMAIN] = MockConfigEntry(domain=DOMAIN, data={CONF_ALLOW_ALL_IMPORTS: False})
+    Function.init(hass)
+    State.init(hass)
+    State.register_functions()
+
+    ticks = 0
+
+    async def ticker():
+        nonlocal ticks
+        while True:
+            ticks += 1
+            await asyncio.sleep(0)
+
+    for time_slice, source in [
+        [0.01, "def busy(t):\n    while time.monotonic() < t:\n        pass\nbusy(end)"],
+        [0.01, "x = 0\nfor i in range(10000000):\n    if time.monotonic() > end:\n        break"],
+        [0.01, "[time.sleep(0.0001) for i in range(1000)]"],
+        [None, "while time.monotonic() < end:\n    pass"],
+    ]:
+        global_ctx = GlobalContext("test", global_sym_table={"time": time}, manager=GlobalContextMgr)
+        global_ctx.set_time_slice(time_slice)
+        ast = AstEval("test", global_ctx=global_ctx)
+        ast.parse(source)
+        ticks = 0
+        ticker_task = asyncio.create_task(ticker())
+        await ast.eval({"end": time.monotonic() + 0.1})
+        ticker_task.cancel()
+        await asyncio.gather(ticker_task, return_exceptions=True)
+        assert ast.get_exception() is None
+        if time_slice is None:
+            assert ticks == 0
+        else:
+            assert ticks >= 5
+
+
+async def test_service_cache(hass):
+    """Test service lookups are cached and forgotten when services change."""
+    hass.data[DOMAIN] = MockConfigEntry(domain=DOMAIN, data={CONF_ALLOW_ALL_IMPORTS: False})
+    Function.init(hass)
+
+    async def handler(call):
+        pass
+
+    assert Function.get("test_domain.service1") is None
+    hass.services.async_register("test_domain", "service1", handler)
+    await hass.async_block_till_done()
+    func = Function.get("test_domain.service1")
+    assert func is not None
+    assert Function.get("test_domain.service1") is func
+    hass.services.async_remove("test_domain", "service1")
+    await hass.async_block_till_done()
+    assert Function.get("test_domain.service1") is None
+
+    #
+    # another init replaces the listeners rather than adding more
+    #
+    listeners = hass.bus.async_listeners()
+    Function.init(hass)
+    assert hass.bus.async_listeners() == listeners
+
+
+async def test_parse_cache(hass):
+    """Test unchanged files reuse their cached parse, and changed or unused files don't."""
+    hass.data[DOMAIN] = MockConfigEntry(domain=DOMAIN, data={CONF_ALLOW_ALL_IMPORTS: False})
+    Function.init(hass)
+    State.init(hass)
+    State.register_functions()
+    GlobalContextMgr.parse_cache = {}
+    GlobalContextMgr.parse_cache_used = set()
+
+    async def load(filepath, source):
+        global_ctx = GlobalContext("file.test", manager=GlobalContextMgr)
+        with patch("custom_components.pyscript.global_ctx.open", mock_open(read_data=source), create=True):
+            assert await GlobalContextMgr.load_file(filepath, global_ctx) is None
+        await GlobalContextMgr.delete("file.test")
+        return GlobalContextMgr.parse_cache[filepath][1]
+
+    tree = await load("/dir/test.py", "x = 1\n")
+    assert await load("/dir/test.py", "x = 1\n") is tree
+    new_tree = await load("/dir/test.py", "x = 2\n")
+    assert new_tree is not tree
+    assert await load("/dir/test.py", "x = 2\n") is new_tree
+
+    await load("/dir/other.py", "y = 1\n")
+    GlobalContextMgr.parse_cache_prune()
+    assert set(GlobalContextMgr.parse_cache) == {"/dir/test.py", "/dir/other.py"}
+    await load("/dir/test.py", "x = 2\n")
+    GlobalContextMgr.parse_cache_prune()
+    assert set(GlobalContextMgr.parse_cache) == {"/dir/test.py"}
+    assert not GlobalContextMgr.parse_cache_used
+
+
+async def test_lazy_body_compile(hass):
+    """Test function bodies are only compiled on their first call."""
+    hass.data[DOMAIN] = MockConfigEntry(domain=DOMAIN, data={CONF_ALLOW_ALL_IMPORTS: False})
+    Function.init(hass)
+    State.init(hass)
+    State.register_functions()
+
+    global_ctx = GlobalContext("test", global_sym_table={}, manager=GlobalContextMgr)
+    ast = AstEval("test", global_ctx=global_ctx)
+    ast.parse("def func(x=1):\n    y = x + 1\n    return y\n")
+    func_def = ast.ast.body[0]
+    assert func_def.eval_code is not None
+    assert func_def.args.defaults[0].eval_code is not None
+    assert not getattr(func_def, "eval_body", False)
+    assert all(getattr(node, "eval_code", None) is None for node in func_def.body)
+
+    await ast.eval()
+    assert all(getattr(node, "eval_code", None) is None for node in func_def.body)
+
+    ast.parse("func(2)")
+    assert await ast.eval() == 3
+    assert func_def.eval_body
+    body_code = [node.eval_code for node in func_def.body]
+    assert None not in body_code
+
+    assert await ast.eval() == 3
+    assert [node.eval_code for node in func_def.body] == body_code
+
+
+async def test_generator_not_started(hass):
+    """Test generators that are never iterated don't leave coroutines that were never awaited."""
+    hass.data[DOMAIN] = MockConfigEntry(domain=DOMAIN, data={CONF_ALLOW_ALL_IMPORTS: False})
+    Function.init(hass)
+    State.init(hass)
+    State.register_functions()
+
+    with warnings.catch_warnings(record=True) as caught:
+        warnings.simplefilter("always")
+        for source in ["def gen():\n    yield 1\nx = gen()", "x = (y for y in range(3))"]:
+            global_ctx = GlobalContext("test", global_sym_table={}, manager=GlobalContextMgr)
+            ast = AstEval("test", global_ctx=global_ctx)
+            ast.parse(source)
+            await ast.eval()
+            assert ast.get_exception() is None
+            del global_ctx, ast
+            gc.collect()
+    assert not [warning for warning in caught if issubclass(warning.category, RuntimeWarning)]
@@ -1,12 +1,31 @@
 """Unit tests for time trigger functions."""
 
+import asyncio
 from datetime import datetime as dt
+import logging
 
+from custom_components.pyscript.const import LOGGER_PATH
+from custom_components.pyscript.eval import AstEval
+from custom_components.pyscript.event import Event
 from custom_components.pyscript.function import Function
-from custom_components.pyscript.trigger import TrigTime
+from custom_components.pyscript.global_ctx import GlobalContext, GlobalContextMgr
+from custom_components.pyscript.state import State
+from custom_components.pyscript.trigger import (
+    NotifyQueue,
+    TimeSpecCron,
+    TimeSpecOnce,
+    TimeSpecPeriod,
+    TimeSpecRange,
+    TrigExpr,
+    TrigInfo,
+    TrigStartup,
+    TrigTime,
+)
 import pytest
 from pytest_homeassistant_custom_component.async_mock import patch
 
+from homeassistant.const import EVENT_CORE_CONFIG_UPDATE
+
 parseDateTimeTests = [
     ["2019/9/12 13:45", 0, dt(2019, 9, 12, 13, 45, 0, 0)],
     ["9/12 13:45", 0, dt(2019, 9, 12, 13, 45, 0, 0)],
@@ -502,3 +521,767 @@ def test_timer_trigger_next_month_rollover(hass):
             t_next = TrigTime.timer_trigger_next(spec, now)
             assert t_next == expect
             now = t_next
+
+
+async def test_timer_scheduler(hass):
+    """Test the shared timer heap delivers timers in order, and skips canceled ones."""
+    TrigTime.init(hass)
+    notify_q1 = asyncio.Queue(0)
+    notify_q2 = asyncio.Queue(0)
+
+    timers = [TrigTime.timer_add(0.02 * (10 - i), notify_q1, i) for i in range(10)]
+    TrigTime.timer_add(0.05, notify_q2, "q2")
+    for i in range(0, 10, 2):
+        TrigTime.timer_cancel(timers[i])
+    assert len(TrigTime.timer_heap) == 11
+
+    assert await asyncio.wait_for(notify_q2.get(), timeout=5) == ["time", "q2"]
+    got = [(await asyncio.wait_for(notify_q1.get(), timeout=5))[1] for i in range(5)]
+    assert got == [9, 7, 5, 3, 1]
+    assert notify_q1.empty()
+    assert TrigTime.timer_heap == []
+
+    #
+    # canceling a timer that already fired does nothing
+    #
+    TrigTime.timer_cancel(timers[1])
+    assert TrigTime.timer_num_canceled == 0
+
+
+def test_time_spec_parse(hass):
+    """Test time specs are parsed into the right type, and invalid ones are rejected."""
+    TrigTime.init(hass)
+
+    now = dt(2019, 9, 1, 13, 0, 0, 100000)
+    for spec, spec_type, next_time in [
+        ["cron(0 14 * * *)", TimeSpecCron, dt(2019, 9, 1, 14, 0, 0, 0)],
+        ["once(2019/9/1 15:00)", TimeSpecOnce, dt(2019, 9, 1, 15, 0, 0, 0)],
+        ["period(2019/9/1 12:00, 5 min)", TimeSpecPeriod, dt(2019, 9, 1, 13, 5, 0, 0)],
+    ]:
+        time_spec = TrigTime.time_spec_parse(spec)
+        assert isinstance(time_spec, spec_type)
+        assert time_spec.next_after(now) == next_time
+        assert TrigTime.timer_trigger_next([time_spec], now) == next_time
+
+    time_spec = TrigTime.time_spec_parse_list(["not range(12:00, 14:00)", "cron(* 14 * * *)"], active=True)
+    assert isinstance(time_spec[0], TimeSpecRange) and time_spec[0].negate
+    assert time_spec[0].contains(now)
+    assert not TrigTime.timer_active_check(time_spec, now)
+    assert not TrigTime.timer_active_check(time_spec[:1], now)
+
+    for spec, active in [
+        ["cron(* * *)", False],
+        ["period(2019/9/1 12:00, 0)", False],
+        ["range(12:00, 14:00)", False],
+        ["once(12:00)", True],
+        ["xyz", True],
+    ]:
+        with pytest.raises(ValueError):
+            TrigTime.time_spec_parse(spec, active=active)
+
+
+async def test_sun_cache(hass):
+    """Test sun times and resolved date times are cached until the location config changes."""
+    TrigTime.init(hass)
+
+    now = dt(2019, 9, 1, 13, 0, 0, 0)
+    time_sun = TrigTime.sun_time("sunset", now.date())
+    assert isinstance(time_sun, dt)
+    assert ("sunset", now.date()) in TrigTime.sun_cache
+    assert TrigTime.sun_time("sunset", now.date()) is time_sun
+
+    time_spec = TrigTime.time_spec_parse("once(2019/9/1 15:00)")
+    assert time_spec.next_after(now) is time_spec.next_after(now.replace(hour=14))
+
+    #
+    # another init replaces the config listener, so it still only fires once
+    #
+    TrigTime.init(hass)
+    config_gen = TrigTime.config_gen
+    hass.bus.async_fire(EVENT_CORE_CONFIG_UPDATE, {})
+    await hass.async_block_till_done()
+    assert TrigTime.sun_cache == {}
+    assert TrigTime.config_gen == config_gen + 1
+
+    #
+    # the sun doesn't set near the north pole in summer
+    #
+    await hass.config.async_update(latitude=89.0, longitude=0.0)
+    await hass.async_block_till_done()
+    assert TrigTime.sun_time("sunset", now.date()) is None
+
+
+async def test_trig_expr_shared(hass, caplog):
+    """Test identical trigger expressions are shared and evaluated once per notification."""
+    Function.init(hass)
+    TrigTime.init(hass)
+    State.init(hass)
+
+    num_calls = 0
+
+    def count():
+        nonlocal num_calls
+        num_calls += 1
+        return True
+
+    global_ctx = GlobalContext("test", global_sym_table={"count": count}, manager=GlobalContextMgr)
+    global_ctx2 = GlobalContext("test2", global_sym_table={"count": count}, manager=GlobalContextMgr)
+    expr = TrigExpr.get("func1 @state_trigger()", global_ctx, "sensor.a == '1' and count()")
+    assert TrigExpr.get("func2 @state_trigger()", global_ctx, "(sensor.a=='1') and count( )") is expr
+    assert TrigExpr.get("func2 @state_trigger()", global_ctx2, "sensor.a == '1' and count()") is not expr
+    assert TrigExpr.get("func3 @state_trigger()", global_ctx, "sensor.a ==") is None
+    assert await expr.get_names() == {"sensor.a", "count"}
+
+    func_args = {"var_name": "sensor.a", "value": "1"}
+    for _ in range(3):
+        assert await expr.eval({"sensor.a": "1"}, func_args)
+    assert num_calls == 1
+
+    assert await expr.eval({"sensor.a": "1"}, dict(func_args))
+    assert not await expr.eval({"sensor.a": "2"}, func_args)
+    assert num_calls == 2
+
+    #
+    # errors are logged by each trigger sharing the expression, even if the result is reused
+    #
+    bad_expr = TrigExpr.get("func1 @state_trigger()", global_ctx, "sensor.a == '1' and 1 / 0")
+    assert TrigExpr.get("func2 @state_trigger()", global_ctx, "sensor.a == '1' and 1/0") is bad_expr
+    for trig_name in ["func1", "func2"]:
+        logger = logging.getLogger(LOGGER_PATH + "." + trig_name)
+        assert not await bad_expr.eval({"sensor.a": "1"}, func_args, logger)
+    for trig_name in ["func1", "func2"]:
+        assert any(
+            record.name == LOGGER_PATH + "." + trig_name and "ZeroDivisionError" in record.getMessage()
+            for record in caplog.records
+        )
+
+
+async def test_state_trig_terms(hass):
+    """Test only the state trigger terms that read the changed variable are re-evaluated."""
+    Function.init(hass)
+    TrigTime.init(hass)
+    State.init(hass)
+
+    evals = []
+
+    def count(name):
+        evals.append(name)
+        return True
+
+    global_ctx = GlobalContext("test", global_sym_table={"count": count}, manager=GlobalContextMgr)
+    trig = TrigInfo(
+        "func1",
+        {
+            "state_trigger": {
+                "args": ["sensor.a == '1' and count('a')", "sensor.b.attr1 == 'x' and count('b')"]
+            }
+        },
+        global_ctx,
+    )
+    trig.start()
+    await asyncio.sleep(0)
+    assert trig.state_trig_term_vars == [{"sensor.a"}, {"sensor.b"}]
+
+    for var_name, new_vars, trig_ok, new_evals in [
+        ["sensor.a", {"sensor.a": "1", "sensor.b.attr1": "y"}, True, ["a"]],
+        ["sensor.b", {"sensor.a": "1", "sensor.b.attr1": "x"}, True, []],
+        ["sensor.a", {"sensor.a": "2", "sensor.b.attr1": "x"}, True, ["b"]],
+        ["sensor.a", {"sensor.a": "3", "sensor.b.attr1": "x"}, True, []],
+        ["sensor.b", {"sensor.a": "3", "sensor.b.attr1": "y"}, False, []],
+    ]:
+        evals = []
+        assert await trig.state_trig_check(new_vars, {"var_name": var_name}) == trig_ok
+        assert evals == new_evals
+    trig.stop()
+
+
+async def test_state_wildcard_notify(hass):
+    """Test wildcard state variable patterns get notified of matching state changes."""
+    State.init(hass)
+    notify_q = asyncio.Queue(0)
+    var_names = {"sensor.*_battery", "sensor.temp"}
+    await State.notify_add(var_names, notify_q)
+
+    for var_name, notified in [
+        ["sensor.phone_battery", True],
+        ["sensor.battery_level", False],
+        ["binary_sensor.door_battery", False],
+        ["sensor.temp", True],
+        ["sensor.new_battery", True],
+    ]:
+        func_args = {"trigger_type": "state", "var_name": var_name, "value": "1", "old_value": None}
+        await State.update({var_name: "1", f"{var_name}.old": None}, func_args)
+        if notified:
+            notify_type, (notify_vars, notify_args) = notify_q.get_nowait()
+            assert notify_type == "state" and notify_args is func_args
+            assert "sensor.*_battery" not in notify_vars
+        assert notify_q.empty()
+    assert State.wildcard_match("sensor.phone_battery", var_names)
+    assert not State.wildcard_match("sensor.temp", var_names)
+
+    State.notify_del(var_names, notify_q)
+    assert State.notify_wildcard == {}
+    await State.update({"sensor.phone_battery": "2"}, {"var_name": "sensor.phone_battery"})
+    assert notify_q.empty()
+
+
+async def test_state_attr_notify(hass):
+    """Test queues that only read attributes are only notified when those attributes change."""
+    State.init(hass)
+    attr_q = asyncio.Queue(0)
+    state_q = asyncio.Queue(0)
+    await State.notify_add({"climate.x.temp", "climate.x.temp.old"}, attr_q)
+    await State.notify_add({"climate.x", "climate.x.temp"}, state_q)
+
+    old_attrs = {"temp": 20, "humidity": 50}
+    for new_val, new_attrs, attr_notified in [
+        ["heat", {"temp": 20, "humidity": 51}, False],
+        ["cool", {"temp": 20, "humidity": 51}, False],
+        ["cool", {"temp": 21, "humidity": 51}, True],
+        ["cool", {"humidity": 51}, True],
+    ]:
+        func_args = {"trigger_type": "state", "var_name": "climate.x", "value": new_val}
+        await State.update(
+            {"climate.x": new_val, "climate.x.old": "heat"},
+            func_args,
+            old_attrs=old_attrs,
+            new_attrs=new_attrs,
+        )
+        assert state_q.get_nowait()[1][1] is func_args
+        if attr_notified:
+            notify_vars = attr_q.get_nowait()[1][0]
+            assert notify_vars["climate.x.temp.old"] == old_attrs["temp"]
+            assert notify_vars["climate.x.temp"] == new_attrs.get("temp")
+        assert attr_q.empty()
+        old_attrs = new_attrs
+
+    State.notify_del({"climate.x.temp", "climate.x.temp.old"}, attr_q)
+    State.notify_del({"climate.x", "climate.x.temp"}, state_q)
+    assert "climate.x" not in State.notify_attrs
+
+
+async def test_notify_queue(hass):
+    """Test trigger queue size limits and overflow policies."""
+
+    def state_msg(var_name, value):
+        return ["state", [{var_name: value}, {"var_name": var_name, "value": value}]]
+
+    notify_q = NotifyQueue("func1", size=2, policy="block")
+    notify_q.put_nowait(state_msg("sensor.a", 1))
+    notify_q.put_nowait(state_msg("sensor.a", 2))
+    assert notify_q.full()
+    with pytest.raises(asyncio.QueueFull):
+        notify_q.put_nowait(state_msg("sensor.a", 3))
+
+    notify_q = NotifyQueue("func1", size=2)
+    assert notify_q.policy == "drop_oldest"
+    for value in range(4):
+        notify_q.put_nowait(state_msg("sensor.a", value))
+    assert not notify_q.full()
+    assert [notify_q.get_nowait()[1][1]["value"] for _ in range(2)] == [2, 3]
+    assert notify_q.num_dropped == 2
+
+    notify_q = NotifyQueue("func1", size=2, policy="latest")
+    for var_name, value in [["sensor.a", 1], ["sensor.b", 1], ["sensor.a", 2], ["sensor.c", 1]]:
+        notify_q.put_nowait(state_msg(var_name, value))
+    notify_q.put_nowait(["event", {"trigger_type": "event"}])
+    assert notify_q.num_coalesced == 1 and notify_q.num_dropped == 2
+    assert notify_q.get_nowait()[1][1] == {"var_name": "sensor.c", "value": 1}
+    assert notify_q.get_nowait()[0] == "event"
+    assert notify_q.latest == {}
+    notify_q.put_nowait(state_msg("sensor.c", 2))
+    assert notify_q.num_coalesced == 1
+
+    for size, policy in [[0, "block"], ["2", "latest"], [None, "newest"]]:
+        with pytest.raises(ValueError):
+            NotifyQueue("func1", size=size, policy=policy)
+
+
+async def test_wait_until_queue(hass):
+    """Test task.wait_until() queue_size and queue_policy limit its notification queue."""
+    Function.init(hass)
+    TrigTime.init(hass)
+    State.init(hass)
+
+    ast_ctx = AstEval("test", GlobalContext("test", global_sym_table={}, manager=GlobalContextMgr))
+    wait_until = TrigTime.wait_until(
+        ast_ctx, state_trigger="sensor.q", queue_size=2, queue_policy="latest", timeout=5
+    )
+    wait = asyncio.create_task(wait_until)
+    await asyncio.sleep(0)
+    [notify_q] = State.notify["sensor.q"]
+    assert isinstance(notify_q, NotifyQueue) and notify_q.size == 2 and notify_q.policy == "latest"
+    func_args = {"trigger_type": "state", "var_name": "sensor.q", "value": "1"}
+    await State.update({"sensor.q": "1"}, func_args)
+    assert await wait == func_args
+    assert "sensor.q" not in State.notify
+
+    with pytest.raises(ValueError):
+        await TrigTime.wait_until(ast_ctx, state_trigger="sensor.q", queue_policy="newest")
+
+
+async def test_notify_queue_block(hass):
+    """Test a full queue with the block policy doesn't hold up notifying other queues."""
+    Function.init(hass)
+    State.init(hass)
+    Event.init(hass)
+
+    block_q = NotifyQueue("func1", size=1, policy="block")
+    other_q = NotifyQueue("func2")
+    for notify_q in [block_q, other_q]:
+        await State.notify_add({"sensor.q"}, notify_q)
+        Event.notify_add("test_event", notify_q)
+    for value in ["1", "2"]:
+        func_args = {"trigger_type": "state", "var_name": "sensor.q", "value": value}
+        await asyncio.wait_for(State.update({"sensor.q": value}, func_args), 1)
+    await asyncio.wait_for(Event.update("test_event", {"trigger_type": "event"}), 1)
+    assert other_q.qsize() == 3 and block_q.qsize() == 1
+
+    #
+    # the notifications that didn't fit are queued, in order, once there's room
+    #
+    received = []
+    for _ in range(3):
+        received.append(await asyncio.wait_for(block_q.get(), 1))
+    assert [msg[0] for msg in received] == ["state", "state", "event"]
+    assert [msg[1][1]["value"] for msg in received[:2]] == ["1", "2"]
+    State.notify_del({"sensor.q"}, block_q)
+    State.notify_del({"sensor.q"}, other_q)
+    Event.notify_del("test_event", block_q)
+    Event.notify_del("test_event", other_q)
+
+
+class FakeAction:
+    """Trigger action that records its calls, and optionally waits until told to finish.
+
+    Actions given the same calls list, running set and finish dict record into them
+    together.  Each call is keyed by (var_name, value) for state triggers, and otherwise
+    by the action's name.
+    """
+
+    global_ctx_name = "test"
+
+    def __init__(self, global_ctx, name="func", calls=None, running=None, finish=None):
+        """Initialize action; with finish, each call waits until finish[key] is set."""
+        self.global_ctx = global_ctx
+        self.name = name
+        self.calls = calls if calls is not None else []
+        self.running = running if running is not None else set()
+        self.finish = finish
+
+    async def call(self, ast_ctx, **kwargs):
+        """Record the call, and wait until it's told to finish."""
+        key = (kwargs["var_name"], kwargs["value"]) if "var_name" in kwargs else self.name
+        self.calls.append(key)
+        self.running.add(key)
+        if self.finish is not None:
+            self.finish[key] = asyncio.Event()
+            await self.finish[key].wait()
+        self.running.discard(key)
+
+
+class FakeClock:
+    """Event loop clock that only moves when the test advances it.
+
+    While it's installed with patch.object(loop, "time", clock.time), the timers and
+    delays, which all use the event loop's clock, fire exactly when the test says.
+    """
+
+    def __init__(self, loop):
+        """Initialize clock at the loop's current time."""
+        self.now = loop.time()
+
+    def time(self):
+        """Return the fake time."""
+        return self.now
+
+    async def advance(self, secs=0):
+        """Advance the clock by secs, then run everything that's ready until it's idle."""
+        self.now += secs
+        for _ in range(50):
+            await asyncio.sleep(0)
+
+
+async def test_state_trigger_delays(hass):
+    """Test @state_trigger debounce, throttle and hold only run the action when they should."""
+    Function.init(hass)
+    TrigTime.init(hass)
+    State.init(hass)
+
+    global_ctx = GlobalContext("test", global_sym_table={}, manager=GlobalContextMgr)
+    loop = asyncio.get_running_loop()
+    clock = FakeClock(loop)
+    calls = []
+
+    async def set_state(var_name, value):
+        func_args = {"trigger_type": "state", "var_name": var_name, "value": value}
+        await State.update({var_name: value}, func_args)
+        await clock.advance()
+
+    with patch.object(loop, "time", clock.time):
+        trigs = []
+        for var_name, kwargs in [
+            ["sensor.a == '1'", {"hold": 5}],
+            ["sensor.b", {"debounce": 5}],
+            ["sensor.c", {"throttle": 10}],
+        ]:
+            trig_cfg = {
+                "state_trigger": {"args": [var_name], "kwargs": kwargs},
+                "action": FakeAction(global_ctx, calls=calls),
+            }
+            trig = TrigInfo(f"func_{var_name}", trig_cfg, global_ctx)
+            trig.start()
+            trigs.append(trig)
+        await clock.advance()
+
+        #
+        # hold only runs the action once the expression has stayed true for 5 seconds
+        #
+        await set_state("sensor.a", "1")
+        await clock.advance(4.9)
+        await set_state("sensor.a", "0")
+        await clock.advance(10)
+        assert calls == []
+        await set_state("sensor.a", "1")
+        await clock.advance(4.9)
+        assert calls == []
+        await clock.advance(0.1)
+        assert calls == [("sensor.a", "1")]
+        await set_state("sensor.a", "1")
+        await clock.advance(10)
+        assert calls == [("sensor.a", "1")]
+
+        #
+        # debounce restarts the 5 seconds on each change, and runs the action with the last one
+        #
+        calls.clear()
+        for value in ["1", "2", "3"]:
+            await set_state("sensor.b", value)
+            await clock.advance(4)
+        assert calls == []
+        await clock.advance(1)
+        assert calls == [("sensor.b", "3")]
+
+        #
+        # throttle ignores changes for 10 seconds after running the action
+        #
+        calls.clear()
+        for value in ["1", "2"]:
+            await set_state("sensor.c", value)
+            await clock.advance(9.9)
+        await set_state("sensor.c", "3")
+        assert calls == [("sensor.c", "1"), ("sensor.c", "3")]
+
+        for trig in trigs:
+            trig.stop()
+
+    for var_name, kwargs in [["sensor.a == '1'", {"hold": 1, "debounce": 1}], ["sensor.a", {"hold": 1}]]:
+        trig = TrigInfo("func", {"state_trigger": {"args": [var_name], "kwargs": kwargs}}, global_ctx)
+        assert not trig.setup_ok
+
+
+async def test_action_ctx_pool(hass):
+    """Test action contexts are reused, and only create the ast functions they use."""
+    Function.init(hass)
+    TrigTime.init(hass)
+    State.init(hass)
+
+    global_ctx = GlobalContext("test", global_sym_table={}, manager=GlobalContextMgr)
+    ast_ctx = AstEval("test.setup", global_ctx)
+    ast_ctx.parse("def func(x):\n    log.info(f'x = {x}')\n    return 1 / x")
+    await ast_ctx.eval()
+    func = global_ctx.get_global_sym_table()["func"].get_func()
+
+    trig = TrigInfo("func", {"action": func}, global_ctx)
+    action_ctx = trig.action_ctx_get()
+    assert "log.info" in action_ctx.local_sym_table and "task.unique" in action_ctx.local_sym_table
+    assert len(action_ctx.local_sym_table) == 0
+    await func.call(action_ctx, 0)
+    assert action_ctx.get_exception_obj() is not None
+    assert list(action_ctx.local_sym_table) == ["log.info"]
+
+    trig.action_ctx_put(action_ctx)
+    assert action_ctx.get_exception_obj() is None
+    assert trig.action_ctx_get() is action_ctx
+    assert trig.action_ctx_get() is not action_ctx
+
+    action_ctx.sym_table_stack.append({})
+    trig.action_ctx_put(action_ctx)
+    assert trig.action_ctx_pool == []
+
+
+async def test_event_filter_notify(hass):
+    """Test event filters only notify the queues whose filter matches the event data."""
+    Event.init(hass)
+    queues = {name: asyncio.Queue(0) for name in ["all", "light", "light_on", "switch_or_fan"]}
+    for name, filter_kwargs in [
+        ["all", None],
+        ["light", {"domain": "light"}],
+        ["light_on", {"domain": "light", "service": "turn_on"}],
+        ["switch_or_fan", {"domain": ["switch", "fan"], "service": "turn_on"}],
+    ]:
+        Event.notify_add("call_service", queues[name], Event.filter_parse(filter_kwargs))
+
+    for event_data, notified in [
+        [{"domain": "light", "service": "turn_on"}, {"all", "light", "light_on"}],
+        [{"domain": "light", "service": "turn_off"}, {"all", "light"}],
+        [{"domain": "fan", "service": "turn_on"}, {"all", "switch_or_fan"}],
+        [{"domain": "fan"}, {"all"}],
+        [{"domain": {"light"}, "service": "turn_on"}, {"all"}],
+    ]:
+        func_args = {"trigger_type": "event", "event_type": "call_service", **event_data}
+        await Event.update("call_service", func_args)
+        for name, queue in queues.items():
+            if name in notified:
+                assert queue.get_nowait() == ["event", func_args]
+            assert queue.empty()
+
+    with pytest.raises(ValueError):
+        Event.filter_parse({"domain": {"a": 1}})
+
+    for queue in queues.values():
+        Event.notify_del("call_service", queue)
+    assert "call_service" not in Event.notify and "call_service" not in Event.notify_index
+
+
+async def test_wait_expr_cache(hass):
+    """Test wait_until expressions are parsed once per global context, with LRU eviction."""
+    Function.init(hass)
+    TrigTime.init(hass)
+    State.init(hass)
+
+    global_ctx = GlobalContext("test", global_sym_table={}, manager=GlobalContextMgr)
+    global_ctx2 = GlobalContext("test2", global_sym_table={}, manager=GlobalContextMgr)
+    ast_ctx = AstEval("test.func", global_ctx)
+    ast_ctx2 = AstEval("test2.func", global_ctx2)
+
+    ident, ident_any, expr = await TrigTime.state_trig_parse(ast_ctx, ["sensor.a == '1'", "sensor.b"])
+    assert ident == {"sensor.a", "sensor.b"} and ident_any == {"sensor.b"}
+    ident2, _, expr2 = await TrigTime.state_trig_parse(ast_ctx, ["sensor.a == '1'", "sensor.b"])
+    assert ident2 == ident and ident2 is not ident
+    assert expr2 is not expr and expr2.ast is expr.ast
+    _, _, expr3 = await TrigTime.state_trig_parse(ast_ctx2, ["sensor.a == '1'", "sensor.b"])
+    assert expr3.ast is not expr.ast
+
+    assert await expr2.eval({"sensor.a": "1"})
+    assert not await expr.eval({"sensor.a": "2"})
+
+    #
+    # the names are found again each time, since a global can hide a state variable
+    #
+    global_ctx.get_global_sym_table()["sensor"] = object()
+    ident3, _, expr3 = await TrigTime.state_trig_parse(ast_ctx, ["sensor.a == '1'", "sensor.b"])
+    assert expr3.ast is expr.ast and ident3 == {"sensor", "sensor.b"}
+    del global_ctx.get_global_sym_table()["sensor"]
+
+    event_expr = await TrigTime.event_trig_parse(ast_ctx, ["my_event", "arg1 == 1"])
+    assert (await TrigTime.event_trig_parse(ast_ctx, ["my_event", "arg1 == 1"])).ast is event_expr.ast
+    with pytest.raises(SyntaxError):
+        await TrigTime.event_trig_parse(ast_ctx, ["my_event", "arg1 =="])
+
+    with patch.object(TrigTime, "wait_expr_cache_max", 2):
+        for i in range(3):
+            await TrigTime.event_trig_parse(ast_ctx, ["my_event", f"arg1 == {i}"])
+        assert len(TrigTime.wait_expr_cache) == 2
+        assert (id(global_ctx), "event_trigger", "arg1 == 2") in TrigTime.wait_expr_cache
+        assert (id(global_ctx), "event_trigger", "arg1 == 0") not in TrigTime.wait_expr_cache
+
+
+async def test_startup_scheduler(hass):
+    """Test startup runs are limited to the concurrency, in priority order."""
+    Function.init(hass)
+    TrigTime.init(hass)
+    State.init(hass)
+    TrigStartup.init(concurrency=2)
+
+    global_ctx = GlobalContext("test", global_sym_table={}, manager=GlobalContextMgr)
+    loop = asyncio.get_running_loop()
+    clock = FakeClock(loop)
+    running = set()
+    started = []
+    finish = {}
+
+    def action(name):
+        return FakeAction(global_ctx, name, calls=started, running=running, finish=finish)
+
+    with patch.object(loop, "time", clock.time):
+        trigs = []
+        for name, kwargs in [
+            ["a", {}],
+            ["b", {"startup_priority": 5}],
+            ["c", {}],
+            ["d", {"startup_priority": 10}],
+        ]:
+            trig_cfg = {"time_trigger": {"args": None, "kwargs": kwargs}, "action": action(name)}
+            trig = TrigInfo(name, trig_cfg, global_ctx)
+            trig.start()
+            trigs.append(trig)
+        await clock.advance()
+        assert set(started) == {"d", "b"} and TrigStartup.num_running == 2
+
+        finish["b"].set()
+        await clock.advance()
+        assert started[2:] == ["a"] and running == {"d", "a"}
+        assert "b" in TrigStartup.run_times and "d" not in TrigStartup.run_times
+
+        #
+        # a run that's taking too long gives up its slot
+        #
+        with patch.object(TrigStartup, "slot_timeout", 2):
+            trigs[2].stop()
+            trig = TrigInfo("e", {"time_trigger": {"args": None}, "action": action("e")}, global_ctx)
+            trig.start()
+            trigs.append(trig)
+            finish["a"].set()
+            await clock.advance()
+            assert started[2:] == ["a", "e"]
+            await clock.advance(1.9)
+            assert TrigStartup.num_running == 2
+            await clock.advance(0.1)
+            assert TrigStartup.num_running == 1 and running == {"d", "e"}
+
+        for name in ["d", "e"]:
+            finish[name].set()
+        await clock.advance()
+        assert TrigStartup.num_running == 0 and set(TrigStartup.run_times) == {"a", "b", "d", "e"}
+        for trig in trigs:
+            trig.stop()
+
+        #
+        # startup_delay holds the run back until the delay is up
+        #
+        trig_cfg = {"time_trigger": {"args": None, "kwargs": {"startup_delay": 5}}, "action": action("f")}
+        trig = TrigInfo("f", trig_cfg, global_ctx)
+        trig.start()
+        await clock.advance(4.9)
+        assert "f" not in started
+        await clock.advance(0.1)
+        assert started[-1] == "f"
+        finish["f"].set()
+        await clock.advance()
+        trig.stop()
+
+    for kwargs, setup_ok in [
+        [{"startup_priority": -3, "startup_delay": 0.5}, True],
+        [{"startup_priority": "high"}, False],
+        [{"startup_priority": None, "startup_delay": -1}, False],
+        [{"startup_delay": True}, False],
+        [{"startup_delay": "5"}, False],
+    ]:
+        trig_cfg = {"time_trigger": {"args": None, "kwargs": kwargs}, "action": action("g")}
+        trig = TrigInfo("g", trig_cfg, global_ctx)
+        assert trig.setup_ok == setup_ok
+        if setup_ok:
+            assert trig.startup_priority == -3 and trig.startup_delay == 0.5
+
+
+async def test_task_limit(hass):
+    """Test @task_limit limits the running actions, and queues, coalesces or drops the others."""
+    Function.init(hass)
+    TrigTime.init(hass)
+    State.init(hass)
+
+    global_ctx = GlobalContext("test", global_sym_table={}, manager=GlobalContextMgr)
+    loop = asyncio.get_running_loop()
+    clock = FakeClock(loop)
+    started = []
+    finish = {}
+
+    def action():
+        return FakeAction(global_ctx, calls=started, finish=finish)
+
+    async def set_values(var_name, values):
+        for value in values:
+            func_args = {"trigger_type": "state", "var_name": var_name, "value": value}
+            await State.update({var_name: value}, func_args)
+
+    with patch.object(loop, "time", clock.time):
+        for var_name, queue, limit in [
+            ["sensor.a", "fifo", 2],
+            ["sensor.b", "latest", 1],
+            ["sensor.c", "drop", 1],
+        ]:
+            trig_cfg = {
+                "state_trigger": {"args": [var_name]},
+                "task_limit": {"args": limit, "kwargs": {"queue": queue}},
+                "action": action(),
+            }
+            trig = TrigInfo(f"func_{queue}", trig_cfg, global_ctx)
+            trig.start()
+            await clock.advance()
+            started.clear()
+            await set_values(var_name, range(4))
+            await clock.advance()
+            assert started == [(var_name, value) for value in range(limit)]
+            assert trig.task_limit_running == limit
+
+            finish[(var_name, 0)].set()
+            await clock.advance()
+            if queue == "fifo":
+                assert started == [(var_name, 0), (var_name, 1), (var_name, 2)]
+                assert len(trig.task_limit_pending) == 1 and trig.task_limit_stats["queued"] == 2
+            elif queue == "latest":
+                assert started == [(var_name, 0), (var_name, 3)]
+                assert trig.task_limit_stats["coalesced"] == 2 and trig.task_limit_stats["wait_max"] > 0
+            else:
+                assert started == [(var_name, 0)] and trig.task_limit_running == 0
+                assert trig.task_limit_stats["dropped"] == 3
+
+            for _ in range(3):
+                for event in finish.values():
+                    event.set()
+                await clock.advance()
+            assert trig.task_limit_running == 0 and not trig.task_limit_pending
+            trig.stop()
+
+        #
+        # stopping the trigger drops the queued actions, and reuses their contexts
+        #
+        trig_cfg = {"state_trigger": {"args": ["sensor.d"]}, "task_limit": {"args": 1}, "action": action()}
+        trig = TrigInfo("func_stop", trig_cfg, global_ctx)
+        trig.start()
+        await clock.advance()
+        await set_values("sensor.d", range(3))
+        await clock.advance()
+        assert len(trig.task_limit_pending) == 2
+        num_pooled = len(trig.action_ctx_pool)
+        trig.stop()
+        assert not trig.task_limit_pending and trig.task_limit_stats["dropped"] == 2
+        assert len(trig.action_ctx_pool) == num_pooled + 2
+        finish[("sensor.d", 0)].set()
+        await clock.advance()
+
+    for args, kwargs in [[0, {}], [1, {"queue": "lifo"}]]:
+        trig_cfg = {"state_trigger": {"args": ["sensor.a"]}, "task_limit": {"args": args, "kwargs": kwargs}}
+        trig = TrigInfo("func", trig_cfg, global_ctx)
+        assert not trig.setup_ok
+
+
+async def test_notify_var_last(hass):
+    """Test the last notified values are kept while watched, and bounded after that."""
+    State.init(hass)
+    State.notify_var_last.clear()
+    State.notify_var_recent.clear()
+    notify_q = asyncio.Queue(0)
+
+    await State.notify_add({"sensor.a", "sensor.b.attr1"}, notify_q)
+    await State.update({"sensor.a": "1", "sensor.a.old": "0"}, {"var_name": "sensor.a"})
+    notify_q.get_nowait()
+    assert State.notify_var_last == {"sensor.a": "1"}
+    assert State.notify_var_get({"sensor.a"}, {}) == {"sensor.a": "1"}
+
+    State.notify_del({"sensor.a", "sensor.b.attr1"}, notify_q)
+    assert "sensor.a" not in State.notify and "sensor.b" not in State.notify
+    assert State.notify_var_last_info() == {"watched": 0, "recent": 1, "recent_max": 256}
+    await State.update({"sensor.a": "2", "sensor.a.old": "1"}, {"var_name": "sensor.a"})
+    assert State.notify_var_get({"sensor.a"}, {}) == {"sensor.a": "2"}
+
+    await State.notify_add({"sensor.a"}, notify_q)
+    assert State.notify_var_last == {"sensor.a": "2"} and not State.notify_var_recent
+    State.notify_del({"sensor.a"}, notify_q)
+
+    with patch.object(State, "notify_var_recent_max", 2):
+        for var_name in ["sensor.x", "sensor.y"]:
+            await State.set(var_name, 1)
+        assert list(State.notify_var_recent) == ["sensor.x", "sensor.y"]
+        assert "sensor.a" not in State.notify_var_recent